@@ -0,0 +1,121 @@
+"""
+Admission control for bot commands
+
+Per-user token buckets stop a single user from flooding the bot, and a global
+concurrency cap bounds the number of storage operations (and so database
+connections) in flight. Work that cannot get a slot quickly is rejected
+instead of queueing without limit, which keeps latency bounded for everyone
+else.
+"""
+
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Any
+
+logger = logging.getLogger('vault.admission')
+
+BUCKET_PRUNE_SIZE = 10000
+
+
+class Overloaded(Exception):
+    """Raised when a storage operation cannot be admitted"""
+
+
+class TokenBucket:
+    __slots__ = ('capacity', 'refill_per_second', 'tokens', 'updated')
+
+    def __init__(self, capacity: float, refill_per_second: float, now: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def try_acquire(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self, now: float) -> float:
+        """Seconds until one token is available"""
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.refill_per_second)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    def __init__(self, rate_per_minute: float, burst: int, max_concurrent: int,
+                 max_queue: int, queue_timeout: float, clock: Callable[[], float] = time.monotonic):
+        self.refill_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self._buckets: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats: Dict[str, int] = {'admitted': 0, 'rate_limited': 0, 'overloaded': 0}
+
+    def admit_user(self, user_id: str) -> bool:
+        """Take one token from the user's bucket"""
+        now = self.clock()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, self.refill_per_second, now)
+            self._buckets[user_id] = bucket
+            if len(self._buckets) > BUCKET_PRUNE_SIZE:
+                self._prune(now)
+        self._buckets.move_to_end(user_id)
+        if bucket.try_acquire(now):
+            self.stats['admitted'] += 1
+            return True
+        self.stats['rate_limited'] += 1
+        return False
+
+    def retry_after(self, user_id: str) -> float:
+        bucket = self._buckets.get(user_id)
+        return bucket.retry_after(self.clock()) if bucket else 0.0
+
+    def _prune(self, now: float):
+        # A full bucket behaves exactly like a new one, so it can be dropped
+        for user_id in list(self._buckets):
+            if len(self._buckets) <= BUCKET_PRUNE_SIZE // 2:
+                break
+            if self._buckets[user_id].is_full(now):
+                del self._buckets[user_id]
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """Run a blocking storage call in a worker thread under the global cap
+
+        Raises Overloaded immediately when the wait queue is full, or after
+        queue_timeout if no slot frees up.
+        """
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.stats['overloaded'] += 1
+            raise Overloaded()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats['overloaded'] += 1
+            raise Overloaded() from None
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.to_thread(func, *args)
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
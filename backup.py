@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Incremental snapshot/backup tool for the PostgreSQL backend
+
+A backup directory holds one full (base) snapshot followed by incremental
+snapshots. Each incremental contains only the rows whose updated_at is past
+the previous snapshot's watermark, plus tombstones for rows deleted since
+then, so a nightly run costs time proportional to the day's changes.
+
+Layout:
+    <dir>/manifest.json
+    <dir>/<snapshot id>/rows-0001.ndjson.gz
+    <dir>/<snapshot id>/tombstones-0001.ndjson.gz
+
+Restore replays the base and then every incremental in order inside a single
+transaction.
+"""
+
+import os
+import gzip
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Iterator, Iterable
+import psycopg2.extras
+from database import DatabaseManager, CHANGE_CHANNEL
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('backup')
+
+MANIFEST_FILE = 'manifest.json'
+CHUNK_ROWS = 50000
+FETCH_SIZE = 2000
+RESTORE_PAGE_SIZE = 1000
+TOMBSTONE_PRUNE_BATCH = 5000
+# updated_at/deleted_at are the writing transaction's start time, so a
+# transaction that commits after our snapshot can carry an older timestamp.
+# Each incremental re-reads this much before the previous watermark; replaying
+# the overlap is idempotent.
+WATERMARK_OVERLAP = timedelta(minutes=10)
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# expires_at is kept as epoch seconds (rows from older backups have none)
+ROW_COLUMNS = "user_id::text, key, value, updated_at, EXTRACT(EPOCH FROM expires_at)::float8"
+
+
+def load_manifest(backup_dir: str) -> Dict[str, Any]:
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'snapshots': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(backup_dir: str, manifest: Dict[str, Any]):
+    # Write then rename, so a crash never leaves a half-written manifest
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_chunks(directory: str, prefix: str, records: Iterable[Dict[str, Any]], chunk_rows: int = CHUNK_ROWS) -> List[Dict[str, Any]]:
+    """Write records as gzip-compressed NDJSON files of at most chunk_rows lines"""
+    files = []
+    out = None
+    count = 0
+    try:
+        for record in records:
+            if out is None or count == chunk_rows:
+                if out is not None:
+                    out.close()
+                    files[-1]['rows'] = count
+                name = f"{prefix}-{len(files) + 1:04d}.ndjson.gz"
+                out = gzip.open(os.path.join(directory, name), 'wt', encoding='utf-8')
+                files.append({'name': name, 'rows': 0})
+                count = 0
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if out is not None:
+            out.close()
+            files[-1]['rows'] = count
+    return files
+
+
+def read_chunks(directory: str, files: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    for entry in files:
+        with gzip.open(os.path.join(directory, entry['name']), 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def take_snapshot(db: DatabaseManager, backup_dir: str, full: bool = False, prune_tombstones: bool = True) -> Dict[str, Any]:
+    """Take a full snapshot (or an incremental one if a base already exists)"""
+    os.makedirs(backup_dir, exist_ok=True)
+    manifest = load_manifest(backup_dir)
+    if not manifest['snapshots']:
+        full = True
+
+    since = None
+    if not full:
+        last_watermark = datetime.strptime(manifest['snapshots'][-1]['watermark'], TIMESTAMP_FORMAT)
+        since = last_watermark - WATERMARK_OVERLAP
+
+    with db.get_connection() as conn:
+        # One consistent view for rows and tombstones
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT CURRENT_TIMESTAMP::timestamp")
+            watermark = cursor.fetchone()[0]
+
+        snapshot_id = f"{watermark.strftime('%Y%m%dT%H%M%S')}-{'full' if full else 'incr'}"
+        snapshot_dir = os.path.join(backup_dir, snapshot_id)
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+        row_files = write_chunks(snapshot_dir, 'rows', _stream_rows(conn, since))
+        tombstone_files = write_chunks(snapshot_dir, 'tombstones', _stream_tombstones(conn, since)) if since else []
+        conn.commit()
+
+    snapshot = {
+        'id': snapshot_id,
+        'kind': 'full' if full else 'incremental',
+        'since': since.strftime(TIMESTAMP_FORMAT) if since else None,
+        'watermark': watermark.strftime(TIMESTAMP_FORMAT),
+        'rows': sum(entry['rows'] for entry in row_files),
+        'tombstones': sum(entry['rows'] for entry in tombstone_files),
+        'row_files': row_files,
+        'tombstone_files': tombstone_files,
+    }
+    # A new base starts a new chain; older snapshots stay on disk until removed
+    manifest['snapshots'] = [snapshot] if full else manifest['snapshots'] + [snapshot]
+    save_manifest(backup_dir, manifest)
+    logger.info(f"Snapshot {snapshot_id}: {snapshot['rows']} rows, {snapshot['tombstones']} tombstones")
+
+    if full and prune_tombstones:
+        prune_tombstones_before(db, watermark - WATERMARK_OVERLAP)
+    return snapshot
+
+
+def _stream_rows(conn, since: Optional[datetime]) -> Iterator[Dict[str, Any]]:
+    with conn.cursor(name='backup_rows') as cursor:
+        cursor.itersize = FETCH_SIZE
+        if since is None:
+            cursor.execute(f"SELECT {ROW_COLUMNS} FROM user_data")
+        else:
+            cursor.execute(f"SELECT {ROW_COLUMNS} FROM user_data WHERE updated_at >= %s", (since,))
+        for user_id, key, value, updated_at, expires_at in cursor:
+            yield {'user_id': user_id, 'key': key, 'value': value,
+                   'updated_at': updated_at.strftime(TIMESTAMP_FORMAT) if updated_at else None,
+                   'expires_at': expires_at}
+
+
+def _stream_tombstones(conn, since: datetime) -> Iterator[Dict[str, Any]]:
+    with conn.cursor(name='backup_tombstones') as cursor:
+        cursor.itersize = FETCH_SIZE
+        cursor.execute("""
+            SELECT user_id::text, key, MAX(deleted_at) FROM user_data_tombstones
+            WHERE deleted_at >= %s GROUP BY user_id, key
+        """, (since,))
+        for user_id, key, deleted_at in cursor:
+            yield {'user_id': user_id, 'key': key, 'deleted_at': deleted_at.strftime(TIMESTAMP_FORMAT)}
+
+
+def prune_tombstones_before(db: DatabaseManager, cutoff: datetime):
+    """Delete tombstones already covered by a full snapshot, in small batches"""
+    total = 0
+    while True:
+        with db.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM user_data_tombstones WHERE ctid IN (
+                        SELECT ctid FROM user_data_tombstones WHERE deleted_at < %s LIMIT %s
+                    )
+                """, (cutoff, TOMBSTONE_PRUNE_BATCH))
+                deleted = cursor.rowcount
+                conn.commit()
+        total += deleted
+        if deleted < TOMBSTONE_PRUNE_BATCH:
+            break
+    if total:
+        logger.info(f"Pruned {total} tombstones older than {cutoff}")
+
+
+def restore(db: DatabaseManager, backup_dir: str, until: Optional[str] = None, truncate: bool = True):
+    """Replay the base snapshot and incrementals (up to and including `until`)"""
+    manifest = load_manifest(backup_dir)
+    snapshots = manifest['snapshots']
+    if not snapshots:
+        raise ValueError(f"No snapshots in {backup_dir}")
+    if until is not None:
+        ids = [snapshot['id'] for snapshot in snapshots]
+        if until not in ids:
+            raise ValueError(f"Snapshot {until} not found")
+        snapshots = snapshots[:ids.index(until) + 1]
+
+    with db.get_connection() as conn:
+        with conn.cursor() as cursor:
+            if truncate:
+                # user_stats is rebuilt by the insert trigger as rows are restored
+                cursor.execute("TRUNCATE user_data, user_stats")
+            user_id_type = _user_id_type(cursor)
+            for snapshot in snapshots:
+                snapshot_dir = os.path.join(backup_dir, snapshot['id'])
+                deleted = _apply_tombstones(cursor, read_chunks(snapshot_dir, snapshot['tombstone_files']), user_id_type)
+                upserted = _apply_rows(cursor, read_chunks(snapshot_dir, snapshot['row_files']))
+                logger.info(f"Replayed {snapshot['id']}: {upserted} rows, {deleted} deletes")
+            # Tell running bots to drop their caches
+            cursor.execute("SELECT pg_notify(%s, %s)", (CHANGE_CHANNEL, json.dumps({'user_id': None})))
+            conn.commit()
+    logger.info(f"Restore complete ({len(snapshots)} snapshot(s))")
+
+
+def _pages(records: Iterable[Dict[str, Any]], size: int = RESTORE_PAGE_SIZE) -> Iterator[List[Dict[str, Any]]]:
+    page = []
+    for record in records:
+        page.append(record)
+        if len(page) == size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _user_id_type(cursor) -> str:
+    """'bigint', or 'character varying' on installs not yet converted by migrate_schema.py"""
+    cursor.execute("""
+        SELECT atttypid::regtype::text FROM pg_attribute
+        WHERE attrelid = 'user_data'::regclass AND attname = 'user_id'
+    """)
+    return cursor.fetchone()[0]
+
+
+def _apply_tombstones(cursor, tombstones: Iterable[Dict[str, Any]], user_id_type: str = 'bigint') -> int:
+    # IDs are cast to the column's own type, so the (user_id, key) index is used
+    total = 0
+    for page in _pages(tombstones):
+        psycopg2.extras.execute_values(cursor, """
+            DELETE FROM user_data d USING (VALUES %s) AS t(user_id, key)
+            WHERE d.user_id = t.user_id AND d.key = t.key
+        """, [(t['user_id'], t['key']) for t in page],
+            template=f"(%s::{'bigint' if user_id_type == 'bigint' else 'varchar'}, %s)")
+        total += cursor.rowcount
+    return total
+
+
+def _apply_rows(cursor, rows: Iterable[Dict[str, Any]]) -> int:
+    total = 0
+    for page in _pages(rows):
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO user_data (user_id, key, value, updated_at, expires_at)
+            VALUES %s
+            ON CONFLICT (user_id, key)
+            DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at, expires_at = EXCLUDED.expires_at
+        """, [(r['user_id'], r['key'], r['value'], r['updated_at'], r.get('expires_at')) for r in page],
+            template="(%s::bigint, %s, %s, %s::timestamp, to_timestamp(%s))")
+        total += len(page)
+    return total
+
+
+def list_snapshots(backup_dir: str):
+    for snapshot in load_manifest(backup_dir)['snapshots']:
+        print(f"{snapshot['id']:<24} {snapshot['kind']:<12} rows={snapshot['rows']:<8} "
+              f"tombstones={snapshot['tombstones']:<8} watermark={snapshot['watermark']}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Full and incremental backups of the Discord Vault database')
+    parser.add_argument('--dir', default='backups', help='Backup directory (default: backups)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    snapshot_parser = subparsers.add_parser('snapshot', help='Take an incremental snapshot (full if no base exists)')
+    snapshot_parser.add_argument('--full', action='store_true', help='Start a new chain with a full snapshot')
+    snapshot_parser.add_argument('--keep-tombstones', action='store_true',
+                                 help='Do not prune tombstones covered by a new full snapshot '
+                                      '(needed if other backup directories take incrementals)')
+
+    restore_parser = subparsers.add_parser('restore', help='Replay base + incrementals into the database')
+    restore_parser.add_argument('--until', default=None, help='Last snapshot id to replay (default: all)')
+    restore_parser.add_argument('--no-truncate', action='store_true',
+                                help='Merge into existing data instead of replacing it')
+
+    subparsers.add_parser('list', help='List snapshots in the backup directory')
+
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        list_snapshots(args.dir)
+    else:
+        db = DatabaseManager()
+        if not db.test_connection():
+            logger.error("Cannot connect to database")
+            exit(1)
+        if args.command == 'snapshot':
+            take_snapshot(db, args.dir, full=args.full, prune_tombstones=not args.keep_tombstones)
+        else:
+            restore(db, args.dir, until=args.until, truncate=not args.no_truncate)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Resident memory benchmark for the JSON backend's in-process representation
+
+Builds the same synthetic data set as a plain Dict[str, Dict[str, str]] and as
+a CompactStore, each in a fresh subprocess, saves it once the way the bot does
+(json.dump / write_json), and reports the RSS growth after the build and after
+the save. The bot saves on every write, so the after-save figure is the steady
+state.
+
+    python bench_memory.py --users 100000 --items 3
+"""
+
+import os
+import sys
+import gc
+import json
+import random
+import subprocess
+from typing import Dict, Iterator, Tuple
+
+# Data names people actually use repeat across users
+COMMON_NAMES = ['password', 'email', 'memo', 'todo', 'address', 'phone', 'birthday', 'api_key',
+                'wifi', 'pin', 'note', 'url', 'token', 'username', 'server', 'link']
+
+
+def synthetic_rows(users: int, items: int, seed: int = 42) -> Iterator[Tuple[str, str, str]]:
+    """(user_id, key, value) rows with snowflake-sized IDs and 20-80 character values"""
+    rng = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    for _ in range(users):
+        user_id = str(rng.randrange(10 ** 17, 10 ** 19))
+        for key in rng.sample(COMMON_NAMES, items):
+            yield user_id, key, ''.join(rng.choices(alphabet, k=rng.randint(20, 80)))
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        # Peak rather than current RSS; still fine for a build-only process
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def measure(kind: str, users: int, items: int) -> Dict[str, int]:
+    """RSS growth from building the representation (including the strings it keeps) and after saving it"""
+    gc.collect()
+    before = current_rss_bytes()
+    if kind == 'dict':
+        data: Dict[str, Dict[str, str]] = {}
+        for user_id, key, value in synthetic_rows(users, items):
+            # json.load shares repeated object keys the same way
+            data.setdefault(user_id, {})[sys.intern(key)] = value
+    else:
+        from compact_store import CompactStore
+        data = CompactStore()
+        for user_id, key, value in synthetic_rows(users, items):
+            data.set_value(user_id, key, value)
+    gc.collect()
+    built = current_rss_bytes()
+    with open(os.devnull, 'w', encoding='utf-8') as f:
+        if kind == 'dict':
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        else:
+            data.write_json(f)
+    gc.collect()
+    saved = current_rss_bytes()
+    return {'kind': kind, 'users': len(data), 'build_growth': built - before, 'rss_growth': saved - before}
+
+
+def run_in_subprocess(kind: str, users: int, items: int) -> Dict[str, int]:
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--worker', kind, '--users', str(users), '--items', str(items)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return json.loads(output)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare resident memory of the JSON backend representations')
+    parser.add_argument('--users', type=int, default=100000, help='Number of users (default: 100000)')
+    parser.add_argument('--items', type=int, default=3, help=f'Entries per user (default: 3, max: {len(COMMON_NAMES)})')
+    parser.add_argument('--worker', choices=['dict', 'compact'], help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(args.worker, args.users, args.items)))
+        sys.exit(0)
+
+    results = {kind: run_in_subprocess(kind, args.users, args.items) for kind in ('dict', 'compact')}
+    baseline = results['dict']['rss_growth']
+    print(f"{args.users} users x {args.items} entries")
+    for kind, result in results.items():
+        growth = result['rss_growth']
+        print(f"  {kind:<8} {growth / 2 ** 20:8.1f} MiB  ({growth / max(result['users'], 1):.0f} bytes/user) after a save, "
+              f"{result['build_growth'] / 2 ** 20:.1f} MiB before")
+    saved = baseline - results['compact']['rss_growth']
+    print(f"  saved    {saved / 2 ** 20:8.1f} MiB  ({saved / max(baseline, 1):.0%})")
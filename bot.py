@@ -1,12 +1,24 @@
 import os
+import io
 import json
 import re
+import time
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple, List, Iterator, Iterable, Callable
 import discord
+from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
-from database import DatabaseManager
+from compact_store import CompactStore
+from admission import AdmissionController, Overloaded
+from interactions import ResponseStats, respond_with_deferral
+from expiry import ExpiryScheduler
+from startup import StartupTimeline
+from profiling import capture_profile, memory_diff, measure_loop_lag, describe_lag, task_counts
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -19,31 +31,171 @@ DATA_FILE = 'user_data.json'
 MAX_NAME_LENGTH = 50
 MAX_VALUE_LENGTH = 1900  # Discord表示制限を考慮
 MAX_ITEMS_PER_USER = 100  # より多くのデータを保存可能
-NAME_PATTERN = re.compile(r'^[a-zA-Z0-9_\-]+$')
+MAX_IMPORT_BYTES = 1024 * 1024  # インポートファイルの上限サイズ
+EXPORT_FILENAME = 'vault-export.ndjson'
+# "/" で区切って階層化できる（例: work/github/token）。空の階層や先頭・末尾の "/" は不可
+NAME_PATTERN = re.compile(r'^[a-zA-Z0-9_\-]+(/[a-zA-Z0-9_\-]+)*$')
+# /list・/delete の prefix: はデータ名の先頭部分（"work/" のように "/" で終わってもよい）
+PREFIX_PATTERN = re.compile(r'^[a-zA-Z0-9_\-]+(/[a-zA-Z0-9_\-]+)*/?$')
+NAMES_SEPARATOR = re.compile(r'[\s,]+')  # /get・/delete で複数の名前を区切る
+MAX_NAMES_PER_COMMAND = 20
+# /save の ttl:（例: 30s, 10m, 2h, 7d）。単位ごとの秒数と表示名
+TTL_PATTERN = re.compile(r'^(\d+)([smhd])$')
+TTL_UNITS = {'s': (1, '秒'), 'm': (60, '分'), 'h': (3600, '時間'), 'd': (86400, '日')}
+MAX_TTL_SECONDS = 365 * 86400
+# 上書きされた値をデータごとに何件まで残すか（/history・/restore）
+HISTORY_MAX_VERSIONS = int(os.getenv('HISTORY_MAX_VERSIONS', '5'))
+HISTORY_PRUNE_SECONDS = 60.0  # DB利用時、保持数を超えた古い版を削除する間隔
+CACHE_MAX_USERS = int(os.getenv('CACHE_MAX_USERS', '1000'))  # DB利用時のユーザー単位キャッシュ上限
+# DB障害中に受け付けた書き込みの退避先（復旧後に順番どおり反映する）
+WRITE_BEHIND_FILE = os.getenv('WRITE_BEHIND_FILE', 'pending_writes.ndjson')
+# 起動時にキャッシュへ先読みする、最近書き込みのあったユーザー数
+CACHE_PRELOAD_USERS = min(int(os.getenv('CACHE_PRELOAD_USERS', '200')), CACHE_MAX_USERS)
+# 変更フィードの接続を待つ上限（先読みはフィード開始後でないとキャッシュできない）
+CHANGE_FEED_WAIT_SECONDS = 5.0
+
+# シャード設定（launcher.py が各ワーカープロセスに設定する。未設定なら自動シャーディング）
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = [int(i) for i in os.getenv('SHARD_IDS', '').split(',') if i.strip()] or None
+
+# 流量制御（ユーザーごとのトークンバケットとストレージ処理の同時実行上限）
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '30'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '10'))
+STORAGE_MAX_CONCURRENCY = int(os.getenv('STORAGE_MAX_CONCURRENCY', '8'))
+STORAGE_MAX_QUEUE = int(os.getenv('STORAGE_MAX_QUEUE', '32'))
+STORAGE_QUEUE_TIMEOUT = float(os.getenv('STORAGE_QUEUE_TIMEOUT', '2.0'))
+# 応答期限（3秒）に間に合わせるため、この秒数で処理が終わらなければ defer する
+INTERACTION_DEFER_BUDGET = float(os.getenv('INTERACTION_DEFER_BUDGET', '2.0'))
+
+# /debug はBotのオーナー（未指定ならアプリケーションのオーナー/チーム）だけが使える
+OWNER_IDS = {int(i) for i in os.getenv('BOT_OWNER_IDS', '').split(',') if i.strip()} or None
+DEBUG_PROFILE_MAX_SECONDS = 60
+DEBUG_MEMORY_MAX_SECONDS = 300
+DEBUG_LOOP_MAX_SECONDS = 60
+
+
+class SingleFlight:
+    """同じキーの同時呼び出しを1回の実行にまとめ、結果を待っている全員で共有する"""
+
+    class _Call:
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, 'SingleFlight._Call'] = {}
+
+    def do(self, key: Any, func: Callable[..., Any], *args) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                # forget() 後に始まった新しい呼び出しは消さない
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def forget(self, predicate: Callable[[Any], bool]):
+        """条件に合う実行中の呼び出しに、以降の呼び出しを合流させない"""
+        with self._lock:
+            for key in [key for key in self._calls if predicate(key)]:
+                del self._calls[key]
 
 
 class UserDataManager:
-    def __init__(self, filepath: str = DATA_FILE):
+    def __init__(self, filepath: str = DATA_FILE, lazy: bool = False):
+        """lazy=True のときは接続やファイル読み込みをせず、呼び出し側が warm_up() を実行する"""
         self.filepath = filepath
         self.use_database = self._should_use_database()
+        # ストレージ処理はワーカースレッドで動くため、JSONバックエンドの読み書きを直列化する
+        self._lock = threading.RLock()
+        
+        # DB利用時のキャッシュ。変更フィード(LISTEN/NOTIFY)が生きている間だけ使う。
+        # 値は(格納時の世代, データ, 最も早い有効期限)。世代が古いものもDB障害中の読み取りには使うが、
+        # 有効期限を過ぎたデータを含むものは使わない
+        self._cache: 'OrderedDict[str, Tuple[int, Dict[str, str], Optional[float]]]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_epoch = 0
+        self._user_epochs: Dict[str, int] = {}
+        # 同じユーザーへの同時読み取りは1回のDB呼び出しにまとめる
+        self._flights = SingleFlight()
         
+        if not lazy:
+            self.warm_up()
+    
+    def warm_up(self, timeline: Optional[StartupTimeline] = None, preload_users: int = 0):
+        """ストレージを使える状態にする（DB接続・スキーマ確認・キャッシュ先読み、またはJSON読み込み）
+        
+        DBのモジュール（psycopg2）はDBを使うときだけ読み込む。
+        """
+        timeline = timeline or StartupTimeline()
         if self.use_database:
             try:
+                with timeline.phase('db_import'):
+                    from database import DatabaseManager
                 self.db = DatabaseManager()
-                # Test connection and initialize schema if needed
-                if self.db.test_connection():
-                    self.db.initialize_schema()
+                with timeline.phase('db_pool'):
+                    connected = self.db.open_pool() and self.db.test_connection()
+                if connected:
+                    # 変更フィードはスキーマ確認と並行して接続させる
+                    self.db.start_change_listener(self._on_data_changed)
+                    with timeline.phase('schema_check'):
+                        self.db.ensure_schema()
+                    with timeline.phase('write_behind'):
+                        self.db.enable_write_behind(WRITE_BEHIND_FILE)
+                    if preload_users:
+                        with timeline.phase('cache_preload'):
+                            self.preload_cache(preload_users)
                     logger.info("Using PostgreSQL database for data storage")
                 else:
                     logger.warning("Database connection failed, falling back to JSON file")
+                    self.db.close_pool()
                     self.use_database = False
-                    self.data = self.load_data()
             except Exception as e:
                 logger.warning(f"Database initialization failed: {e}, falling back to JSON file")
+                # 途中で始めた変更フィードの受信スレッドと接続プールを残さない
+                db = getattr(self, 'db', None)
+                if db is not None:
+                    db.stop_change_listener()
+                    db.close_pool()
                 self.use_database = False
-                self.data = self.load_data()
-        else:
-            self.data = self.load_data()
+        
+        if not self.use_database:
+            with timeline.phase('json_load'):
+                # 常駐メモリを抑えた形で保持する（件数・合計バイト数も O(1) で取れる）
+                self.data = CompactStore.from_dict(self.load_data(), HISTORY_MAX_VERSIONS)
+
+    def preload_cache(self, limit: int) -> int:
+        """最近書き込みのあったユーザーのデータをキャッシュに読み込む（読み込んだ人数を返す）"""
+        if not self.db.change_feed_ready.wait(CHANGE_FEED_WAIT_SECONDS):
+            logger.warning("変更フィードが開始されないため、キャッシュの先読みを省略します")
+            return 0
+        # 読み込み中に届いた無効化を取りこぼさないよう、世代は読み込み前に控える
+        with self._cache_lock:
+            epoch, user_epochs = self._cache_epoch, dict(self._user_epochs)
+        recent = self.db.load_recent_users(limit)
+        for user_id, data in recent.items():
+            self._cache_put(user_id, data, (epoch, user_epochs.get(user_id, 0)))
+        logger.info(f"キャッシュ先読み: {len(recent)}ユーザー")
+        return len(recent)
     
     def _should_use_database(self) -> bool:
         """Check if we should use database based on environment variables"""
@@ -64,65 +216,417 @@ class UserDataManager:
         try:
             os.makedirs(os.path.dirname(self.filepath) if os.path.dirname(self.filepath) else '.', exist_ok=True)
             with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+                self.data.write_json(f)
             return True
         except Exception as e:
             print(f"データ保存エラー: {e}")
             return False
 
-    def set_user_data(self, user_id: str, key: str, value: str) -> bool:
+    def _on_data_changed(self, user_id: Optional[str], key: Optional[str]):
+        """変更フィードからの通知でキャッシュを無効化する（user_id=Noneは全件）"""
+        # レプリカが追いつくまで、変更のあったユーザーの読み取りはプライマリへ
+        self.db.note_write(user_id)
+        # 変更前に始まった読み取りに、これからの読み取りを合流させない
+        self._flights.forget(lambda flight: user_id is None or flight[1] == user_id)
+        with self._cache_lock:
+            if user_id is None or len(self._user_epochs) >= CACHE_MAX_USERS * 10:
+                # 全体の世代を進める（世代表が膨らみすぎたときも同様にリセット）。
+                # 古い世代のエントリはDB障害時の予備として残す
+                self._cache_epoch += 1
+                self._user_epochs.clear()
+            else:
+                self._user_epochs[user_id] = self._user_epochs.get(user_id, 0) + 1
+                self._cache.pop(user_id, None)
+
+    def _cache_token(self, user_id: str) -> Tuple[int, int]:
+        with self._cache_lock:
+            return self._cache_epoch, self._user_epochs.get(user_id, 0)
+
+    def _cache_get(self, user_id: str) -> Optional[Dict[str, str]]:
+        with self._cache_lock:
+            entry = self._cache.get(user_id)
+            if entry is None:
+                return None
+            epoch, cached, next_expiry = entry
+            if next_expiry is not None and next_expiry <= time.time():
+                del self._cache[user_id]
+                return None
+            fresh = self.db.change_feed_active and epoch == self._cache_epoch
+            # DB障害中は古いかもしれない値でも返す（何も返せないよりよい）
+            if not fresh and not self.db.degraded:
+                return None
+            self._cache.move_to_end(user_id)
+            return cached
+
+    def _cache_put(self, user_id: str, data: Dict[str, str], token: Tuple[int, int]):
+        # 読み取り中に無効化が届いていたら古い値になるので保存しない
+        with self._cache_lock:
+            if not self.db.change_feed_active or token != (self._cache_epoch, self._user_epochs.get(user_id, 0)):
+                return
+            # DBから読んだデータは、含まれるデータの最も早い有効期限を持っている
+            self._cache[user_id] = (self._cache_epoch, data, getattr(data, 'next_expiry', None))
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > CACHE_MAX_USERS:
+                self._cache.popitem(last=False)
+
+    def _load_user_from_db(self, user_id: str) -> Optional[Dict[str, str]]:
+        cached = self._cache_get(user_id)
+        if cached is not None:
+            return cached
+        token = self._cache_token(user_id)
+        data = self._flights.do(('all', user_id), self.db.get_user_data, user_id)
+        # 取得失敗とデータなしは区別できないため、Noneはキャッシュしない
+        if data is not None:
+            self._cache_put(user_id, data, token)
+        return data
+
+    def _record_local_write(self, user_id: str, key: str, value: Optional[str], result: bool,
+                            expires_at: Optional[float] = None):
+        """書き込み後のキャッシュ処理。DB障害中はキャッシュ側にも反映して手元の写しを最新に保つ"""
+        if not (result and self.db.degraded):
+            self._on_data_changed(user_id, key)
+            return
+        self._flights.forget(lambda flight: flight[1] == user_id)
+        with self._cache_lock:
+            entry = self._cache.get(user_id)
+            if entry is None:
+                return
+            epoch, data, next_expiry = entry
+            data = dict(data)
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+            if expires_at is not None:
+                next_expiry = expires_at if next_expiry is None else min(next_expiry, expires_at)
+            self._cache[user_id] = (epoch, data, next_expiry)
+
+    def set_user_data(self, user_id: str, key: str, value: str, expires_at: Optional[float] = None) -> bool:
+        """データを保存する。expires_at（UNIX時刻）を指定すると、その時刻以降は存在しない扱いになる"""
         if self.use_database:
-            return self.db.set_user_data(user_id, key, value)
+            result = self.db.set_user_data(user_id, key, value, expires_at)
+            self._record_local_write(user_id, key, value, result, expires_at)
+            return result
         else:
-            if user_id not in self.data:
-                self.data[user_id] = {}
-            self.data[user_id][key] = value
-            return self.save_data()
+            with self._lock:
+                self.data.set_value(user_id, key, value, expires_at)
+                return self.save_data()
 
     def get_user_data(self, user_id: str, key: Optional[str] = None) -> Optional[Any]:
         if self.use_database:
-            return self.db.get_user_data(user_id, key)
-        else:
-            if user_id not in self.data:
-                return None
             if key is None:
-                return self.data[user_id]
-            return self.data[user_id].get(key)
+                data = self._load_user_from_db(user_id)
+                return dict(data) if data is not None else None
+            cached = self._cache_get(user_id)
+            if cached is not None:
+                return cached.get(key)
+            return self._flights.do(('key', user_id, key), self.db.get_user_data, user_id, key)
+        else:
+            with self._lock:
+                if key is None:
+                    return self.data.get(user_id)
+                return self.data.get_value(user_id, key)
 
     def delete_user_data(self, user_id: str, key: str) -> bool:
         if self.use_database:
-            return self.db.delete_user_data(user_id, key)
+            if self.db.degraded:
+                # 障害中のDB削除は存在確認ができないので、手元の写しで判断できるなら使う
+                cached = self._cache_get(user_id)
+                if cached is not None and key not in cached:
+                    return False
+            result = self.db.delete_user_data(user_id, key)
+            self._record_local_write(user_id, key, None, result)
+            return result
+        else:
+            with self._lock:
+                if not self.data.delete_value(user_id, key):
+                    return False
+                return self.save_data()
+
+    def get_user_data_many(self, user_id: str, keys: List[str]) -> Optional[Dict[str, str]]:
+        """複数のデータをまとめて取得する（見つかったものだけを指定順で返す。失敗時はNone）"""
+        if self.use_database:
+            cached = self._cache_get(user_id)
+            if cached is not None:
+                return {key: cached[key] for key in keys if key in cached}
+            return self._flights.do(('many', user_id, tuple(keys)), self.db.get_user_data_many, user_id, keys)
+        else:
+            with self._lock:
+                values = {key: self.data.get_value(user_id, key) for key in keys}
+            return {key: value for key, value in values.items() if value is not None}
+
+    def delete_user_data_many(self, user_id: str, keys: List[str]) -> Optional[List[str]]:
+        """複数のデータをまとめて削除する（削除した名前を返す。失敗時はNone）"""
+        if self.use_database:
+            if self.db.degraded:
+                cached = self._cache_get(user_id)
+                if cached is not None:
+                    keys = [key for key in keys if key in cached]
+                    if not keys:
+                        return []
+            deleted = self.db.delete_user_data_many(user_id, keys)
+            for key in keys:
+                self._record_local_write(user_id, key, None, deleted is not None)
+            return deleted
+        else:
+            with self._lock:
+                deleted = [key for key in keys if self.data.delete_value(user_id, key)]
+                # 何件消しても保存は1回
+                if deleted and not self.save_data():
+                    return None
+                return deleted
+
+    def delete_user_data_prefix(self, user_id: str, prefix: str) -> Optional[List[str]]:
+        """名前が prefix で始まるデータをまとめて削除する（削除した名前を返す。失敗時はNone）"""
+        if self.use_database:
+            if self.db.degraded:
+                cached = self._cache_get(user_id)
+                if cached is not None:
+                    # DB障害中は手元の写しで対象を決め、個別の削除としてキューに積む
+                    keys = sorted(key for key in cached if key.startswith(prefix))
+                    return self.delete_user_data_many(user_id, keys) if keys else []
+            deleted = self.db.delete_user_data_prefix(user_id, prefix)
+            if deleted is None:
+                self._on_data_changed(user_id, None)
+                return None
+            for key in deleted:
+                self._record_local_write(user_id, key, None, True)
+            return deleted
+        else:
+            with self._lock:
+                deleted = self.data.delete_prefix(user_id, prefix)
+                if deleted and not self.save_data():
+                    return None
+                return deleted
+
+    def sweep_expired(self, limit: int) -> Optional[int]:
+        """有効期限切れのデータを期限の早い順に最大 limit 件削除する（件数を返す。失敗時はNone）"""
+        if self.use_database:
+            swept = self.db.sweep_expired(limit)
+            if swept is None:
+                return None
+            # 変更フィードでも届くが、フィードが止まっていても古い写しを残さない
+            for user_id, key in swept:
+                self._on_data_changed(user_id, key)
+            return len(swept)
         else:
-            if user_id not in self.data or key not in self.data[user_id]:
-                return False
-            del self.data[user_id][key]
-            if not self.data[user_id]:
-                del self.data[user_id]
-            return self.save_data()
+            with self._lock:
+                swept = self.data.sweep_expired(time.time(), limit)
+                if swept and not self.save_data():
+                    return None
+                return len(swept)
+
+    def upcoming_expiries(self, until: float, limit: int) -> List[float]:
+        """until までに来る有効期限を早い順に返す（DBは部分インデックス、JSONは期限付きデータだけを見る）"""
+        if self.use_database:
+            return self.db.upcoming_expiries(until, limit)
+        else:
+            with self._lock:
+                return self.data.upcoming_expiries(until, limit)
+
+    def get_user_history(self, user_id: str, key: str) -> Optional[List[Tuple[float, str]]]:
+        """上書き前の値を(上書きされた時刻, 値)で新しい順に返す（失敗時はNone）"""
+        if self.use_database:
+            return self.db.get_user_history(user_id, key, HISTORY_MAX_VERSIONS)
+        else:
+            with self._lock:
+                return self.data.history(user_id, key)
+
+    def prune_history(self) -> Optional[int]:
+        """保持数を超えた古い版を削除する（JSONはデータごとのリングバッファなので何もしない）"""
+        if self.use_database:
+            return self.db.prune_history(HISTORY_MAX_VERSIONS)
+        return 0
+
+    def export_user_data(self, user_id: str) -> Iterator[Tuple[str, str, Optional[float]]]:
+        """ユーザーの全データを(名前, 値, 有効期限)で順に返す（DBはサーバーサイドカーソルで逐次取得）"""
+        if self.use_database:
+            yield from self.db.iter_user_data(user_id)
+        else:
+            with self._lock:
+                items = [(key, value, self.data.expires_at(user_id, key))
+                         for key, value in sorted(self.data.get(user_id, {}).items())]
+            yield from items
+
+    def import_user_data(self, user_id: str, items: Dict[str, str],
+                         expiries: Optional[Dict[str, float]] = None) -> Optional[int]:
+        """複数データを一括保存する（expiries は名前ごとの有効期限）。上限超過・失敗時はNoneで、何も保存しない"""
+        expiries = expiries or {}
+        if self.use_database:
+            result = self.db.import_user_data(user_id, items, MAX_ITEMS_PER_USER, expiries)
+            self._on_data_changed(user_id, None)
+            return result
+        else:
+            with self._lock:
+                existing = set(self.data.user_keys(user_id))
+                new_count = sum(1 for key in items if key not in existing)
+                if len(existing) + new_count > MAX_ITEMS_PER_USER:
+                    return None
+                for key, value in items.items():
+                    self.data.set_value(user_id, key, value, expiries.get(key))
+                return len(items) if self.save_data() else None
+
+    def list_user_keys(self, user_id: str, prefix: Optional[str] = None) -> List[str]:
+        """データ名を名前順で返す（prefix 指定時はその文字列で始まるものだけ）"""
+        if self.use_database:
+            cached = self._cache_get(user_id)
+            if cached is not None:
+                return sorted(key for key in cached if prefix is None or key.startswith(prefix))
+            return list(self._flights.do(('keys', user_id, prefix), self.db.list_user_keys, user_id, prefix))
+        else:
+            with self._lock:
+                return self.data.user_keys(user_id, prefix)
 
     def get_user_data_count(self, user_id: str) -> int:
         if self.use_database:
-            return self.db.get_user_data_count(user_id)
+            cached = self._cache_get(user_id)
+            if cached is not None:
+                return len(cached)
+            return self._flights.do(('count', user_id), self.db.get_user_data_count, user_id)
+        else:
+            with self._lock:
+                return self.data.user_count(user_id)
+
+    def get_user_data_bytes(self, user_id: str) -> int:
+        """保存値の合計バイト数（UTF-8）"""
+        if self.use_database:
+            cached = self._cache_get(user_id)
+            if cached is not None:
+                return sum(len(value.encode('utf-8')) for value in cached.values())
+            return self._flights.do(('bytes', user_id), self.db.get_user_data_bytes, user_id)
+        else:
+            with self._lock:
+                return self.data.user_bytes(user_id)
+
+
+class VaultCommandTree(app_commands.CommandTree):
+    """コマンド実行前の流量制御と、過負荷時の即時エラー応答"""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        admission = self.client.admission
+        user_id = str(interaction.user.id)
+        if admission.admit_user(user_id):
+            return True
+        retry_after = admission.retry_after(user_id)
+        await interaction.response.send_message(
+            f"⏳ **操作が多すぎます**\n\n{retry_after:.0f}秒ほど待ってからもう一度お試しください。",
+            ephemeral=True
+        )
+        return False
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        original = getattr(error, 'original', error)
+        if isinstance(original, Overloaded):
+            logger.warning("ストレージ処理が混雑しているためコマンドを拒否しました")
+            message = "⏳ **混雑しています**\n\nしばらくしてからもう一度お試しください。"
         else:
-            return len(self.data.get(user_id, {}))
+            logger.error(f"コマンドエラー: {type(original).__name__}: {original}")
+            message = "エラーが発生しました。もう一度お試しください。"
+        try:
+            if interaction.response.is_done():
+                # defer 済みならフォローアップで返す
+                await interaction.followup.send(message, ephemeral=True)
+            else:
+                await interaction.response.send_message(message, ephemeral=True)
+        except discord.HTTPException:
+            pass
 
 
-class VaultBot(commands.Bot):
+class VaultBot(commands.AutoShardedBot):
     def __init__(self):
         intents = discord.Intents.default()
-        super().__init__(command_prefix='!', intents=intents)
-        self.data_manager = UserDataManager()
+        super().__init__(
+            command_prefix='!',
+            intents=intents,
+            shard_count=SHARD_COUNT,
+            shard_ids=SHARD_IDS if SHARD_COUNT else None,
+            tree_cls=VaultCommandTree,
+            owner_ids=OWNER_IDS,
+        )
+        self.timeline = StartupTimeline()
+        self.timeline.mark('imports')
+        # ストレージの準備はログインと並行して setup_hook から始める
+        self.data_manager = UserDataManager(lazy=True)
+        self.storage_ready = asyncio.Event()
+        self._startup_tasks: List[asyncio.Task] = []
+        self._startup_reported = False
+        self.admission = AdmissionController(
+            rate_per_minute=RATE_LIMIT_PER_MINUTE,
+            burst=RATE_LIMIT_BURST,
+            max_concurrent=STORAGE_MAX_CONCURRENCY,
+            max_queue=STORAGE_MAX_QUEUE,
+            queue_timeout=STORAGE_QUEUE_TIMEOUT,
+        )
+        self.response_stats = ResponseStats()
+        # 期限付きデータの削除。ヒープで次の期限まで眠り、期限が来たらまとめて削除する
+        self.expiry = ExpiryScheduler(
+            lambda limit: self.storage(self.data_manager.sweep_expired, limit),
+            lambda until, limit: self.storage(self.data_manager.upcoming_expiries, until, limit),
+        )
+        self._expiry_task: Optional[asyncio.Task] = None
+        self._history_task: Optional[asyncio.Task] = None
+        # /debug の計測は同時に1つだけ
+        self.debug_lock = asyncio.Lock()
+
+    async def storage(self, func, *args):
+        """ストレージ処理をワーカースレッドで実行する（同時実行数の上限を超えると Overloaded）"""
+        if not self.storage_ready.is_set():
+            # 起動直後のコマンドはストレージの準備完了を待つ（長引けば応答は defer される）
+            await self.storage_ready.wait()
+        return await self.admission.run(func, *args)
 
     async def setup_hook(self):
+        self.timeline.mark('login')
+        # ストレージの準備とコマンド同期は待たずに Gateway 接続へ進む
+        self._startup_tasks.append(asyncio.create_task(self._warm_up_storage()))
+        # ストレージの準備ができるまでは storage() の中で待つ
+        self._expiry_task = asyncio.create_task(self.expiry.run())
+        self._history_task = asyncio.create_task(self._prune_history_loop())
+        # コマンド同期はアプリケーション単位なので、シャード0を持つプロセスだけが行う
+        if not SHARD_IDS or 0 in SHARD_IDS:
+            self._startup_tasks.append(asyncio.create_task(self._sync_commands()))
+
+    async def _warm_up_storage(self):
+        try:
+            await asyncio.to_thread(self.data_manager.warm_up, self.timeline, CACHE_PRELOAD_USERS)
+        finally:
+            self.storage_ready.set()
+            self.timeline.mark('storage_ready')
+            self._report_startup()
+
+    async def _prune_history_loop(self):
+        """履歴の古い版の削除は保存処理から切り離し、一定間隔でまとめて行う"""
+        await self.storage_ready.wait()
+        if not self.data_manager.use_database:
+            return
+        while True:
+            try:
+                await self.storage(self.data_manager.prune_history)
+            except Overloaded:
+                pass  # 混雑時は次の回に回す
+            await asyncio.sleep(HISTORY_PRUNE_SECONDS)
+
+    async def _sync_commands(self):
         try:
-            synced = await self.tree.sync()
+            with self.timeline.phase('command_sync'):
+                synced = await self.tree.sync()
             logger.info(f"コマンド同期完了: {len(synced)}件")
         except Exception as e:
             logger.error(f"同期エラー: {e}")
 
+    def _report_startup(self):
+        """Gateway接続とストレージ準備の両方が済んだら、起動時間の内訳を1回だけ記録する"""
+        if self._startup_reported or not {'gateway_ready', 'storage_ready'} <= self.timeline.marks.keys():
+            return
+        self._startup_reported = True
+        logger.info(f"起動時間の内訳: {self.timeline.summary()}")
+
     async def on_ready(self):
+        self.timeline.mark('gateway_ready')
+        self._report_startup()
         print(f'{self.user} としてログインしました (ID: {self.user.id})')
         print(f'サーバー数: {len(self.guilds)}')
+        print(f'シャード: {sorted(self.shards)} / {self.shard_count}')
         
         # アプリケーション情報を確認
         try:
@@ -143,115 +647,511 @@ def validate_name(name: str) -> Optional[str]:
     if len(name) > MAX_NAME_LENGTH:
         return f"データ名は{MAX_NAME_LENGTH}文字以内で入力してください。"
     if not NAME_PATTERN.match(name):
-        return "データ名は英数字、アンダースコア、ハイフンのみ使用できます。"
+        return "データ名は英数字、アンダースコア、ハイフンと、階層の区切りの「/」のみ使用できます。"
     return None
 
 
+def validate_prefix(prefix: str) -> Optional[str]:
+    if len(prefix) > MAX_NAME_LENGTH:
+        return f"プレフィックスは{MAX_NAME_LENGTH}文字以内で入力してください。"
+    if not PREFIX_PATTERN.match(prefix):
+        return "プレフィックスにはデータ名の先頭部分（例: work/ や work/github）を指定してください。"
+    return None
+
+
+def join_names(names: List[str], limit: int = 1500) -> str:
+    """名前をカンマ区切りで並べる（limit 文字を超える分は件数だけ示す）"""
+    shown: List[str] = []
+    length = 0
+    for name in names:
+        length += len(name) + 2
+        if length > limit:
+            return f"{', '.join(shown)} ほか{len(names) - len(shown)}件"
+        shown.append(name)
+    return ', '.join(shown)
+
+
+def parse_names(text: str) -> Tuple[List[str], Optional[str]]:
+    """スペースまたはカンマ区切りのデータ名を分解して検証する（重複は1つにまとめる）"""
+    names = list(dict.fromkeys(name for name in NAMES_SEPARATOR.split(text) if name))
+    if not names:
+        return [], "データ名を指定してください。"
+    if len(names) > MAX_NAMES_PER_COMMAND:
+        return [], f"一度に指定できるデータ名は{MAX_NAMES_PER_COMMAND}件までです。"
+    for name in names:
+        name_error = validate_name(name)
+        if name_error:
+            return [], name_error
+    return names, None
+
+
+def parse_ttl(text: str) -> Tuple[Optional[int], Optional[str]]:
+    """"30s" "10m" "2h" "7d" 形式の有効期間を秒数にする"""
+    match = TTL_PATTERN.match(text.strip().lower())
+    if not match:
+        return None, "有効期間は数字と単位（s: 秒、m: 分、h: 時間、d: 日）で指定してください（例: 10m, 2h, 7d）。"
+    seconds = int(match.group(1)) * TTL_UNITS[match.group(2)][0]
+    if not 0 < seconds <= MAX_TTL_SECONDS:
+        return None, f"有効期間は1秒から{MAX_TTL_SECONDS // 86400}日までの範囲で指定してください。"
+    return seconds, None
+
+
+def describe_ttl(seconds: int) -> str:
+    """割り切れる最大の単位で表す（例: 7200 → 2時間）"""
+    for multiplier, label in sorted(TTL_UNITS.values(), reverse=True):
+        if seconds % multiplier == 0:
+            return f"{seconds // multiplier}{label}"
+    return f"{seconds}秒"
+
+
 def validate_value(value: str) -> Optional[str]:
     if len(value) > MAX_VALUE_LENGTH:
         return f"データ値は{MAX_VALUE_LENGTH}文字以内で入力してください。"
     return None
 
 
+def parse_import_lines(lines: Iterable[str]) -> Tuple[Dict[str, str], Dict[str, float], Optional[str]]:
+    """NDJSON（1行1件の {"name": ..., "value": ..., "expires_at": ...}）を1行ずつ検証しながら読み込む
+    
+    expires_at（UNIX時刻、省略可）は有効期限付きデータの期限で、(データ, 有効期限) を返す。
+    期限を過ぎたデータは読み飛ばす。最初の不正な行、または上限件数を超えた時点で打ち切り、エラーメッセージを返す。
+    """
+    items: Dict[str, str] = {}
+    expiries: Dict[str, float] = {}
+    now = time.time()
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            name, value = entry['name'], entry['value']
+        except (ValueError, KeyError, TypeError):
+            return {}, {}, f"{line_number}行目: `{{\"name\": ..., \"value\": ...}}` 形式のJSONではありません。"
+        if not isinstance(name, str) or not isinstance(value, str):
+            return {}, {}, f"{line_number}行目: name と value は文字列で指定してください。"
+        expires_at = entry.get('expires_at')
+        if expires_at is not None and (isinstance(expires_at, bool) or not isinstance(expires_at, (int, float))):
+            return {}, {}, f"{line_number}行目: expires_at はUNIX時刻（数値）で指定してください。"
+        error = validate_name(name) or validate_value(value)
+        if error:
+            return {}, {}, f"{line_number}行目: {error}"
+        items.pop(name, None)
+        expiries.pop(name, None)
+        if expires_at is not None:
+            if expires_at <= now:
+                continue
+            expiries[name] = float(expires_at)
+        items[name] = value
+        if len(items) > MAX_ITEMS_PER_USER:
+            return {}, {}, f"ファイルのデータ数が上限（{MAX_ITEMS_PER_USER}件）を超えています。"
+    return items, expiries, None
+
+
+def write_export(data_manager: UserDataManager, user_id: str, buffer) -> int:
+    """ユーザーの全データをNDJSONとしてbufferに書き出し、件数を返す（有効期限付きのデータは expires_at 付き）"""
+    count = 0
+    for name, value, expires_at in data_manager.export_user_data(user_id):
+        entry = {"name": name, "value": value}
+        if expires_at is not None:
+            entry["expires_at"] = expires_at
+        buffer.write((json.dumps(entry, ensure_ascii=False) + "\n").encode('utf-8'))
+        count += 1
+    return count
+
+
+async def respond(interaction: discord.Interaction, work):
+    """処理が予算時間内に終わらなければ defer してからフォローアップで返信する"""
+    await respond_with_deferral(interaction, work, INTERACTION_DEFER_BUDGET, bot.response_stats)
+
+
 @bot.tree.command(name="save", description="データを保存します")
 @discord.app_commands.describe(
-    name="データの名前（英数字、アンダースコア、ハイフンのみ）",
-    value="保存するデータの値"
+    name="データの名前（英数字、アンダースコア、ハイフン。「/」で階層に分けられます）",
+    value="保存するデータの値",
+    ttl="有効期間（例: 10m, 2h, 7d）。過ぎると自動的に削除されます"
 )
-async def save_command(interaction: discord.Interaction, name: str, value: str):
-    user_id = str(interaction.user.id)
-    
+async def save_command(interaction: discord.Interaction, name: str, value: str, ttl: Optional[str] = None):
+    await respond(interaction, save_reply(str(interaction.user.id), name, value, ttl))
+
+
+async def save_reply(user_id: str, name: str, value: str, ttl: Optional[str] = None) -> str:
     name_error = validate_name(name)
     if name_error:
-        message = f"❌ **エラー**\n\n{name_error}"
-        await interaction.response.send_message(message, ephemeral=True)
-        return
+        return f"❌ **エラー**\n\n{name_error}"
     
     value_error = validate_value(value)
     if value_error:
-        message = f"❌ **エラー**\n\n{value_error}"
-        await interaction.response.send_message(message, ephemeral=True)
-        return
+        return f"❌ **エラー**\n\n{value_error}"
     
-    current_count = bot.data_manager.get_user_data_count(user_id)
-    if current_count >= MAX_ITEMS_PER_USER and name not in (bot.data_manager.get_user_data(user_id) or {}):
-        message = f"❌ **エラー**\n\n保存できるデータ数の上限（{MAX_ITEMS_PER_USER}件）に達しています。\n不要なデータを削除してください。"
-        await interaction.response.send_message(message, ephemeral=True)
-        return
+    expires_at = None
+    if ttl is not None:
+        ttl_seconds, ttl_error = parse_ttl(ttl)
+        if ttl_error:
+            return f"❌ **エラー**\n\n{ttl_error}"
+        expires_at = time.time() + ttl_seconds
     
-    if bot.data_manager.set_user_data(user_id, name, value):
-        message = f"✅ **保存完了**\n\nデータ「{name}」を保存しました。"
-    else:
-        message = "❌ **エラー**\n\nデータの保存に失敗しました。"
+    current_count = await bot.storage(bot.data_manager.get_user_data_count, user_id)
+    if current_count >= MAX_ITEMS_PER_USER and await bot.storage(bot.data_manager.get_user_data, user_id, name) is None:
+        return f"❌ **エラー**\n\n保存できるデータ数の上限（{MAX_ITEMS_PER_USER}件）に達しています。\n不要なデータを削除してください。"
     
-    await interaction.response.send_message(message, ephemeral=True)
+    if await bot.storage(bot.data_manager.set_user_data, user_id, name, value, expires_at):
+        if expires_at is None:
+            return f"✅ **保存完了**\n\nデータ「{name}」を保存しました。"
+        bot.expiry.schedule(expires_at)
+        return f"✅ **保存完了**\n\nデータ「{name}」を保存しました。\n⏳ {describe_ttl(ttl_seconds)}後に自動的に削除されます。"
+    return "❌ **エラー**\n\nデータの保存に失敗しました。"
 
 
 @bot.tree.command(name="get", description="保存したデータを取得します")
-@discord.app_commands.describe(name="取得するデータの名前（省略で全データ表示）")
+@discord.app_commands.describe(name="取得するデータの名前（スペース区切りで複数指定可、省略で全データ表示）")
 async def get_command(interaction: discord.Interaction, name: Optional[str] = None):
-    user_id = str(interaction.user.id)
-    
+    await respond(interaction, get_reply(str(interaction.user.id), name))
+
+
+async def get_reply(user_id: str, name: Optional[str]) -> str:
     if name:
-        name_error = validate_name(name)
+        names, name_error = parse_names(name)
         if name_error:
-            message = f"❌ **エラー**\n\n{name_error}"
-            await interaction.response.send_message(message, ephemeral=True)
-            return
+            return f"❌ **エラー**\n\n{name_error}"
+        if len(names) > 1:
+            return await get_many_reply(user_id, names)
+        name = names[0]
         
-        value = bot.data_manager.get_user_data(user_id, name)
+        value = await bot.storage(bot.data_manager.get_user_data, user_id, name)
         if value is None:
-            message = f"🔍 **データ検索**\n\nデータ「{name}」は見つかりませんでした。"
-        else:
-            # 長いデータの場合は分割表示
-            if len(value) > 1800:
-                truncated_value = value[:1800] + "..."
-                message = f"📄 **データ: {name}** (一部表示)\n\n```\n{truncated_value}\n```\n\n💡 データが長すぎるため一部のみ表示しています。"
-            else:
-                message = f"📄 **データ: {name}**\n\n```\n{value}\n```"
-    else:
-        user_data = bot.data_manager.get_user_data(user_id)
-        if not user_data:
-            message = "📋 **データ一覧**\n\n保存されたデータはありません。"
-        else:
-            data_list = "\n".join([f"• **{k}**: {v[:50]}{'...' if len(v) > 50 else ''}" 
-                                 for k, v in user_data.items()])
-            message = f"📋 **保存されたデータ一覧**\n\n{data_list}\n\n合計: {len(user_data)}件"
+            return f"🔍 **データ検索**\n\nデータ「{name}」は見つかりませんでした。"
+        # 長いデータの場合は分割表示
+        if len(value) > 1800:
+            truncated_value = value[:1800] + "..."
+            return f"📄 **データ: {name}** (一部表示)\n\n```\n{truncated_value}\n```\n\n💡 データが長すぎるため一部のみ表示しています。"
+        return f"📄 **データ: {name}**\n\n```\n{value}\n```"
     
-    await interaction.response.send_message(message, ephemeral=True)
+    user_data = await bot.storage(bot.data_manager.get_user_data, user_id)
+    if not user_data:
+        return "📋 **データ一覧**\n\n保存されたデータはありません。"
+    data_list = "\n".join([f"• **{k}**: {v[:50]}{'...' if len(v) > 50 else ''}" 
+                         for k, v in user_data.items()])
+    return f"📋 **保存されたデータ一覧**\n\n{data_list}\n\n合計: {len(user_data)}件"
+
+
+async def get_many_reply(user_id: str, names: List[str]) -> str:
+    # 複数の名前は1回の問い合わせでまとめて取得する
+    found = await bot.storage(bot.data_manager.get_user_data_many, user_id, names)
+    if found is None:
+        return "❌ **エラー**\n\nデータの取得に失敗しました。"
+    missing = [name for name in names if name not in found]
+    if not found:
+        return f"🔍 **データ検索**\n\n指定したデータはいずれも見つかりませんでした: {', '.join(missing)}"
+    
+    # Discordの2000文字制限に収まるよう、名前や装飾を除いた残りを1件ずつ割り振る
+    overhead = sum(len(key) + 14 for key in found) + sum(len(name) + 2 for name in missing) + 60
+    limit = max(20, (1900 - overhead) // len(found))
+    sections = [f"**{key}**\n```\n{value[:limit] + '...' if len(value) > limit else value}\n```"
+                for key, value in found.items()]
+    message = f"📄 **データ: {len(found)}件**\n\n" + "\n".join(sections)
+    if missing:
+        message += f"\n🔍 見つからなかったデータ: {', '.join(missing)}"
+    return message
 
 
 @bot.tree.command(name="delete", description="保存したデータを削除します")
-@discord.app_commands.describe(name="削除するデータの名前")
-async def delete_command(interaction: discord.Interaction, name: str):
-    user_id = str(interaction.user.id)
+@discord.app_commands.describe(
+    name="削除するデータの名前（スペース区切りで複数指定可）",
+    prefix="この文字列で始まるデータをまとめて削除（例: work/）"
+)
+async def delete_command(interaction: discord.Interaction, name: Optional[str] = None, prefix: Optional[str] = None):
+    await respond(interaction, delete_reply(str(interaction.user.id), name, prefix))
+
+
+async def delete_reply(user_id: str, name: Optional[str], prefix: Optional[str] = None) -> str:
+    if prefix is not None:
+        if name is not None:
+            return "❌ **エラー**\n\nデータ名とプレフィックスはどちらか一方だけ指定してください。"
+        return await delete_prefix_reply(user_id, prefix)
+    names, name_error = parse_names(name or '')
+    if name_error:
+        return f"❌ **エラー**\n\n{name_error}"
+    if len(names) > 1:
+        return await delete_many_reply(user_id, names)
+    name = names[0]
+    
+    if await bot.storage(bot.data_manager.delete_user_data, user_id, name):
+        return f"🗑️ **削除完了**\n\nデータ「{name}」を削除しました。"
+    return f"⚠️ **エラー**\n\nデータ「{name}」は見つかりませんでした。"
+
+
+async def delete_many_reply(user_id: str, names: List[str]) -> str:
+    # 1つの文・1トランザクション（JSONは保存1回）でまとめて削除する
+    deleted = await bot.storage(bot.data_manager.delete_user_data_many, user_id, names)
+    if deleted is None:
+        return "❌ **エラー**\n\nデータの削除に失敗しました。"
+    missing = [name for name in names if name not in deleted]
+    if not deleted:
+        return f"⚠️ **エラー**\n\n指定したデータはいずれも見つかりませんでした: {', '.join(missing)}"
+    message = f"🗑️ **削除完了**\n\n{len(deleted)}件のデータを削除しました: {', '.join(deleted)}"
+    if missing:
+        message += f"\n\n⚠️ 見つからなかったデータ: {', '.join(missing)}"
+    return message
+
+
+async def delete_prefix_reply(user_id: str, prefix: str) -> str:
+    prefix_error = validate_prefix(prefix)
+    if prefix_error:
+        return f"❌ **エラー**\n\n{prefix_error}"
+    
+    # 対象の名前を先に取得せず、範囲をまとめて削除する
+    deleted = await bot.storage(bot.data_manager.delete_user_data_prefix, user_id, prefix)
+    if deleted is None:
+        return "❌ **エラー**\n\nデータの削除に失敗しました。"
+    if not deleted:
+        return f"⚠️ **エラー**\n\n「{prefix}」で始まるデータは見つかりませんでした。"
+    return f"🗑️ **削除完了**\n\n「{prefix}」で始まる{len(deleted)}件のデータを削除しました: {join_names(deleted)}"
+
+
+@bot.tree.command(name="list", description="保存したデータの名前一覧を表示します")
+@discord.app_commands.describe(prefix="この文字列で始まるデータだけを表示（例: work/）")
+async def list_command(interaction: discord.Interaction, prefix: Optional[str] = None):
+    await respond(interaction, list_reply(str(interaction.user.id), prefix))
+
+
+async def list_reply(user_id: str, prefix: Optional[str] = None) -> str:
+    if prefix is not None:
+        prefix_error = validate_prefix(prefix)
+        if prefix_error:
+            return f"❌ **エラー**\n\n{prefix_error}"
+        # 値は不要なので、範囲に入る名前だけ取得する
+        names = await bot.storage(bot.data_manager.list_user_keys, user_id, prefix)
+        if not names:
+            return f"📋 **データ一覧: {prefix}**\n\n「{prefix}」で始まるデータはありません。"
+        data_names = "\n".join([f"• {name}" for name in names])
+        return f"📋 **データ一覧: {prefix}**\n\n{data_names}\n\n該当: {len(names)}件"
+    
+    # 値は不要なので名前だけ取得する
+    names = await bot.storage(bot.data_manager.list_user_keys, user_id)
     
+    if not names:
+        return "📋 **データ一覧**\n\n保存されたデータはありません。"
+    data_names = "\n".join([f"• {name}" for name in names])
+    return f"📋 **データ一覧**\n\n{data_names}\n\n合計: {len(names)}件 / 上限: {MAX_ITEMS_PER_USER}件"
+
+
+@bot.tree.command(name="history", description="データの変更履歴（上書きされる前の値）を表示します")
+@discord.app_commands.describe(name="履歴を表示するデータの名前")
+async def history_command(interaction: discord.Interaction, name: str):
+    await respond(interaction, history_reply(str(interaction.user.id), name))
+
+
+async def history_reply(user_id: str, name: str) -> str:
     name_error = validate_name(name)
     if name_error:
-        message = f"❌ **エラー**\n\n{name_error}"
-        await interaction.response.send_message(message, ephemeral=True)
-        return
+        return f"❌ **エラー**\n\n{name_error}"
     
-    if bot.data_manager.delete_user_data(user_id, name):
-        message = f"🗑️ **削除完了**\n\nデータ「{name}」を削除しました。"
-    else:
-        message = f"⚠️ **エラー**\n\nデータ「{name}」は見つかりませんでした。"
+    versions = await bot.storage(bot.data_manager.get_user_history, user_id, name)
+    if versions is None:
+        return "❌ **エラー**\n\n履歴の取得に失敗しました。"
+    if not versions:
+        return f"🕘 **変更履歴: {name}**\n\n上書きされた値はありません。"
+    # 全版を2000文字に収めるため、値は先頭だけ表示する
+    sections = [f"**{number}.** <t:{int(replaced_at)}:f> まで\n```\n{value[:100] + '...' if len(value) > 100 else value}\n```"
+                for number, (replaced_at, value) in enumerate(versions, start=1)]
+    return (f"🕘 **変更履歴: {name}**\n\n" + "\n".join(sections) +
+            f"\n💡 `/restore name:{name} version:番号` で、その値に戻せます。")
+
+
+@bot.tree.command(name="restore", description="データを履歴にある以前の値に戻します")
+@discord.app_commands.describe(
+    name="戻すデータの名前",
+    version="戻す版の番号（/history の番号。省略すると直前の値）"
+)
+async def restore_command(interaction: discord.Interaction, name: str, version: int = 1):
+    await respond(interaction, restore_reply(str(interaction.user.id), name, version))
+
+
+async def restore_reply(user_id: str, name: str, version: int = 1) -> str:
+    name_error = validate_name(name)
+    if name_error:
+        return f"❌ **エラー**\n\n{name_error}"
+    if not 1 <= version <= HISTORY_MAX_VERSIONS:
+        return f"❌ **エラー**\n\n版の番号は1から{HISTORY_MAX_VERSIONS}の範囲で指定してください。"
+    
+    versions = await bot.storage(bot.data_manager.get_user_history, user_id, name)
+    if versions is None:
+        return "❌ **エラー**\n\n履歴の取得に失敗しました。"
+    if len(versions) < version:
+        return f"⚠️ **エラー**\n\nデータ「{name}」に版{version}の履歴はありません。"
     
-    await interaction.response.send_message(message, ephemeral=True)
+    # 通常の保存として書き込むので、戻す前の値も履歴に残る
+    replaced_at, value = versions[version - 1]
+    if await bot.storage(bot.data_manager.set_user_data, user_id, name, value):
+        return (f"♻️ **復元完了**\n\nデータ「{name}」を版{version}（<t:{int(replaced_at)}:f> まで使われていた値）に戻しました。\n"
+                f"💡 戻す前の値は履歴に残っています。")
+    return "❌ **エラー**\n\nデータの復元に失敗しました。"
 
 
-@bot.tree.command(name="list", description="保存したデータの名前一覧を表示します")
-async def list_command(interaction: discord.Interaction):
-    user_id = str(interaction.user.id)
-    user_data = bot.data_manager.get_user_data(user_id)
+@bot.tree.command(name="export", description="保存したデータをファイルでエクスポートします")
+async def export_command(interaction: discord.Interaction):
+    await respond(interaction, export_reply(str(interaction.user.id)))
+
+
+async def export_reply(user_id: str) -> Tuple[str, Optional[discord.File]]:
+    # 1件ずつNDJSONとして書き出す（大きくなったらディスクに退避）
+    buffer = tempfile.SpooledTemporaryFile(max_size=MAX_IMPORT_BYTES)
+    try:
+        count = await bot.storage(write_export, bot.data_manager, user_id, buffer)
+    except Overloaded:
+        buffer.close()
+        raise
+    except Exception as e:
+        logger.error(f"エクスポートエラー: {e}")
+        buffer.close()
+        return "❌ **エラー**\n\nデータのエクスポートに失敗しました。", None
     
-    if not user_data:
-        message = "📋 **データ一覧**\n\n保存されたデータはありません。"
-    else:
-        data_names = "\n".join([f"• {name}" for name in user_data.keys()])
-        message = f"📋 **データ一覧**\n\n{data_names}\n\n合計: {len(user_data)}件 / 上限: {MAX_ITEMS_PER_USER}件"
+    if count == 0:
+        buffer.close()
+        return "📋 **エクスポート**\n\n保存されたデータはありません。", None
+    
+    buffer.seek(0)
+    return (f"📦 **エクスポート完了**\n\n{count}件のデータを書き出しました。\n`/import` で復元できます。",
+            discord.File(buffer, filename=EXPORT_FILENAME))
+
+
+@bot.tree.command(name="import", description="エクスポートしたファイルからデータを一括保存します")
+@discord.app_commands.describe(file="/export で作成したNDJSONファイル（同名のデータは上書き）")
+async def import_command(interaction: discord.Interaction, file: discord.Attachment):
+    await respond(interaction, import_reply(str(interaction.user.id), file))
+
+
+async def import_reply(user_id: str, file: discord.Attachment) -> str:
+    if file.size > MAX_IMPORT_BYTES:
+        return f"❌ **エラー**\n\nファイルサイズは{MAX_IMPORT_BYTES // 1024}KB以内にしてください。"
+    
+    try:
+        raw = await file.read()
+        items, expiries, parse_error = parse_import_lines(io.TextIOWrapper(io.BytesIO(raw), encoding='utf-8'))
+    except (discord.HTTPException, UnicodeDecodeError) as e:
+        logger.error(f"インポートファイル読み込みエラー: {e}")
+        items, expiries, parse_error = {}, {}, "ファイルを読み込めませんでした（UTF-8のNDJSONファイルを指定してください）。"
+    if parse_error:
+        return f"❌ **エラー**\n\n{parse_error}"
+    if not items:
+        return "❌ **エラー**\n\nファイルにデータがありません。"
+    
+    # 上限を超える場合に早めに分かりやすく断るための確認（ロックは持たない）。保存時の判定は
+    # import_user_data が行う（JSONは self._lock、DBは user_stats の行ロックを持ったまま）。ただし
+    # /save は件数確認と保存を1つのロックの中で行わないため、同時に保存されたぶん上限を少し超えることがある
+    existing = set(await bot.storage(bot.data_manager.list_user_keys, user_id))
+    new_count = len(set(items) - existing)
+    if len(existing) + new_count > MAX_ITEMS_PER_USER:
+        return (f"❌ **エラー**\n\nインポートすると保存できるデータ数の上限（{MAX_ITEMS_PER_USER}件）を超えます。\n"
+                f"現在: {len(existing)}件 / 新規: {new_count}件")
     
-    await interaction.response.send_message(message, ephemeral=True)
+    imported = await bot.storage(bot.data_manager.import_user_data, user_id, items, expiries)
+    if imported is None:
+        return "❌ **エラー**\n\nデータのインポートに失敗しました。何も保存されていません。"
+    for expires_at in set(expiries.values()):
+        bot.expiry.schedule(expires_at)
+    return f"✅ **インポート完了**\n\n{imported}件のデータを保存しました（新規: {new_count}件）。"
+
+
+debug_group = app_commands.Group(
+    name="debug", description="Botの動作状況を調べます（オーナー専用）",
+    default_permissions=discord.Permissions(administrator=True)
+)
+
+
+async def respond_owner_only(interaction: discord.Interaction, work):
+    """オーナー以外には何も計測せずに断る"""
+    if not await bot.is_owner(interaction.user):
+        work.close()
+        await interaction.response.send_message("🔒 このコマンドはBotのオーナーだけが使えます。", ephemeral=True)
+        return
+    await respond(interaction, work)
+
+
+def debug_file(kind: str, text: str) -> discord.File:
+    return discord.File(io.BytesIO(text.encode('utf-8')), filename=f"{kind}-{int(time.time())}.txt")
+
+
+def code_block(lines: List[str], limit: int = 1500) -> str:
+    """2000文字の上限に収まる行数だけをコードブロックにする"""
+    kept, length = [], 0
+    for line in lines:
+        length += len(line) + 1
+        if length > limit:
+            break
+        kept.append(line)
+    return "```\n" + "\n".join(kept or ["(なし)"]) + "\n```"
+
+
+@debug_group.command(name="profile", description="CPUプロファイル（スタックのサンプリング）を取得します")
+@discord.app_commands.describe(seconds=f"計測する秒数（1〜{DEBUG_PROFILE_MAX_SECONDS}、省略時10）")
+async def debug_profile_command(interaction: discord.Interaction, seconds: int = 10):
+    await respond_owner_only(interaction, debug_profile_reply(seconds))
+
+
+async def debug_profile_reply(seconds: int = 10) -> Tuple[str, Optional[discord.File]]:
+    if not 1 <= seconds <= DEBUG_PROFILE_MAX_SECONDS:
+        return f"❌ **エラー**\n\n秒数は1から{DEBUG_PROFILE_MAX_SECONDS}の範囲で指定してください。", None
+    if bot.debug_lock.locked():
+        return "⏳ 別の計測が実行中です。終わってからもう一度お試しください。", None
+    async with bot.debug_lock:
+        profile = await capture_profile(seconds)
+    top = [f"{count:6d}  {label}" for label, count in profile.top_self(10)]
+    return (f"🔬 **CPUプロファイル（{seconds}秒）**\n\n処理中のサンプル {profile.busy_samples}件、上位:\n{code_block(top)}\n"
+            f"添付ファイルの folded stacks は flamegraph.pl や speedscope で表示できます。",
+            debug_file('profile', profile.report()))
+
+
+@debug_group.command(name="memory", description="一定時間に確保されて残ったメモリを調べます（tracemalloc）")
+@discord.app_commands.describe(seconds=f"計測する秒数（1〜{DEBUG_MEMORY_MAX_SECONDS}、省略時30）")
+async def debug_memory_command(interaction: discord.Interaction, seconds: int = 30):
+    await respond_owner_only(interaction, debug_memory_reply(seconds))
+
+
+async def debug_memory_reply(seconds: int = 30) -> Tuple[str, Optional[discord.File]]:
+    if not 1 <= seconds <= DEBUG_MEMORY_MAX_SECONDS:
+        return f"❌ **エラー**\n\n秒数は1から{DEBUG_MEMORY_MAX_SECONDS}の範囲で指定してください。", None
+    if bot.debug_lock.locked():
+        return "⏳ 別の計測が実行中です。終わってからもう一度お試しください。", None
+    async with bot.debug_lock:
+        diff = await memory_diff(seconds)
+    return (f"🧠 **メモリの増加（{seconds}秒）**\n\n{code_block(diff.summary())}",
+            debug_file('memory', diff.report()))
+
+
+@debug_group.command(name="loop", description="イベントループの遅延・タスク数・各種統計を表示します")
+@discord.app_commands.describe(seconds=f"遅延を計測する秒数（1〜{DEBUG_LOOP_MAX_SECONDS}、省略時5）")
+async def debug_loop_command(interaction: discord.Interaction, seconds: int = 5):
+    await respond_owner_only(interaction, debug_loop_reply(seconds))
+
+
+async def debug_loop_reply(seconds: int = 5) -> Tuple[str, Optional[discord.File]]:
+    if not 1 <= seconds <= DEBUG_LOOP_MAX_SECONDS:
+        return f"❌ **エラー**\n\n秒数は1から{DEBUG_LOOP_MAX_SECONDS}の範囲で指定してください。", None
+    if bot.debug_lock.locked():
+        return "⏳ 別の計測が実行中です。終わってからもう一度お試しください。", None
+    async with bot.debug_lock:
+        lags = await measure_loop_lag(seconds)
+    tasks = task_counts()
+    admission = bot.admission
+    overview = [
+        f"loop lag: {describe_lag(lags)}",
+        f"tasks: {sum(tasks.values())}, threads: {threading.active_count()}",
+        f"storage: {admission.in_flight} running, {admission.waiting} waiting, "
+        + ", ".join(f"{key} {value}" for key, value in admission.stats.items()),
+        f"expiry: {len(bot.expiry)} scheduled, "
+        + ", ".join(f"{key} {value}" for key, value in bot.expiry.stats.items()),
+    ]
+    if bot.data_manager.use_database:
+        overview.append("prepared statements: "
+                        + ", ".join(f"{key} {value}" for key, value in bot.data_manager.db.statements.stats.items()))
+    report = (["# Overview"] + overview + ["", "# Tasks"] + [f"{count:5d}  {name}" for name, count in tasks.items()]
+              + ["", "# Responses"] + bot.response_stats.summary())
+    return (f"⏱️ **イベントループ（{seconds}秒）**\n\n{code_block(overview)}",
+            debug_file('loop', '\n'.join(report) + '\n'))
+
+
+bot.tree.add_command(debug_group)
 
 
 @bot.event
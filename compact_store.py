@@ -0,0 +1,392 @@
+"""
+Memory-compact resident store for the JSON file backend
+
+A plain Dict[str, Dict[str, str]] pays full Python object overhead for every
+user ID, key and value: a 100k-user file costs several hundred bytes per user
+before counting the data itself. Here each user is one dict entry:
+
+- snowflake user IDs are stored as ints instead of 18-19 character strings
+- data names are interned into one shared name table and referenced by number
+- a user's entries are packed into a single bytes arena: a small offset table
+  followed by the values' UTF-8 bytes back to back, sorted by name so that a
+  name prefix (a namespace such as "work/") is one contiguous range
+
+UserRecord (a __slots__ view) decodes an arena on access and is never kept.
+CompactStore reads like the old mapping ({user_id: {key: value}}, with fresh
+dicts materialized on access) and writes the same JSON file layout.
+
+Entries saved with a TTL are the exception: their expiry times live in a
+separate per-user map (only TTL entries pay for it), an expired entry reads as
+absent until it is swept, and the file stores such an entry as
+{"value": ..., "expires_at": <epoch seconds>} instead of a bare string.
+
+Likewise, values replaced by an overwrite are kept in a capped per-entry ring
+buffer (the newest history_versions of them) and stored in the file as
+{"value": ..., "history": [[<replaced at>, <old value>], ...]}, oldest first.
+Deleting an entry drops its history, and TTL entries never get one.
+
+Saving writes the file straight from the arenas: names and values are
+escaped with the json module's C string encoder and joined in json.dump's
+indent=2 layout, without building a dict per user or keeping any text
+between saves. Only users with TTL or history entries go through json.dumps.
+"""
+
+import json
+import json.encoder
+import time
+import heapq
+from array import array
+from collections import deque
+from bisect import bisect_left
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union, IO
+
+UserKey = Union[int, str]
+
+# json.dumps(s, ensure_ascii=False) for a str, without the per-call setup
+_json_string = json.encoder.encode_basestring
+
+# Arena layout, native-endian uint32 words:
+#   [count] [name ids x count] [value end offsets x count] [UTF-8 values...]
+WORD = array('I').itemsize
+
+
+def _user_key(user_id: str) -> UserKey:
+    """Canonical decimal IDs become ints; anything else is kept as the string"""
+    if user_id.isascii() and user_id.isdigit() and (user_id == '0' or user_id[0] != '0'):
+        return int(user_id)
+    return user_id
+
+
+class UserRecord:
+    """Decoded view of one user's arena
+
+    Value i is the UTF-8 slice ends[i - 1]:ends[i] of the value area.
+    """
+    __slots__ = ('arena', 'name_ids', 'ends', 'base')
+
+    def __init__(self, arena: bytes = b''):
+        self.arena = arena
+        count = array('I', arena[:WORD])[0] if arena else 0
+        self.name_ids = array('I', arena[WORD:WORD * (1 + count)])
+        self.ends = array('I', arena[WORD * (1 + count):WORD * (1 + 2 * count)])
+        self.base = WORD * (1 + 2 * count)
+
+    def __len__(self) -> int:
+        return len(self.name_ids)
+
+    def index(self, name_id: int) -> int:
+        try:
+            return self.name_ids.index(name_id)
+        except ValueError:
+            return -1
+
+    def value_bytes(self, i: int) -> bytes:
+        start = self.ends[i - 1] if i else 0
+        return self.arena[self.base + start:self.base + self.ends[i]]
+
+    def values(self) -> List[bytes]:
+        return [self.value_bytes(i) for i in range(len(self))]
+
+    @staticmethod
+    def pack(name_ids: List[int], values: List[bytes]) -> bytes:
+        ends = array('I')
+        total = 0
+        for value in values:
+            total += len(value)
+            ends.append(total)
+        return array('I', [len(name_ids)]).tobytes() + array('I', name_ids).tobytes() + ends.tobytes() + b''.join(values)
+
+
+class CompactStore(Mapping):
+    """All users' data, readable as a read-only {user_id: {key: value}} mapping
+
+    Writes go through set_value/delete_value/delete_prefix. Not thread-safe; the caller
+    serializes access (UserDataManager holds its JSON lock).
+    """
+    __slots__ = ('_users', '_names', '_name_ids', '_expiry', '_history', '_history_versions')
+
+    def __init__(self, history_versions: int = 0):
+        self._users: Dict[UserKey, bytes] = {}
+        # Names are never dropped from the table; it grows with distinct names, not users
+        self._names: List[str] = []
+        self._name_ids: Dict[str, int] = {}
+        # {user: {name id: expires_at}} for TTL entries only
+        self._expiry: Dict[UserKey, Dict[int, float]] = {}
+        # {user: {name id: ring buffer of (replaced_at, old value)}}; 0 versions disables it
+        self._history: Dict[UserKey, Dict[int, deque]] = {}
+        self._history_versions = history_versions
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Dict[str, Any]], history_versions: int = 0) -> 'CompactStore':
+        """Build from loaded JSON, emptying data as it goes to cap peak memory
+
+        Entries that expired while the file was not loaded are dropped, and
+        values that are not strings (hand-edited files) are stored as str(value).
+        """
+        store = cls(history_versions)
+        now = time.time()
+        for user_id in list(data):
+            user_key = _user_key(user_id)
+            name_ids, values = [], []
+            for key, value in sorted(data.pop(user_id).items()):
+                if isinstance(value, dict):
+                    expires_at = value.get('expires_at')
+                    if expires_at is not None and expires_at <= now:
+                        continue
+                    store._set_expiry(user_key, store._name_id(key), expires_at)
+                    for replaced_at, old_value in value.get('history', []):
+                        store._push_history(user_key, store._name_id(key), replaced_at, str(old_value).encode('utf-8'))
+                    value = value['value']
+                name_ids.append(store._name_id(key))
+                values.append(str(value).encode('utf-8'))
+            if name_ids:
+                store._users[user_key] = UserRecord.pack(name_ids, values)
+        return store
+
+    def _name_id(self, key: str) -> int:
+        name_id = self._name_ids.get(key)
+        if name_id is None:
+            name_id = self._name_ids[key] = len(self._names)
+            self._names.append(key)
+        return name_id
+
+    def _set_expiry(self, user_key: UserKey, name_id: int, expires_at: Optional[float]):
+        if expires_at is not None:
+            self._expiry.setdefault(user_key, {})[name_id] = expires_at
+            return
+        user_expiry = self._expiry.get(user_key)
+        if user_expiry and user_expiry.pop(name_id, None) is not None and not user_expiry:
+            del self._expiry[user_key]
+
+    def _push_history(self, user_key: UserKey, name_id: int, replaced_at: float, old_value: bytes):
+        if self._history_versions:
+            user_history = self._history.setdefault(user_key, {})
+            if name_id not in user_history:
+                user_history[name_id] = deque(maxlen=self._history_versions)
+            user_history[name_id].append((replaced_at, old_value))
+
+    def _drop_history(self, user_key: UserKey, name_id: int):
+        user_history = self._history.get(user_key)
+        if user_history and user_history.pop(name_id, None) is not None and not user_history:
+            del self._history[user_key]
+
+    def _live_positions(self, user_key: UserKey, record: UserRecord) -> List[int]:
+        """Positions of the entries that have not expired"""
+        user_expiry = self._expiry.get(user_key)
+        if not user_expiry:
+            return list(range(len(record)))
+        now = time.time()
+        return [i for i, name_id in enumerate(record.name_ids) if user_expiry.get(name_id, now + 1) > now]
+
+    def _is_live(self, user_key: UserKey, name_id: int) -> bool:
+        user_expiry = self._expiry.get(user_key)
+        return not user_expiry or user_expiry.get(name_id, float('inf')) > time.time()
+
+    def _sorted_names(self, record: UserRecord) -> List[str]:
+        return [self._names[name_id] for name_id in record.name_ids]
+
+    def _prefix_range(self, names: List[str], prefix: str) -> range:
+        """Positions of the names starting with prefix (a contiguous run, since names are sorted)"""
+        start = end = bisect_left(names, prefix)
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return range(start, end)
+
+    def _record(self, user_id: str) -> Optional[UserRecord]:
+        arena = self._users.get(_user_key(user_id))
+        return UserRecord(arena) if arena is not None else None
+
+    def __getitem__(self, user_id: str) -> Dict[str, str]:
+        if not isinstance(user_id, str):
+            raise KeyError(user_id)
+        user_key = _user_key(user_id)
+        data = self._as_dict(user_key, UserRecord(self._users[user_key]))
+        if not data:
+            # Only expired entries left, waiting for the sweep
+            raise KeyError(user_id)
+        return data
+
+    def _as_dict(self, user_key: UserKey, record: UserRecord) -> Dict[str, str]:
+        return {self._names[record.name_ids[i]]: record.value_bytes(i).decode('utf-8')
+                for i in self._live_positions(user_key, record)}
+
+    def __iter__(self) -> Iterator[str]:
+        for user_key in self._users:
+            yield str(user_key)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __contains__(self, user_id: object) -> bool:
+        return isinstance(user_id, str) and _user_key(user_id) in self._users
+
+    def get_value(self, user_id: str, key: str) -> Optional[str]:
+        record = self._record(user_id)
+        name_id = self._name_ids.get(key)
+        if record is None or name_id is None or not self._is_live(_user_key(user_id), name_id):
+            return None
+        i = record.index(name_id)
+        return record.value_bytes(i).decode('utf-8') if i >= 0 else None
+
+    def set_value(self, user_id: str, key: str, value: str, expires_at: Optional[float] = None):
+        """Add or overwrite an entry; saving without expires_at clears an earlier TTL"""
+        user_key = _user_key(user_id)
+        name_id = self._name_id(key)
+        record = UserRecord(self._users.get(user_key, b''))
+        name_ids = record.name_ids.tolist()
+        values = record.values()
+        names = self._sorted_names(record)
+        i = bisect_left(names, key)
+        encoded = value.encode('utf-8')
+        if i < len(names) and names[i] == key:
+            # Keep the replaced value, unless it was a TTL entry (expired or not)
+            if values[i] != encoded and name_id not in self._expiry.get(user_key, {}):
+                self._push_history(user_key, name_id, time.time(), values[i])
+            values[i] = encoded
+        else:
+            name_ids.insert(i, name_id)
+            values.insert(i, encoded)
+        self._set_expiry(user_key, name_id, expires_at)
+        self._users[user_key] = UserRecord.pack(name_ids, values)
+
+    def delete_value(self, user_id: str, key: str) -> bool:
+        """Remove one entry; a user with no entries left is dropped"""
+        user_key = _user_key(user_id)
+        arena = self._users.get(user_key)
+        name_id = self._name_ids.get(key)
+        if arena is None or name_id is None:
+            return False
+        record = UserRecord(arena)
+        i = record.index(name_id)
+        if i < 0:
+            return False
+        live = self._is_live(user_key, name_id)
+        self._remove(user_key, record, [i])
+        return live
+
+    def _remove(self, user_key: UserKey, record: UserRecord, positions: List[int]):
+        """Drop the entries at positions (and their expiry times and history) with one repack"""
+        for i in positions:
+            self._set_expiry(user_key, record.name_ids[i], None)
+            self._drop_history(user_key, record.name_ids[i])
+        if len(positions) == len(record):
+            del self._users[user_key]
+            return
+        drop = set(positions)
+        keep = [i for i in range(len(record)) if i not in drop]
+        self._users[user_key] = UserRecord.pack([record.name_ids[i] for i in keep],
+                                                [record.value_bytes(i) for i in keep])
+
+    def delete_prefix(self, user_id: str, prefix: str) -> List[str]:
+        """Remove every entry whose name starts with prefix; returns the removed names"""
+        user_key = _user_key(user_id)
+        arena = self._users.get(user_key)
+        if arena is None:
+            return []
+        record = UserRecord(arena)
+        names = self._sorted_names(record)
+        found = self._prefix_range(names, prefix)
+        if not found:
+            return []
+        live = set(self._live_positions(user_key, record))
+        self._remove(user_key, record, list(found))
+        return [names[i] for i in found if i in live]
+
+    def user_keys(self, user_id: str, prefix: Optional[str] = None) -> List[str]:
+        """The user's names in sorted order, optionally only those starting with prefix"""
+        user_key = _user_key(user_id)
+        record = self._record(user_id)
+        if record is None:
+            return []
+        names = self._sorted_names(record)
+        found = range(len(names)) if prefix is None else self._prefix_range(names, prefix)
+        if user_key in self._expiry:
+            live = set(self._live_positions(user_key, record))
+            return [names[i] for i in found if i in live]
+        return names[found.start:found.stop]
+
+    def user_count(self, user_id: str) -> int:
+        record = self._record(user_id)
+        return len(self._live_positions(_user_key(user_id), record)) if record else 0
+
+    def user_bytes(self, user_id: str) -> int:
+        """Total UTF-8 size of the user's values"""
+        user_key = _user_key(user_id)
+        record = self._record(user_id)
+        if record is None:
+            return 0
+        if user_key in self._expiry:
+            return sum(len(record.value_bytes(i)) for i in self._live_positions(user_key, record))
+        return len(record.arena) - record.base
+
+    def expires_at(self, user_id: str, key: str) -> Optional[float]:
+        """When a TTL entry expires (None for entries without a TTL)"""
+        name_id = self._name_ids.get(key)
+        return self._expiry.get(_user_key(user_id), {}).get(name_id)
+
+    def history(self, user_id: str, key: str) -> List[Tuple[float, str]]:
+        """Replaced values of an entry as (replaced_at, value), newest first"""
+        name_id = self._name_ids.get(key)
+        versions = self._history.get(_user_key(user_id), {}).get(name_id, ())
+        return [(replaced_at, value.decode('utf-8')) for replaced_at, value in reversed(versions)]
+
+    def _expiring(self) -> Iterator[Tuple[float, UserKey, int]]:
+        for user_key, user_expiry in self._expiry.items():
+            for name_id, expires_at in user_expiry.items():
+                yield expires_at, user_key, name_id
+
+    def upcoming_expiries(self, until: float, limit: int) -> List[float]:
+        """The earliest expiry times up to until (looks at TTL entries only)"""
+        return heapq.nsmallest(limit, (expires_at for expires_at, _, _ in self._expiring() if expires_at <= until))
+
+    def sweep_expired(self, now: float, limit: int) -> List[Tuple[str, str]]:
+        """Remove up to limit entries that expired by now, earliest first; returns (user_id, key)"""
+        due = heapq.nsmallest(limit, (entry for entry in self._expiring() if entry[0] <= now))
+        by_user: Dict[UserKey, List[int]] = {}
+        for _, user_key, name_id in due:
+            by_user.setdefault(user_key, []).append(name_id)
+        swept = []
+        for user_key, name_ids in by_user.items():
+            record = UserRecord(self._users[user_key])
+            self._remove(user_key, record, [record.index(name_id) for name_id in name_ids])
+            swept.extend((str(user_key), self._names[name_id]) for name_id in name_ids)
+        return swept
+
+    def write_json(self, f: IO[str]):
+        """Write the same layout as json.dump(data, f, ensure_ascii=False, indent=2),
+        one user at a time instead of materializing the whole mapping"""
+        if not self._users:
+            f.write('{}')
+            return
+        f.write('{')
+        separator = '\n  '
+        for user_key, arena in self._users.items():
+            f.write(separator)
+            f.write(self._user_json(user_key, UserRecord(arena)))
+            separator = ',\n  '
+        f.write('\n}')
+
+    def _user_json(self, user_key: UserKey, record: UserRecord) -> str:
+        """One user's '"user id": {...}' member of the file, indented as json.dump(indent=2) does"""
+        if user_key in self._expiry or user_key in self._history:
+            return self._user_json_with_metadata(user_key, record)
+        names = self._names
+        members = ',\n    '.join(f"{_json_string(names[name_id])}: {_json_string(record.value_bytes(i).decode('utf-8'))}"
+                                  for i, name_id in enumerate(record.name_ids))
+        return f"{_json_string(str(user_key))}: {{\n    {members}\n  }}" if members else f"{_json_string(str(user_key))}: {{}}"
+
+    def _user_json_with_metadata(self, user_key: UserKey, record: UserRecord) -> str:
+        data: Dict[str, Any] = self._as_dict(user_key, record)
+        for name_id, expires_at in self._expiry.get(user_key, {}).items():
+            name = self._names[name_id]
+            if name in data:
+                data[name] = {'value': data[name], 'expires_at': expires_at}
+        for name_id, versions in self._history.get(user_key, {}).items():
+            name = self._names[name_id]
+            if name in data:
+                entry = data[name] if isinstance(data[name], dict) else {'value': data[name]}
+                entry['history'] = [[replaced_at, value.decode('utf-8')] for replaced_at, value in versions]
+                data[name] = entry
+        user_json = json.dumps(data, ensure_ascii=False, indent=2)
+        return f"{json.dumps(str(user_key))}: {user_json.replace(chr(10), chr(10) + '  ')}"
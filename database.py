@@ -1,12 +1,506 @@
 import os
+import json
+import time
+import hashlib
+import select
+import itertools
+import threading
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.errors
+import psycopg2.pool
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, List, Iterator, Tuple, Set
+from concurrent.futures import Future
 from contextlib import contextmanager
+from prepared import StatementRegistry
 
 logger = logging.getLogger('vault.database')
 
+# Channel used by the notify_user_data_change trigger in schema.sql
+CHANGE_CHANNEL = 'user_data_changes'
+LISTEN_POLL_SECONDS = 5.0
+LISTEN_RETRY_SECONDS = 5.0
+
+# Read replica routing
+REPLICA_HEALTH_CHECK_SECONDS = 10.0
+REPLICA_RETRY_SECONDS = 30.0  # An unreachable replica is skipped for this long
+READ_YOUR_WRITES_SECONDS = float(os.getenv('PG_READ_YOUR_WRITES_SECONDS', '5'))
+# Per-replica connection pool: psycopg2 pools keep only the minimum open
+# between reads, connections beyond it are closed when returned
+REPLICA_POOL_MIN_CONNECTIONS = int(os.getenv('PG_REPLICA_POOL_MIN', '2'))
+REPLICA_POOL_MAX_CONNECTIONS = int(os.getenv('PG_REPLICA_POOL_MAX', '4'))
+RECENT_WRITES_PRUNE_SIZE = 10000
+
+# Circuit breaker on the primary: after this many consecutive connect failures,
+# fail fast for PG_BREAKER_RESET_SECONDS before letting one probe through
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('PG_BREAKER_FAILURES', '3'))
+BREAKER_RESET_SECONDS = float(os.getenv('PG_BREAKER_RESET_SECONDS', '10'))
+CONNECT_TIMEOUT_SECONDS = int(os.getenv('PGCONNECT_TIMEOUT', '5'))
+# TCP keepalives notice a dead server under an idle pooled connection, and the
+# statement timeout bounds a query stuck on a server that still answers pings
+# (0 disables it; schema changes and migrations turn it off for themselves)
+KEEPALIVES_IDLE_SECONDS = int(os.getenv('PG_KEEPALIVES_IDLE', '30'))
+KEEPALIVES_INTERVAL_SECONDS = int(os.getenv('PG_KEEPALIVES_INTERVAL', '10'))
+KEEPALIVES_COUNT = int(os.getenv('PG_KEEPALIVES_COUNT', '3'))
+STATEMENT_TIMEOUT_MS = int(os.getenv('PG_STATEMENT_TIMEOUT_MS', '30000'))
+
+# Primary connection pool, filled by open_pool at startup (until then every call connects)
+POOL_MIN_CONNECTIONS = int(os.getenv('PG_POOL_MIN', '2'))
+POOL_MAX_CONNECTIONS = int(os.getenv('PG_POOL_MAX', '10'))
+# Prepare the hot statements once per pooled connection (turn off behind a
+# transaction-mode pooler such as PgBouncer, where sessions are not kept)
+PREPARED_STATEMENTS = os.getenv('PG_PREPARED_STATEMENTS', '1') != '0'
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), 'schema.sql')
+# Cache preload scans this many of the newest rows per wanted user
+RECENT_ROWS_PER_USER = 10
+
+# Export/import
+EXPORT_FETCH_SIZE = 500
+IMPORT_PAGE_SIZE = 500
+
+# Write batching: upserts/deletes arriving within this window share one transaction (0 disables)
+WRITE_BATCH_WINDOW_MS = float(os.getenv('PG_WRITE_BATCH_MS', '3'))
+WRITE_BATCH_MAX = 500
+# A batch rolled back by a deadlock or serialization failure is retried this many times
+WRITE_RETRY_ATTEMPTS = 3
+WRITE_RETRY_BACKOFF_SECONDS = 0.05
+
+# Saving a value replaces its TTL too (expires_at NULL = keep forever)
+UPSERT_MANY_SQL = """
+    INSERT INTO user_data (user_id, key, value, expires_at)
+    VALUES %s
+    ON CONFLICT (user_id, key)
+    DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at, updated_at = CURRENT_TIMESTAMP
+"""
+UPSERT_MANY_TEMPLATE = "(%s, %s, %s, to_timestamp(%s))"
+
+# Version history pruning: keys are handled this many per transaction. Each run
+# looks at history written since the previous run (the first run of a process
+# looks back this far), re-reading a little before it for late commits.
+HISTORY_PRUNE_BATCH = 500
+HISTORY_PRUNE_LOOKBACK_SECONDS = 86400.0
+HISTORY_PRUNE_OVERLAP_SECONDS = 60.0
+HISTORY_PARTITION_CHECK_SECONDS = 3600.0
+# Creating a partition locks user_data_history; give up rather than queue writes behind it
+HISTORY_PARTITION_LOCK_TIMEOUT = '5s'
+
+HISTORY_PRUNE_SQL = """
+    DELETE FROM user_data_history h
+    USING (
+        SELECT id, replaced_at FROM (
+            SELECT id, replaced_at,
+                   row_number() OVER (PARTITION BY user_id, key ORDER BY replaced_at DESC, id DESC) AS version
+            FROM user_data_history
+            WHERE (user_id, key) IN (SELECT * FROM unnest(%s::bigint[], %s::varchar[]))
+        ) ranked
+        WHERE version > %s
+    ) old
+    WHERE h.id = old.id AND h.replaced_at = old.replaced_at
+"""
+
+# Expired rows stay until a sweep deletes them; every read treats them as absent
+LIVE_ROW_SQL = "(expires_at IS NULL OR expires_at > now())"
+
+# Due rows, earliest first, straight off the partial expires_at index. SKIP
+# LOCKED lets several bot processes sweep at once without waiting on each other.
+SWEEP_EXPIRED_SQL = """
+    DELETE FROM user_data
+    WHERE id IN (
+        SELECT id FROM user_data
+        WHERE expires_at <= now()
+        ORDER BY expires_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING user_id::text, key
+"""
+
+# Expired rows the sweeper has not deleted yet are still in the user_stats
+# counter but do not count against the quota. The partial expires_at index
+# holds only rows with a TTL, and due ones are swept within seconds, so this
+# reads a handful of index entries at most.
+UNSWEPT_COUNT_SQL = "SELECT COUNT(*) FROM user_data d WHERE d.user_id = s.user_id AND d.expires_at <= now()"
+
+# Single-row writes, only used when write batching is off (PG_WRITE_BATCH_MS=0)
+UPSERT_SQL = """
+    INSERT INTO user_data (user_id, key, value, expires_at) 
+    VALUES (%s, %s, %s, to_timestamp(%s))
+    ON CONFLICT (user_id, key) 
+    DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at, updated_at = CURRENT_TIMESTAMP
+"""
+DELETE_ONE_SQL = f"DELETE FROM user_data WHERE user_id = %s AND key = %s RETURNING {LIVE_ROW_SQL}"
+
+# Never prepared: the planner turns LIKE 'work/%' into a text_pattern_ops
+# index range only when it sees the pattern, which a generic plan does not
+SELECT_KEYS_PREFIX_SQL = f"SELECT key FROM user_data WHERE user_id = %s AND key LIKE %s AND {LIVE_ROW_SQL} ORDER BY key"
+DELETE_PREFIX_SQL = f"DELETE FROM user_data WHERE user_id = %s AND key LIKE %s RETURNING key, {LIVE_ROW_SQL}"
+
+# Statements run on every command, prepared per pooled connection (see prepared.py)
+HOT_STATEMENTS = {
+    'select_all': f"""
+        SELECT key, value, EXTRACT(EPOCH FROM expires_at)::float8 AS expires_at
+        FROM user_data WHERE user_id = %s AND {LIVE_ROW_SQL}
+    """,
+    'select_one': f"SELECT value FROM user_data WHERE user_id = %s AND key = %s AND {LIVE_ROW_SQL}",
+    'select_many': f"SELECT key, value FROM user_data WHERE user_id = %s AND key = ANY(%s) AND {LIVE_ROW_SQL}",
+    'select_keys': f"SELECT key FROM user_data WHERE user_id = %s AND {LIVE_ROW_SQL} ORDER BY key",
+    'delete_many': f"DELETE FROM user_data WHERE user_id = %s AND key = ANY(%s) RETURNING key, {LIVE_ROW_SQL}",
+    'item_count': f"SELECT item_count - ({UNSWEPT_COUNT_SQL}) FROM user_stats s WHERE user_id = %s",
+    'total_bytes': "SELECT total_bytes FROM user_stats WHERE user_id = %s",
+    'history': """
+        SELECT EXTRACT(EPOCH FROM replaced_at)::float8, value FROM user_data_history
+        WHERE user_id = %s AND key = %s
+        ORDER BY replaced_at DESC, id DESC
+        LIMIT %s
+    """,
+    'sweep_expired': SWEEP_EXPIRED_SQL,
+}
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class Replica:
+    """Connection settings, health state and connection pool of one read replica"""
+    
+    def __init__(self, connection_params: Dict[str, Any]):
+        self.connection_params = connection_params
+        self.down_until = 0.0
+        self.lag_seconds = 0.0
+        # Opened by the health check or the first read, and dropped by
+        # mark_down, so a replica that comes back is reconnected from scratch
+        self.pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+        self._pool_lock = threading.Lock()
+    
+    @property
+    def name(self) -> str:
+        return f"{self.connection_params['host']}:{self.connection_params['port']}"
+    
+    def is_available(self) -> bool:
+        return time.monotonic() >= self.down_until and self.lag_seconds <= READ_YOUR_WRITES_SECONDS
+    
+    def mark_down(self):
+        self.down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+        self.close_pool()
+    
+    def close_pool(self):
+        with self._pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.closeall()
+    
+    def open_pool(self) -> psycopg2.pool.ThreadedConnectionPool:
+        with self._pool_lock:
+            if self.pool is None:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    REPLICA_POOL_MIN_CONNECTIONS, REPLICA_POOL_MAX_CONNECTIONS, **self.connection_params
+                )
+            return self.pool
+    
+    def getconn(self) -> Tuple[Any, Optional[psycopg2.pool.ThreadedConnectionPool]]:
+        """A pooled connection and its pool, or a one-off connection and None when the pool is exhausted"""
+        pool = self.open_pool()
+        try:
+            return pool.getconn(), pool
+        except psycopg2.pool.PoolError:
+            return psycopg2.connect(**self.connection_params), None
+
+
+class DatabaseUnavailable(Exception):
+    """Raised instead of connecting while the primary's circuit breaker is open"""
+
+
+# Statement-level failures from a live server; the statement can simply be run again
+TRANSIENT_ERRORS = (psycopg2.extensions.TransactionRollbackError, psycopg2.errors.QueryCanceled)
+
+# SQLSTATEs of a server that is going away: connection exceptions (class 08) and shutdowns
+CONNECTION_SQLSTATE_PREFIXES = ('08', '57P')
+
+
+def is_connection_error(error: BaseException, conn=None) -> bool:
+    """True when error means the server is unreachable, as opposed to a failed statement
+    
+    OperationalError also covers deadlocks, serialization failures and
+    cancelled statements, which come with a SQLSTATE from a live server;
+    errors raised by libpq itself (refused, reset, timed out) have none.
+    """
+    if isinstance(error, (DatabaseUnavailable, psycopg2.InterfaceError)):
+        return True
+    if not isinstance(error, psycopg2.OperationalError) or isinstance(error, TRANSIENT_ERRORS):
+        return False
+    if conn is not None and conn.closed:
+        return True
+    return error.pgcode is None or error.pgcode.startswith(CONNECTION_SQLSTATE_PREFIXES)
+
+
+class CircuitBreaker:
+    """Stop dialing the primary after repeated connect failures
+    
+    closed: every call connects. open: calls fail fast with
+    DatabaseUnavailable. After reset_seconds the breaker goes half-open and
+    lets a single probe through; its outcome closes or reopens the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+    
+    @property
+    def is_closed(self) -> bool:
+        return self.state == self.CLOSED
+    
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+    
+    def record_success(self) -> bool:
+        """Returns True if this closed an open or half-open breaker"""
+        with self._lock:
+            reopened = self.state != self.CLOSED
+            if reopened:
+                logger.info("Primary database reachable again, closing circuit breaker")
+            self.state = self.CLOSED
+            self.failures = 0
+            return reopened
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state == self.CLOSED:
+                    logger.warning(f"Primary database failed {self.failures} times, opening circuit breaker")
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class WriteOp:
+    """One queued set/delete and the future its caller waits on"""
+    __slots__ = ('kind', 'user_id', 'key', 'value', 'expires_at', 'future')
+    
+    def __init__(self, kind: str, user_id: str, key: str, value: Optional[str] = None,
+                 expires_at: Optional[float] = None):
+        self.kind = kind  # 'set' or 'delete'
+        self.user_id = user_id
+        self.key = key
+        self.value = value
+        self.expires_at = expires_at  # epoch seconds, sets only
+        self.future: Future = Future()
+    
+    def visible_value(self, now: float) -> Optional[str]:
+        """What a read sees after this op: the value, or None for a delete or an expired set"""
+        if self.kind != 'set' or (self.expires_at is not None and self.expires_at <= now):
+            return None
+        return self.value
+
+
+class UserEntries(dict):
+    """One user's {key: value}, plus when the earliest of them expires (None = never)"""
+    __slots__ = ('next_expiry',)
+    
+    def __init__(self, *args, next_expiry: Optional[float] = None):
+        super().__init__(*args)
+        self.next_expiry = next_expiry
+    
+    def note_expiry(self, expires_at: Optional[float]):
+        if expires_at is not None and (self.next_expiry is None or expires_at < self.next_expiry):
+            self.next_expiry = expires_at
+
+
+def plan_write_batch(ops: List[WriteOp]) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str, str, Optional[float]]]]:
+    """Reduce a batch to the rows to delete and the final upserts
+    
+    Each (user_id, key) is upserted at most once (ON CONFLICT cannot touch a
+    row twice in one statement). Keys whose first op is a delete are always
+    deleted first, so RETURNING tells whether the row existed before the batch.
+    """
+    first_kind: Dict[Tuple[str, str], str] = {}
+    final: Dict[Tuple[str, str], Optional[WriteOp]] = {}
+    for op in ops:
+        row = (op.user_id, op.key)
+        first_kind.setdefault(row, op.kind)
+        final[row] = op if op.kind == 'set' else None
+    # Sorted so concurrent batches lock rows in the same order and cannot deadlock each other
+    deletes = sorted(row for row, op in final.items() if op is None or first_kind[row] == 'delete')
+    upserts = sorted((user_id, key, op.value, op.expires_at) for (user_id, key), op in final.items() if op is not None)
+    return deletes, upserts
+
+
+def resolve_write_batch(ops: List[WriteOp], existed: Set[Tuple[str, str]]):
+    """Give every op the result it would have had if run on its own, in order"""
+    present: Dict[Tuple[str, str], bool] = {}
+    for op in ops:
+        row = (op.user_id, op.key)
+        if op.kind == 'set':
+            present[row] = True
+            op.future.set_result(True)
+        else:
+            op.future.set_result(present.get(row, row in existed))
+            present[row] = False
+
+
+class WriteBehindQueue:
+    """Durable FIFO of writes accepted while the primary is unreachable
+    
+    Each entry is appended to an NDJSON file and fsynced before the write is
+    acknowledged, so queued writes survive a restart. The newest queued value
+    per key is kept in memory so reads can see writes that are not replayed yet.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        # Held across replay so new writes cannot overtake queued ones
+        self.lock = threading.RLock()
+        self._ops: List[WriteOp] = []
+        # Newest queued op per (user, key)
+        self._pending: Dict[str, Dict[str, WriteOp]] = {}
+        self._load()
+    
+    def __len__(self) -> int:
+        return len(self._ops)
+    
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self._remember(WriteOp(entry['kind'], entry['user_id'], entry['key'], entry.get('value'),
+                                           entry.get('expires_at')))
+                except (ValueError, KeyError, TypeError):
+                    # A crash mid-append leaves at most one torn line at the end
+                    logger.warning(f"Skipping unreadable write-behind entry in {self.path}: {line!r}")
+        if self._ops:
+            logger.info(f"Loaded {len(self._ops)} queued writes from {self.path}")
+    
+    def _remember(self, op: WriteOp):
+        self._ops.append(op)
+        self._pending.setdefault(op.user_id, {})[op.key] = op
+    
+    def append(self, ops: List[WriteOp]):
+        lines = ''.join(
+            json.dumps({'kind': op.kind, 'user_id': op.user_id, 'key': op.key, 'value': op.value,
+                        'expires_at': op.expires_at}, ensure_ascii=False) + "\n"
+            for op in ops
+        )
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            for op in ops:
+                self._remember(op)
+    
+    def ops(self) -> List[WriteOp]:
+        with self.lock:
+            return list(self._ops)
+    
+    def pending(self, user_id: str, key: str) -> Tuple[bool, Optional[str]]:
+        """(True, value) if key has a queued write; value None means a queued delete (or an expired set)"""
+        with self.lock:
+            op = self._pending.get(user_id, {}).get(key)
+        return (True, op.visible_value(time.time())) if op else (False, None)
+    
+    def pending_for_user(self, user_id: str) -> Dict[str, Optional[str]]:
+        now = time.time()
+        with self.lock:
+            return {key: op.visible_value(now) for key, op in self._pending.get(user_id, {}).items()}
+    
+    def next_expiry(self, user_id: str) -> Optional[float]:
+        """Earliest expiry among the user's queued sets"""
+        with self.lock:
+            expiries = [op.expires_at for op in self._pending.get(user_id, {}).values()
+                        if op.kind == 'set' and op.expires_at is not None]
+        return min(expiries, default=None)
+    
+    def clear(self, keep_as: Optional[str] = None):
+        """Drop every entry; keep_as moves the file aside instead of deleting it"""
+        with self.lock:
+            if os.path.exists(self.path):
+                if keep_as:
+                    os.replace(self.path, keep_as)
+                else:
+                    os.remove(self.path)
+            self._ops = []
+            self._pending = {}
+
+
+def like_prefix(prefix: str) -> str:
+    """LIKE pattern for names starting with prefix ("_" is a LIKE wildcard and valid in names)"""
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def apply_pending(data: Dict[str, str], pending: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """Overlay queued writes on rows read from the database"""
+    for key, value in pending.items():
+        if value is None:
+            data.pop(key, None)
+        else:
+            data[key] = value
+    return data
+
+
+class WriteBatcher:
+    """Collect writes for a few milliseconds and hand them to apply_batch together"""
+    
+    def __init__(self, apply_batch: Callable[[List[WriteOp]], None], window_seconds: float, max_batch: int = WRITE_BATCH_MAX):
+        self.apply_batch = apply_batch
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._pending: List[WriteOp] = []
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+    
+    def submit(self, op: WriteOp) -> Future:
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vault-write-batcher', daemon=True)
+                self._thread.start()
+            self._pending.append(op)
+            self._condition.notify()
+        return op.future
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            # Let concurrent writers join the batch
+            time.sleep(self.window_seconds)
+            with self._condition:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            try:
+                self.apply_batch(batch)
+            except Exception as e:
+                logger.error(f"Error applying write batch: {e}")
+            finally:
+                for op in batch:
+                    if not op.future.done():
+                        op.future.set_result(False)
+
+
 class DatabaseManager:
     def __init__(self):
         self.connection_params = {
@@ -15,6 +509,12 @@ class DatabaseManager:
             'database': os.getenv('PGDATABASE'),
             'user': os.getenv('PGUSER'),
             'password': os.getenv('PGPASSWORD'),
+            'connect_timeout': CONNECT_TIMEOUT_SECONDS,
+            'keepalives': 1,
+            'keepalives_idle': KEEPALIVES_IDLE_SECONDS,
+            'keepalives_interval': KEEPALIVES_INTERVAL_SECONDS,
+            'keepalives_count': KEEPALIVES_COUNT,
+            'options': f'-c statement_timeout={STATEMENT_TIMEOUT_MS}',
         }
         
         # Check if all required environment variables are set
@@ -22,95 +522,780 @@ class DatabaseManager:
         missing_vars = [var for var in required_vars if not os.getenv(var)]
         if missing_vars:
             raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
+        
+        # Optional read replicas: PGHOST_REPLICA=host1[:port],host2[:port]
+        default_replica_port = os.getenv('PGPORT_REPLICA', self.connection_params['port'])
+        self.replicas: List[Replica] = []
+        for entry in os.getenv('PGHOST_REPLICA', '').split(','):
+            if not entry.strip():
+                continue
+            host, _, port = entry.strip().partition(':')
+            self.replicas.append(Replica({**self.connection_params, 'host': host, 'port': port or default_replica_port}))
+        self._replica_cursor = itertools.count()
+        self._recent_writes: Dict[str, float] = {}
+        self._all_reads_on_primary_until = 0.0
+        self._routing_lock = threading.Lock()
+        if self.replicas:
+            threading.Thread(target=self._replica_health_loop, name='vault-replica-health', daemon=True).start()
+        
+        # Fail fast while the primary is down; writes go to write_behind if enabled
+        self.breaker = CircuitBreaker()
+        self.write_behind: Optional[WriteBehindQueue] = None
+        self._recovery_thread: Optional[threading.Thread] = None
+        self._recovery_wake = threading.Event()
+        # History pruning progress (see prune_history)
+        self._history_pruned_until: Optional[float] = None
+        self._history_partitions_checked = float('-inf')
+        
+        self._write_batcher = (
+            WriteBatcher(self._apply_write_batch, WRITE_BATCH_WINDOW_MS / 1000.0)
+            if WRITE_BATCH_WINDOW_MS > 0 else None
+        )
+        
+        self._pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+        self.statements = StatementRegistry(HOT_STATEMENTS, enabled=PREPARED_STATEMENTS)
+        
+        # Change feed state (see start_change_listener)
+        self.change_feed_active = False
+        self.change_feed_ready = threading.Event()
+        self._listener_thread: Optional[threading.Thread] = None
+        self._listener_stop = threading.Event()
+    
+    @property
+    def degraded(self) -> bool:
+        """True while the primary is unreachable or queued writes are waiting for replay"""
+        return not self.breaker.is_closed or bool(self.write_behind)
+    
+    def note_write(self, user_id: Optional[str] = None):
+        """Keep reads for user_id (None = all users) on the primary for a short window"""
+        deadline = time.monotonic() + READ_YOUR_WRITES_SECONDS
+        with self._routing_lock:
+            if user_id is None:
+                self._all_reads_on_primary_until = deadline
+                self._recent_writes.clear()
+                return
+            self._recent_writes[user_id] = deadline
+            if len(self._recent_writes) > RECENT_WRITES_PRUNE_SIZE:
+                now = time.monotonic()
+                self._recent_writes = {uid: t for uid, t in self._recent_writes.items() if t > now}
+    
+    def _reads_pinned_to_primary(self, user_id: Optional[str]) -> bool:
+        now = time.monotonic()
+        with self._routing_lock:
+            if now < self._all_reads_on_primary_until:
+                return True
+            return user_id is not None and self._recent_writes.get(user_id, 0.0) > now
+    
+    def _replica_order(self) -> List[Replica]:
+        """Available replicas, rotated round-robin"""
+        with self._routing_lock:
+            start = next(self._replica_cursor) % len(self.replicas)
+        rotated = self.replicas[start:] + self.replicas[:start]
+        return [replica for replica in rotated if replica.is_available()]
+    
+    def _connect(self, read_only: bool, user_id: Optional[str]) -> Tuple[Any, Optional[psycopg2.pool.ThreadedConnectionPool], bool]:
+        """Returns (connection, the pool it came from or None for a one-off connection, whether it is the primary)"""
+        # With the primary down, a possibly stale replica beats no answer at all
+        if read_only and self.replicas and (not self.breaker.is_closed or not self._reads_pinned_to_primary(user_id)):
+            for replica in self._replica_order():
+                try:
+                    conn, pool = replica.getconn()
+                    if pool is not None:
+                        self.statements.track(conn)
+                    return conn, pool, False
+                except psycopg2.OperationalError as e:
+                    logger.warning(f"Replica {replica.name} unavailable, skipping for {REPLICA_RETRY_SECONDS:.0f}s: {e}")
+                    replica.mark_down()
+        if not self.breaker.allow():
+            raise DatabaseUnavailable("primary database circuit breaker is open")
+        pool = self._pool
+        try:
+            if pool is not None:
+                try:
+                    conn = pool.getconn()
+                    self.statements.track(conn)
+                except psycopg2.pool.PoolError:
+                    # Every pooled connection is busy; use a one-off connection
+                    conn, pool = psycopg2.connect(**self.connection_params), None
+            else:
+                conn = psycopg2.connect(**self.connection_params)
+        except psycopg2.OperationalError:
+            self.breaker.record_failure()
+            raise
+        # Success is recorded by get_connection once the caller's statements got an answer
+        return conn, pool, True
+    
+    def open_pool(self) -> bool:
+        """Open the primary connection pool, connecting PG_POOL_MIN connections up front"""
+        if self._pool is not None:
+            return True
+        try:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **self.connection_params
+            )
+            logger.info(f"Opened connection pool ({POOL_MIN_CONNECTIONS}-{POOL_MAX_CONNECTIONS} connections)")
+            return True
+        except psycopg2.OperationalError as e:
+            self.breaker.record_failure()
+            logger.error(f"Could not open connection pool: {e}")
+            return False
+    
+    def close_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.closeall()
+        for replica in self.replicas:
+            replica.close_pool()
+    
+    def check_replicas(self):
+        """Probe every replica for reachability and replication lag"""
+        for replica in self.replicas:
+            conn = None
+            try:
+                conn = psycopg2.connect(**replica.connection_params)
+                with conn.cursor() as cursor:
+                    cursor.execute(REPLICA_LAG_SQL)
+                    replica.lag_seconds = float(cursor.fetchone()[0])
+                replica.down_until = 0.0
+                replica.open_pool()  # Connect off the request path
+                if replica.lag_seconds > READ_YOUR_WRITES_SECONDS:
+                    logger.warning(f"Replica {replica.name} is {replica.lag_seconds:.1f}s behind, routing reads to primary")
+            except Exception as e:
+                logger.warning(f"Replica health check failed for {replica.name}: {e}")
+                replica.mark_down()
+            finally:
+                if conn:
+                    conn.close()
+    
+    def _replica_health_loop(self):
+        while True:
+            self.check_replicas()
+            time.sleep(REPLICA_HEALTH_CHECK_SECONDS)
     
     @contextmanager
-    def get_connection(self):
-        """Context manager for database connections"""
+    def get_connection(self, read_only: bool = False, user_id: Optional[str] = None):
+        """Context manager for database connections
+        
+        read_only connections go to a healthy replica when one is configured,
+        unless user_id wrote recently (read-your-writes).
+        """
         conn = None
+        pool = None
+        primary = False
+        broken = False
         try:
-            conn = psycopg2.connect(**self.connection_params)
+            conn, pool, primary = self._connect(read_only, user_id)
             yield conn
+        except DatabaseUnavailable:
+            raise
         except Exception as e:
+            broken = is_connection_error(e, conn)
             if conn:
-                conn.rollback()
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True  # The connection itself is gone
             logger.error(f"Database error: {e}")
             raise
         finally:
             if conn:
-                conn.close()
+                if pool is not None:
+                    try:
+                        # The pool rolls back anything left open; broken connections are dropped
+                        pool.putconn(conn, close=broken or bool(conn.closed))
+                    except psycopg2.pool.PoolError:
+                        conn.close()  # The pool was closed meanwhile (close_pool, replica marked down)
+                else:
+                    conn.close()
+            if primary:
+                # A failed statement or its rollback still got an answer from the server
+                if broken:
+                    self.breaker.record_failure()
+                elif self.breaker.record_success() and self.write_behind:
+                    self._recovery_wake.set()
     
     def initialize_schema(self):
         """Initialize the database schema"""
-        schema_file = os.path.join(os.path.dirname(__file__), 'schema.sql')
-        with open(schema_file, 'r', encoding='utf-8') as f:
+        with open(SCHEMA_FILE, 'r', encoding='utf-8') as f:
             schema_sql = f.read()
         
         with self.get_connection() as conn:
             with conn.cursor() as cursor:
+                # Index builds and trigger changes may take longer than a query should
+                cursor.execute("SET LOCAL statement_timeout = 0")
                 cursor.execute(schema_sql)
+                self._record_schema_hash(cursor, schema_sql)
                 conn.commit()
+                self.statements.invalidate()
                 logger.info("Database schema initialized successfully")
     
-    def set_user_data(self, user_id: str, key: str, value: str) -> bool:
-        """Set user data (upsert operation)"""
+    @staticmethod
+    def _schema_hash(schema_sql: str) -> str:
+        return hashlib.sha256(schema_sql.encode('utf-8')).hexdigest()
+    
+    def _record_schema_hash(self, cursor, schema_sql: str):
+        cursor.execute("""
+            INSERT INTO schema_version (id, schema_hash) VALUES (1, %s)
+            ON CONFLICT (id) DO UPDATE SET schema_hash = EXCLUDED.schema_hash, applied_at = CURRENT_TIMESTAMP
+        """, (self._schema_hash(schema_sql),))
+    
+    def ensure_schema(self) -> bool:
+        """Apply schema.sql only if the database was not set up from this exact file
+        
+        Re-running the schema recreates triggers, which locks user_data, so a
+        restart with an unchanged schema.sql just compares hashes, and only
+        creates the history partitions of the coming months. Returns True if
+        the schema was applied.
+        """
+        with open(SCHEMA_FILE, 'r', encoding='utf-8') as f:
+            schema_sql = f.read()
+        current = False
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+                if cursor.fetchone()[0]:
+                    cursor.execute("SELECT schema_hash FROM schema_version WHERE id = 1")
+                    row = cursor.fetchone()
+                    current = bool(row) and row[0] == self._schema_hash(schema_sql)
+            conn.commit()
+        if current:
+            self.create_history_partitions()
+            return False
+        self.initialize_schema()
+        return True
+    
+    def load_recent_users(self, limit: int) -> Dict[str, UserEntries]:
+        """All data of the limit users who wrote most recently, oldest writer first
+        
+        Walks the updated_at index from the newest row instead of aggregating
+        the whole table; used to preload caches at startup.
+        """
+        if limit <= 0:
+            return {}
+        try:
+            with self.get_connection(read_only=True) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"""
+                        SELECT d.user_id::text, d.key, d.value, EXTRACT(EPOCH FROM d.expires_at)::float8
+                        FROM (
+                            SELECT user_id, MAX(updated_at) AS last_write
+                            FROM (SELECT user_id, updated_at FROM user_data ORDER BY updated_at DESC LIMIT %s) newest
+                            GROUP BY user_id ORDER BY last_write DESC LIMIT %s
+                        ) recent
+                        JOIN user_data d ON d.user_id = recent.user_id AND {LIVE_ROW_SQL.replace('expires_at', 'd.expires_at')}
+                        ORDER BY recent.last_write, d.key
+                    """, (limit * RECENT_ROWS_PER_USER, limit))
+                    users: Dict[str, UserEntries] = {}
+                    for user_id, key, value, expires_at in cursor.fetchall():
+                        entries = users.setdefault(user_id, UserEntries())
+                        entries[key] = value
+                        entries.note_expiry(expires_at)
+                    return users
+        except Exception as e:
+            logger.error(f"Error loading recently active users: {e}")
+            return {}
+    
+    def _apply_write_batch(self, ops: List[WriteOp]):
+        """Apply a batch as one multi-row DELETE and one multi-row upsert in a single transaction"""
+        if self._queue_writes(ops):
+            return
+        try:
+            existed = self._write_ops(ops)
+        except Exception as e:
+            if not is_connection_error(e) or not self._queue_writes(ops, force=True):
+                raise
+            return
+        for user_id in {op.user_id for op in ops}:
+            self.note_write(user_id)
+        resolve_write_batch(ops, existed)
+    
+    def _write_ops(self, ops: List[WriteOp]) -> Set[Tuple[str, str]]:
+        """Write ops in one transaction; returns the deleted rows that existed
+        
+        Concurrent batches from several processes can deadlock each other;
+        the loser's transaction is rolled back, so it is simply run again.
+        """
+        deletes, upserts = plan_write_batch(ops)
+        for attempt in range(1, WRITE_RETRY_ATTEMPTS + 1):
+            try:
+                return self._write_rows(deletes, upserts)
+            except psycopg2.extensions.TransactionRollbackError as e:
+                if attempt == WRITE_RETRY_ATTEMPTS:
+                    raise
+                logger.warning(f"Write batch rolled back ({e.pgcode}), retrying (attempt {attempt})")
+                time.sleep(WRITE_RETRY_BACKOFF_SECONDS * attempt)
+    
+    def _write_rows(self, deletes: List[Tuple[str, str]], upserts: List[Tuple[str, str, str, Optional[float]]]) -> Set[Tuple[str, str]]:
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                existed: Set[Tuple[str, str]] = set()
+                if deletes:
+                    cursor.execute(
+                        f"DELETE FROM user_data WHERE (user_id, key) IN %s RETURNING user_id::text, key, {LIVE_ROW_SQL}",
+                        (tuple(deletes),)
+                    )
+                    # A row that had expired was already gone as far as readers could tell
+                    existed = {(user_id, key) for user_id, key, live in cursor.fetchall() if live}
+                if upserts:
+                    psycopg2.extras.execute_values(cursor, UPSERT_MANY_SQL, upserts,
+                                                   template=UPSERT_MANY_TEMPLATE, page_size=WRITE_BATCH_MAX)
+                conn.commit()
+        return existed
+    
+    def enable_write_behind(self, path: str):
+        """Queue writes in a local file while the primary is unreachable
+        
+        Writes left over from a previous run are replayed right away when the
+        primary is reachable, otherwise by the background recovery thread.
+        """
+        self.write_behind = WriteBehindQueue(path)
+        if self.write_behind:
+            self.replay_write_behind()
+        if self._recovery_thread is None:
+            self._recovery_thread = threading.Thread(target=self._recovery_loop, name='vault-write-behind', daemon=True)
+            self._recovery_thread.start()
+    
+    def _queue_writes(self, ops: List[WriteOp], force: bool = False) -> bool:
+        """Append ops to the write-behind queue when the primary should not be written directly
+        
+        Queued sets and deletes are acknowledged as successful. Returns False
+        (nothing queued) when write-behind is off, or when the breaker is
+        closed and nothing is waiting for replay, unless force is set.
+        """
+        if self.write_behind is None:
+            return False
+        with self.write_behind.lock:
+            if not force and self.breaker.is_closed and not self.write_behind:
+                return False
+            self.write_behind.append(ops)
+        for op in ops:
+            if not op.future.done():
+                op.future.set_result(True)
+        return True
+    
+    def replay_write_behind(self) -> int:
+        """Apply queued writes, in order, in one transaction; returns how many were replayed"""
+        queue = self.write_behind
+        if queue is None:
+            return 0
+        with queue.lock:
+            ops = queue.ops()
+            if not ops:
+                return 0
+            try:
+                # Last write per key wins, which is what replaying one by one would leave behind
+                self._write_ops(ops)
+            except Exception as e:
+                if is_connection_error(e) or isinstance(e, TRANSIENT_ERRORS):
+                    logger.warning(f"Write-behind replay deferred, {len(ops)} writes still queued: {e}")
+                    return 0
+                # A write the database rejects would block every later write; set it aside
+                failed_path = f"{queue.path}.failed-{int(time.time())}"
+                logger.error(f"Write-behind replay failed, moved {len(ops)} writes to {failed_path}: {e}")
+                queue.clear(keep_as=failed_path)
+                return 0
+            queue.clear()
+        for user_id in {op.user_id for op in ops}:
+            self.note_write(user_id)
+        logger.info(f"Replayed {len(ops)} queued writes")
+        return len(ops)
+    
+    def _recovery_loop(self):
+        # Woken as soon as the breaker closes; the timeout doubles as a probe while it is open
+        while True:
+            self._recovery_wake.wait(BREAKER_RESET_SECONDS)
+            self._recovery_wake.clear()
+            if self.write_behind:
+                self.replay_write_behind()
+    
+    def set_user_data(self, user_id: str, key: str, value: str, expires_at: Optional[float] = None) -> bool:
+        """Set user data (upsert operation); expires_at (epoch seconds) gives it a TTL"""
+        op = WriteOp('set', user_id, key, value, expires_at)
+        if self._queue_writes([op]):
+            return True
+        if self._write_batcher:
+            return self._write_batcher.submit(op).result()
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO user_data (user_id, key, value) 
-                        VALUES (%s, %s, %s)
-                        ON CONFLICT (user_id, key) 
-                        DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
-                    """, (user_id, key, value))
+                    cursor.execute(UPSERT_SQL, (user_id, key, value, expires_at))
                     conn.commit()
+                    self.note_write(user_id)
                     return True
         except Exception as e:
+            if is_connection_error(e) and self._queue_writes([op], force=True):
+                return True
             logger.error(f"Error setting user data: {e}")
             return False
     
     def get_user_data(self, user_id: str, key: Optional[str] = None) -> Optional[Any]:
-        """Get user data"""
+        """Get user data, including writes still waiting in the write-behind queue"""
+        if key is not None and self.write_behind:
+            queued, value = self.write_behind.pending(user_id, key)
+            if queued:
+                return value
         try:
-            with self.get_connection() as conn:
+            with self.get_connection(read_only=True, user_id=user_id) as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                     if key is None:
-                        # Get all data for user
-                        cursor.execute("SELECT key, value FROM user_data WHERE user_id = %s", (user_id,))
+                        # Get all data for user; callers caching it must drop it by next_expiry
+                        self.statements.execute(cursor, 'select_all', (user_id,))
                         rows = cursor.fetchall()
-                        if not rows:
-                            return None
-                        return {row['key']: row['value'] for row in rows}
+                        data = UserEntries((row['key'], row['value']) for row in rows)
+                        for row in rows:
+                            data.note_expiry(row['expires_at'])
+                        if self.write_behind:
+                            apply_pending(data, self.write_behind.pending_for_user(user_id))
+                            data.note_expiry(self.write_behind.next_expiry(user_id))
+                        return data or None
                     else:
                         # Get specific key for user
-                        cursor.execute("SELECT value FROM user_data WHERE user_id = %s AND key = %s", (user_id, key))
+                        self.statements.execute(cursor, 'select_one', (user_id, key))
                         row = cursor.fetchone()
                         return row['value'] if row else None
         except Exception as e:
             logger.error(f"Error getting user data: {e}")
             return None
     
+    def get_user_data_many(self, user_id: str, keys: List[str]) -> Optional[Dict[str, str]]:
+        """Get several entries in one query, in the order asked for
+        
+        Names that do not exist are left out; returns None on error.
+        """
+        pending = self.write_behind.pending_for_user(user_id) if self.write_behind else {}
+        wanted = [key for key in keys if key not in pending]
+        found: Dict[str, str] = {}
+        if wanted:
+            try:
+                with self.get_connection(read_only=True, user_id=user_id) as conn:
+                    with conn.cursor() as cursor:
+                        self.statements.execute(cursor, 'select_many', (user_id, wanted))
+                        found = dict(cursor.fetchall())
+            except Exception as e:
+                logger.error(f"Error getting user data: {e}")
+                return None
+        apply_pending(found, {key: value for key, value in pending.items() if key in keys})
+        return {key: found[key] for key in keys if key in found}
+    
+    def iter_user_data(self, user_id: str) -> Iterator[Tuple[str, str, Optional[float]]]:
+        """Stream a user's (key, value, expires_at epoch) rows through a server-side cursor
+        
+        Unlike the other methods, errors are raised to the caller, since a
+        partially consumed stream cannot be turned into a return value.
+        """
+        with self.get_connection(read_only=True, user_id=user_id) as conn:
+            with conn.cursor(name='vault_export') as cursor:
+                cursor.itersize = EXPORT_FETCH_SIZE
+                cursor.execute(f"""
+                    SELECT key, value, EXTRACT(EPOCH FROM expires_at)::float8 FROM user_data
+                    WHERE user_id = %s AND {LIVE_ROW_SQL} ORDER BY key
+                """, (user_id,))
+                for key, value, expires_at in cursor:
+                    yield key, value, expires_at
+    
+    def import_user_data(self, user_id: str, items: Dict[str, str], max_items: int,
+                         expiries: Optional[Dict[str, float]] = None) -> Optional[int]:
+        """Upsert many entries in one transaction, enforcing the per-user item limit
+        
+        expiries gives entries a TTL (epoch seconds by name); the rest keep none.
+        Returns the number of entries written, or None on error or when the
+        import would exceed max_items (nothing is written in that case).
+        """
+        if not items:
+            return 0
+        expiries = expiries or {}
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    # Lock the user's counter row until commit, so concurrent imports of the same
+                    # user check the quota one after another. Single saves do not take this lock:
+                    # one that passed its own check before this import can still land after it
+                    cursor.execute("INSERT INTO user_stats (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (user_id,))
+                    cursor.execute(f"SELECT item_count - ({UNSWEPT_COUNT_SQL}) FROM user_stats s WHERE user_id = %s FOR UPDATE",
+                                   (user_id,))
+                    current_count = cursor.fetchone()[0]
+                    cursor.execute(
+                        f"SELECT COUNT(*) FROM user_data WHERE user_id = %s AND key = ANY(%s) AND {LIVE_ROW_SQL}",
+                        (user_id, list(items))
+                    )
+                    new_count = len(items) - cursor.fetchone()[0]
+                    if current_count + new_count > max_items:
+                        conn.rollback()
+                        logger.warning(f"Import rejected: {current_count} + {new_count} entries exceeds limit {max_items}")
+                        return None
+                    
+                    psycopg2.extras.execute_values(
+                        cursor, UPSERT_MANY_SQL,
+                        [(user_id, key, value, expiries.get(key)) for key, value in items.items()],
+                        template=UPSERT_MANY_TEMPLATE, page_size=IMPORT_PAGE_SIZE
+                    )
+                    conn.commit()
+                    self.note_write(user_id)
+                    return len(items)
+        except Exception as e:
+            logger.error(f"Error importing user data: {e}")
+            return None
+    
+    def _select_keys(self, user_id: str, prefix: Optional[str]) -> List[str]:
+        """A user's data names, overlaid with queued writes; raises on error
+        
+        With a prefix, LIKE 'prefix%' is a range scan on the (user_id, key
+        text_pattern_ops) index; without one, an index-only scan on the
+        (user_id, key) index.
+        """
+        with self.get_connection(read_only=True, user_id=user_id) as conn:
+            with conn.cursor() as cursor:
+                if prefix is None:
+                    self.statements.execute(cursor, 'select_keys', (user_id,))
+                else:
+                    cursor.execute(SELECT_KEYS_PREFIX_SQL, (user_id, like_prefix(prefix)))
+                keys = [row[0] for row in cursor.fetchall()]
+        if self.write_behind:
+            pending = self.write_behind.pending_for_user(user_id)
+            if prefix is not None:
+                pending = {key: value for key, value in pending.items() if key.startswith(prefix)}
+            if pending:
+                keys = sorted(apply_pending(dict.fromkeys(keys, ''), pending))
+        return keys
+    
+    def list_user_keys(self, user_id: str, prefix: Optional[str] = None) -> List[str]:
+        """List a user's data names, optionally only those starting with prefix"""
+        try:
+            return self._select_keys(user_id, prefix)
+        except Exception as e:
+            logger.error(f"Error listing user data keys: {e}")
+            return []
+    
     def delete_user_data(self, user_id: str, key: str) -> bool:
-        """Delete specific user data"""
+        """Delete specific user data (a queued delete reports success)"""
+        op = WriteOp('delete', user_id, key)
+        if self._queue_writes([op]):
+            return True
+        if self._write_batcher:
+            return self._write_batcher.submit(op).result()
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("DELETE FROM user_data WHERE user_id = %s AND key = %s", (user_id, key))
-                    affected_rows = cursor.rowcount
+                    cursor.execute(DELETE_ONE_SQL, (user_id, key))
+                    row = cursor.fetchone()
                     conn.commit()
-                    return affected_rows > 0
+                    self.note_write(user_id)
+                    # Deleting an expired, not yet swept row does not count as finding it
+                    return bool(row and row[0])
         except Exception as e:
+            if is_connection_error(e) and self._queue_writes([op], force=True):
+                return True
             logger.error(f"Error deleting user data: {e}")
             return False
     
-    def get_user_data_count(self, user_id: str) -> int:
-        """Get count of user data entries"""
+    def delete_user_data_many(self, user_id: str, keys: List[str]) -> Optional[List[str]]:
+        """Delete several entries with one statement; returns the names that existed
+        
+        Returns None on error. Deletes queued while the primary is down are
+        all reported as deleted.
+        """
+        ops = [WriteOp('delete', user_id, key) for key in keys]
+        if self._queue_writes(ops):
+            return list(keys)
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    self.statements.execute(cursor, 'delete_many', (user_id, list(keys)))
+                    deleted = {key for key, live in cursor.fetchall() if live}
+                    conn.commit()
+            self.note_write(user_id)
+            return [key for key in keys if key in deleted]
+        except Exception as e:
+            if is_connection_error(e) and self._queue_writes(ops, force=True):
+                return list(keys)
+            logger.error(f"Error deleting user data: {e}")
+            return None
+    
+    def delete_user_data_prefix(self, user_id: str, prefix: str) -> Optional[List[str]]:
+        """Delete every entry whose name starts with prefix; returns the deleted names
+        
+        One DELETE over the same index range as list_user_keys(prefix).
+        While writes are being queued, the names are resolved first (reads
+        still work through a replica) and their deletes are queued like
+        delete_user_data_many. Returns None on error.
+        """
         try:
+            if self.degraded:
+                keys = self._select_keys(user_id, prefix)
+                return self.delete_user_data_many(user_id, keys) if keys else []
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute("SELECT COUNT(*) FROM user_data WHERE user_id = %s", (user_id,))
-                    return cursor.fetchone()[0]
+                    cursor.execute(DELETE_PREFIX_SQL, (user_id, like_prefix(prefix)))
+                    deleted = sorted(key for key, live in cursor.fetchall() if live)
+                    conn.commit()
+            self.note_write(user_id)
+            return deleted
         except Exception as e:
-            logger.error(f"Error getting user data count: {e}")
+            logger.error(f"Error deleting user data by prefix: {e}")
+            return None
+    
+    def sweep_expired(self, limit: int) -> Optional[List[Tuple[str, str]]]:
+        """Delete up to limit expired rows, earliest first; returns their (user_id, key)
+        
+        The delete triggers keep user_stats, tombstones and the change feed in
+        step as for any other delete. Returns None on error.
+        """
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    self.statements.execute(cursor, 'sweep_expired', (limit,))
+                    swept = cursor.fetchall()
+                    conn.commit()
+            return [(user_id, key) for user_id, key in swept]
+        except Exception as e:
+            logger.error(f"Error sweeping expired user data: {e}")
+            return None
+    
+    def upcoming_expiries(self, until: float, limit: int) -> List[float]:
+        """The earliest expiry times (epoch seconds) up to until, read from the partial expires_at index"""
+        try:
+            with self.get_connection(read_only=True) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT EXTRACT(EPOCH FROM expires_at)::float8 FROM user_data
+                        WHERE expires_at <= to_timestamp(%s)
+                        ORDER BY expires_at
+                        LIMIT %s
+                    """, (until, limit))
+                    return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Error reading upcoming expiries: {e}")
+            return []
+    
+    def get_user_history(self, user_id: str, key: str, limit: int) -> Optional[List[Tuple[float, str]]]:
+        """Replaced values of an entry as (replaced_at epoch, value), newest first; None on error"""
+        try:
+            with self.get_connection(read_only=True, user_id=user_id) as conn:
+                with conn.cursor() as cursor:
+                    self.statements.execute(cursor, 'history', (user_id, key, limit))
+                    return [(replaced_at, value) for replaced_at, value in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Error getting user data history: {e}")
+            return None
+    
+    def import_history(self, user_id: str, key: str, versions: List[Tuple[float, str]]) -> bool:
+        """Insert replaced values of an entry as (replaced_at epoch, value), e.g. from the JSON backend
+        
+        Rows go to the monthly partition of their replaced_at, or to the
+        default partition for months that have none.
+        """
+        if not versions:
+            return True
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    psycopg2.extras.execute_values(
+                        cursor, "INSERT INTO user_data_history (user_id, key, value, replaced_at) VALUES %s",
+                        [(user_id, key, value, replaced_at) for replaced_at, value in versions],
+                        template=UPSERT_MANY_TEMPLATE, page_size=IMPORT_PAGE_SIZE
+                    )
+                    conn.commit()
+                    return True
+        except Exception as e:
+            logger.error(f"Error importing user data history: {e}")
+            return False
+    
+    def prune_history(self, keep: int, batch_size: int = HISTORY_PRUNE_BATCH) -> Optional[int]:
+        """Delete history beyond the newest keep versions of each recently overwritten key
+        
+        Only keys with history written since the previous run can have gone
+        over the limit. They are found through the BRIN index and handled
+        batch_size keys per transaction, so no run holds locks for long.
+        Also creates upcoming monthly partitions once an hour. Returns the
+        number of rows deleted, or None on error.
+        """
+        if time.monotonic() - self._history_partitions_checked >= HISTORY_PARTITION_CHECK_SECONDS:
+            self.create_history_partitions()
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT EXTRACT(EPOCH FROM now())::float8")
+                    started = cursor.fetchone()[0]
+                    if self._history_pruned_until is None:
+                        since = started - HISTORY_PRUNE_LOOKBACK_SECONDS
+                    else:
+                        since = self._history_pruned_until - HISTORY_PRUNE_OVERLAP_SECONDS
+                    deleted = 0
+                    after: Tuple[int, str] = (-1, '')
+                    while True:
+                        cursor.execute("""
+                            SELECT DISTINCT user_id, key FROM user_data_history
+                            WHERE replaced_at >= to_timestamp(%s) AND (user_id, key) > (%s, %s)
+                            ORDER BY user_id, key
+                            LIMIT %s
+                        """, (since, after[0], after[1], batch_size))
+                        touched = cursor.fetchall()
+                        if not touched:
+                            break
+                        cursor.execute(HISTORY_PRUNE_SQL, ([user_id for user_id, _ in touched],
+                                                           [key for _, key in touched], keep))
+                        deleted += cursor.rowcount
+                        conn.commit()
+                        if len(touched) < batch_size:
+                            break
+                        after = touched[-1]
+            self._history_pruned_until = started
+            if deleted:
+                logger.info(f"Pruned {deleted} old history versions")
+            return deleted
+        except Exception as e:
+            logger.error(f"Error pruning user data history: {e}")
+            return None
+    
+    def create_history_partitions(self) -> bool:
+        """Create this month's and the next months' history partitions if missing
+        
+        Rows that already landed in the default partition for one of those
+        months are moved into the new partition (see schema.sql). A failure is
+        logged and retried on the next prune run.
+        """
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(f"SET LOCAL lock_timeout = '{HISTORY_PARTITION_LOCK_TIMEOUT}'")
+                    cursor.execute("SELECT create_user_data_history_partitions()")
+                    conn.commit()
+            self._history_partitions_checked = time.monotonic()
+            return True
+        except Exception as e:
+            logger.error(f"Error creating user data history partitions: {e}")
+            return False
+    
+    def get_user_data_count(self, user_id: str) -> int:
+        """Get count of user data entries (maintained counter in user_stats)
+        
+        Queued writes are not in the counter yet, so while writes are being
+        queued the user's names are counted with the queue applied, or, if
+        nothing can be read, the queued saves are counted. Either way the
+        quota check still sees what was saved during the outage.
+        """
+        if not self.degraded:
+            return self._get_user_stat(user_id, 'item_count')
+        try:
+            return len(self._select_keys(user_id, None))
+        except Exception as e:
+            logger.warning(f"Counting only queued entries for quota check: {e}")
+            pending = self.write_behind.pending_for_user(user_id) if self.write_behind else {}
+            return sum(1 for value in pending.values() if value is not None)
+    
+    def get_user_data_bytes(self, user_id: str) -> int:
+        """Get total size in bytes of a user's values (maintained counter in user_stats)"""
+        return self._get_user_stat(user_id, 'total_bytes')
+    
+    def _get_user_stat(self, user_id: str, column: str) -> int:
+        try:
+            with self.get_connection(read_only=True, user_id=user_id) as conn:
+                with conn.cursor() as cursor:
+                    self.statements.execute(cursor, column, (user_id,))
+                    row = cursor.fetchone()
+                    return row[0] if row else 0
+        except Exception as e:
+            logger.error(f"Error getting user data {column}: {e}")
             return 0
     
     def test_connection(self) -> bool:
@@ -120,7 +1305,79 @@ class DatabaseManager:
                 with conn.cursor() as cursor:
                     cursor.execute("SELECT 1")
                     result = cursor.fetchone()
-                    return result[0] == 1
+                    if result[0] != 1:
+                        return False
+            if self.replicas:
+                self.check_replicas()
+            return True
         except Exception as e:
             logger.error(f"Database connection test failed: {e}")
-            return False
\ No newline at end of file
+            return False
+    
+    def start_change_listener(self, on_change: Callable[[Optional[str], Optional[str]], None]):
+        """Start a background LISTEN on the change feed.
+        
+        on_change(user_id, key) is called from the listener thread for every
+        notification. on_change(None, None) means notifications may have been
+        missed (listener (re)connected or dropped) and all local state is suspect.
+        change_feed_active is only True while notifications are being delivered.
+        """
+        if self._listener_thread and self._listener_thread.is_alive():
+            return
+        self._listener_stop.clear()
+        self._listener_thread = threading.Thread(
+            target=self._listen_loop, args=(on_change,),
+            name='vault-change-listener', daemon=True
+        )
+        self._listener_thread.start()
+    
+    def stop_change_listener(self):
+        """Stop the change feed listener"""
+        self._listener_stop.set()
+        if self._listener_thread:
+            self._listener_thread.join(timeout=LISTEN_POLL_SECONDS + 1)
+            self._listener_thread = None
+    
+    def _listen_loop(self, on_change: Callable[[Optional[str], Optional[str]], None]):
+        while not self._listener_stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connection_params)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANGE_CHANNEL}")
+                self.change_feed_active = True
+                # Anything cached before LISTEN took effect may already be stale
+                on_change(None, None)
+                self.change_feed_ready.set()
+                logger.info("Listening for user data changes")
+                
+                while not self._listener_stop.is_set():
+                    if select.select([conn], [], [], LISTEN_POLL_SECONDS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch_change(notify.payload, on_change)
+            except Exception as e:
+                logger.warning(f"Change listener error: {e}")
+            finally:
+                was_active = self.change_feed_active
+                self.change_feed_active = False
+                self.change_feed_ready.clear()
+                if was_active:
+                    on_change(None, None)
+                if conn:
+                    conn.close()
+            self._listener_stop.wait(LISTEN_RETRY_SECONDS)
+    
+    def _dispatch_change(self, payload: str, on_change: Callable[[Optional[str], Optional[str]], None]):
+        try:
+            change = json.loads(payload)
+            user_id = change['user_id']
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Malformed change notification: {payload!r}")
+            on_change(None, None)
+            return
+        # A null user_id is a bulk change (e.g. backup.py restore): flush everything
+        on_change(str(user_id) if user_id is not None else None, change.get('key'))
\ No newline at end of file
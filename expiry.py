@@ -0,0 +1,119 @@
+"""
+Expiry scheduling for entries saved with a TTL
+
+ExpiryScheduler keeps a min-heap of the expiry times it knows about and sleeps
+until the earliest one. Times come from two places: entries this process
+saves (schedule()), and a periodic look-ahead read from the backend's expiry
+index, which covers entries written by other processes or before a restart.
+When a time comes due, expired entries are removed by batched sweeps, each a
+bounded delete of the earliest due entries, so no sweep walks all the data.
+
+Sweeps only reclaim storage: reads already treat an expired entry as absent.
+"""
+
+import time
+import heapq
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger('vault.expiry')
+
+SWEEP_BATCH_SIZE = 500
+# Expiry times up to this far ahead are kept in the heap; later ones are
+# picked up by a look-ahead, which runs twice per window so none is missed
+LOOKAHEAD_SECONDS = 300.0
+LOOKAHEAD_LIMIT = 1000
+RETRY_SECONDS = 30.0
+
+
+class ExpiryScheduler:
+    def __init__(self, sweep: Callable[[int], Awaitable[Optional[int]]],
+                 upcoming: Callable[[float, int], Awaitable[List[float]]],
+                 batch_size: int = SWEEP_BATCH_SIZE, lookahead: float = LOOKAHEAD_SECONDS,
+                 clock: Callable[[], float] = time.time):
+        """sweep(limit) deletes up to limit due entries and returns how many (None on error);
+        upcoming(until, limit) returns the earliest expiry times up to until"""
+        self.sweep = sweep
+        self.upcoming = upcoming
+        self.batch_size = batch_size
+        self.lookahead = lookahead
+        self.clock = clock
+        self._heap: List[float] = []
+        self._scheduled: Set[float] = set()
+        self._wake = asyncio.Event()
+        self._next_lookahead = 0.0
+        self.stats: Dict[str, int] = {'sweeps': 0, 'swept': 0}
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, expires_at: float):
+        """Make sure a sweep runs at expires_at (call from the event loop)"""
+        if expires_at > self.clock() + self.lookahead:
+            return
+        self._push(expires_at)
+
+    def _push(self, expires_at: float):
+        if expires_at in self._scheduled:
+            return
+        self._scheduled.add(expires_at)
+        heapq.heappush(self._heap, expires_at)
+        if self._heap[0] == expires_at:
+            self._wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                await self._step()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Expiry sweep failed, retrying in {RETRY_SECONDS:.0f}s: {e}")
+                self._push(self.clock() + RETRY_SECONDS)
+            await self._sleep()
+
+    async def _step(self):
+        now = self.clock()
+        if now >= self._next_lookahead:
+            await self._look_ahead(now)
+        if self._heap and self._heap[0] <= now:
+            while self._heap and self._heap[0] <= now:
+                self._scheduled.discard(heapq.heappop(self._heap))
+            await self._sweep_due()
+
+    async def _look_ahead(self, now: float):
+        # Set first so a failing look-ahead is retried later, not in a tight loop
+        self._next_lookahead = now + RETRY_SECONDS
+        times = await self.upcoming(now + self.lookahead, LOOKAHEAD_LIMIT)
+        for expires_at in times:
+            self._push(expires_at)
+        # A full page means more entries fall inside the window than were read
+        self._next_lookahead = times[-1] if len(times) >= LOOKAHEAD_LIMIT else now + self.lookahead / 2
+
+    async def _sweep_due(self):
+        total = 0
+        while True:
+            swept = await self.sweep(self.batch_size)
+            if swept is None:
+                logger.warning(f"Expiry sweep failed, retrying in {RETRY_SECONDS:.0f}s")
+                self._push(self.clock() + RETRY_SECONDS)
+                break
+            self.stats['sweeps'] += 1
+            self.stats['swept'] += swept
+            total += swept
+            if swept < self.batch_size:
+                break
+        if total:
+            logger.info(f"Swept {total} expired entries")
+
+    async def _sleep(self):
+        wake_at = min(self._heap[0] if self._heap else float('inf'), self._next_lookahead)
+        delay = wake_at - self.clock()
+        if delay <= 0:
+            return
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,87 @@
+"""
+Interaction response strategy
+
+Discord fails an interaction that gets no response within 3 seconds. Command
+work runs as a task; if it has not finished within the budget, the
+interaction is deferred (ephemeral "thinking" state) and the result is sent as
+a followup instead. Every decision is recorded in ResponseStats.
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from typing import Awaitable, Dict, List, Optional, Tuple, Union
+import discord
+
+logger = logging.getLogger('vault.interactions')
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, float('inf'))
+
+Reply = Union[str, Tuple[str, Optional[discord.File]]]
+
+
+class ResponseStats:
+    """Per-command counts of fast vs deferred responses and a latency histogram"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands: Dict[str, Dict[str, object]] = {}
+
+    def record(self, command: str, elapsed: float, deferred: bool):
+        with self._lock:
+            entry = self.commands.setdefault(command, {
+                'fast': 0, 'deferred': 0, 'buckets': [0] * len(LATENCY_BUCKETS)
+            })
+            entry['deferred' if deferred else 'fast'] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    entry['buckets'][i] += 1
+                    break
+
+    def summary(self) -> List[str]:
+        """One line per command: counts, deferral rate and histogram"""
+        lines = []
+        with self._lock:
+            for command, entry in sorted(self.commands.items()):
+                total = entry['fast'] + entry['deferred']
+                histogram = ' '.join(
+                    f"<={bound:g}s:{count}" for bound, count in zip(LATENCY_BUCKETS, entry['buckets']) if count
+                )
+                lines.append(
+                    f"/{command}: {total} responses, {entry['deferred']} deferred "
+                    f"({entry['deferred'] / total:.1%}) [{histogram}]"
+                )
+        return lines
+
+
+async def respond_with_deferral(interaction: discord.Interaction, work: Awaitable[Reply],
+                                budget: float, stats: ResponseStats):
+    """Run work and send its reply, deferring first if it takes longer than budget
+
+    work returns the message text, or (text, file) to attach a file.
+    Exceptions from work propagate to the command tree's error handler.
+    """
+    command = interaction.command.name if interaction.command else 'unknown'
+    started = time.perf_counter()
+    task = asyncio.ensure_future(work)
+    done, _ = await asyncio.wait({task}, timeout=budget)
+    deferred = not done
+    if deferred:
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+    try:
+        reply = await task
+    finally:
+        elapsed = time.perf_counter() - started
+        stats.record(command, elapsed, deferred)
+        if deferred:
+            logger.info(f"/{command} missed the {budget:.1f}s fast path, deferred (took {elapsed:.2f}s)")
+
+    content, file = reply if isinstance(reply, tuple) else (reply, None)
+    kwargs = {'file': file} if file is not None else {}
+    if deferred:
+        await interaction.followup.send(content, ephemeral=True, **kwargs)
+    else:
+        await interaction.response.send_message(content, ephemeral=True, **kwargs)
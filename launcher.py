@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Sharded multi-process launcher for the Discord Vault bot
+
+Spreads the bot's gateway shards over several worker processes. Each worker
+imports bot.py with SHARD_COUNT/SHARD_IDS set, so it runs an AutoShardedBot
+that owns only its shard range and opens its own storage connections.
+A supervisor loop restarts workers that crash.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import multiprocessing
+from typing import List, Optional, Dict
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('vault.launcher')
+
+GATEWAY_BOT_URL = 'https://discord.com/api/v10/gateway/bot'
+POLL_INTERVAL_SECONDS = 1.0
+RESTART_BACKOFF_BASE = 1.0
+RESTART_BACKOFF_MAX = 60.0
+STABLE_RUN_SECONDS = 60.0  # A worker that ran this long resets its backoff
+SHUTDOWN_TIMEOUT_SECONDS = 10.0
+
+
+def split_shards(shard_count: int, workers: int) -> List[List[int]]:
+    """Split shard IDs 0..shard_count-1 into contiguous ranges, one per worker"""
+    if shard_count < 1:
+        raise ValueError("shard_count must be at least 1")
+    workers = max(1, min(workers, shard_count))
+    base, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for i in range(workers):
+        size = base + (1 if i < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def fetch_recommended_shard_count(token: str) -> int:
+    """Ask Discord how many shards it recommends for this bot"""
+    import asyncio
+    import aiohttp
+
+    async def fetch() -> int:
+        headers = {'Authorization': f'Bot {token}'}
+        async with aiohttp.ClientSession() as session:
+            async with session.get(GATEWAY_BOT_URL, headers=headers) as response:
+                response.raise_for_status()
+                data = await response.json()
+                return int(data['shards'])
+
+    return asyncio.run(fetch())
+
+
+def run_worker(shard_ids: List[int], shard_count: int):
+    """Worker process entry point: run one bot instance for the given shards"""
+    os.environ['SHARD_COUNT'] = str(shard_count)
+    os.environ['SHARD_IDS'] = ','.join(str(i) for i in shard_ids)
+    # Each worker keeps its own write-behind queue for database outages
+    os.environ.setdefault('WRITE_BEHIND_FILE', f"pending_writes-{shard_ids[0]}.ndjson")
+
+    # Imported here so the shard settings above are visible at module load
+    import bot
+
+    bot.bot.run(bot.TOKEN)
+
+
+class ShardSupervisor:
+    """Start one process per shard range and restart any that exit"""
+
+    def __init__(self, shard_count: int, workers: int):
+        self.shard_count = shard_count
+        self.shard_ranges = split_shards(shard_count, workers)
+        self.ctx = multiprocessing.get_context('spawn')
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started_at: Dict[int, float] = {}
+        self.failures: Dict[int, int] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.stopping = False
+
+    def _start_worker(self, index: int):
+        shard_ids = self.shard_ranges[index]
+        process = self.ctx.Process(
+            target=run_worker,
+            args=(shard_ids, self.shard_count),
+            name=f'vault-shards-{shard_ids[0]}-{shard_ids[-1]}',
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.info(f"Started worker {index} (pid {process.pid}) for shards {shard_ids}")
+
+    def _handle_exit(self, index: int, process: multiprocessing.Process):
+        ran_for = time.monotonic() - self.started_at[index]
+        if ran_for >= STABLE_RUN_SECONDS:
+            self.failures[index] = 0
+        self.failures[index] = self.failures.get(index, 0) + 1
+        delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** (self.failures[index] - 1))
+        logger.warning(
+            f"Worker {index} (pid {process.pid}) exited with code {process.exitcode} "
+            f"after {ran_for:.1f}s, restarting in {delay:.1f}s"
+        )
+        del self.processes[index]
+        self.restart_at[index] = time.monotonic() + delay
+
+    def run(self):
+        """Run until SIGINT/SIGTERM, restarting crashed workers"""
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        for index in range(len(self.shard_ranges)):
+            self._start_worker(index)
+
+        while not self.stopping:
+            now = time.monotonic()
+            for index, process in list(self.processes.items()):
+                if not process.is_alive():
+                    self._handle_exit(index, process)
+            for index, due in list(self.restart_at.items()):
+                if now >= due:
+                    del self.restart_at[index]
+                    self._start_worker(index)
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+        self.shutdown()
+
+    def _request_stop(self, signum, frame):
+        logger.info(f"Received signal {signum}, shutting down workers")
+        self.stopping = True
+
+    def shutdown(self):
+        """Terminate all workers, killing any that do not exit in time"""
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.processes.clear()
+
+
+def main(workers: Optional[int] = None, shard_count: Optional[int] = None) -> int:
+    token = os.getenv('DISCORD_TOKEN')
+    if not token:
+        logger.error("DISCORD_TOKEN is not set")
+        return 1
+
+    workers = workers or os.cpu_count() or 1
+    if shard_count is None:
+        try:
+            shard_count = fetch_recommended_shard_count(token)
+            logger.info(f"Discord recommends {shard_count} shard(s)")
+        except Exception as e:
+            logger.error(f"Could not fetch recommended shard count: {e}")
+            return 1
+
+    required_vars = ['PGHOST', 'PGDATABASE', 'PGUSER', 'PGPASSWORD']
+    if min(workers, shard_count) > 1 and not all(os.getenv(var) for var in required_vars):
+        logger.error("Multiple workers need shared PostgreSQL storage; the JSON file backend is per-process")
+        return 1
+
+    supervisor = ShardSupervisor(shard_count, workers)
+    logger.info(f"Launching {len(supervisor.shard_ranges)} worker(s) for {shard_count} shard(s)")
+    supervisor.run()
+    return 0
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the Discord Vault bot as sharded worker processes')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--shards', type=int, default=None, help='Total shard count (default: Discord recommendation)')
+
+    args = parser.parse_args()
+    sys.exit(main(args.workers, args.shards))
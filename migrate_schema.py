@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Online migration of user_data.user_id from VARCHAR(50) to BIGINT
+
+Databases created before the BIGINT schema store Discord snowflakes as text.
+This script converts them without blocking the running bot, and brings the
+user_data indexes of older databases up to date (step 7):
+
+1. Drop the redundant idx_user_data_user_id / idx_user_data_key indexes
+2. Add a nullable user_id_new BIGINT column kept in sync by a trigger
+3. Backfill it in small batches, one transaction each
+4. Build the new UNIQUE(user_id_new, key) and (user_id_new, key
+   text_pattern_ops) indexes CONCURRENTLY; dropping the old column drops
+   every index on it, and ensure_schema will not recreate them while the
+   schema.sql hash is unchanged
+5. Validate NOT NULL through a NOT VALID check constraint
+6. Swap the columns in one short transaction guarded by lock_timeout, taking
+   over the new indexes under the old names
+7. Rebuild the UNIQUE and prefix indexes with INCLUDE (expires_at) where
+   they lack it, so key listings filtering out expired rows stay index-only
+   scans; schema.sql creates them that way but cannot change existing ones
+
+Index sizes and upsert throughput are measured before and after.
+"""
+
+import time
+import logging
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from typing import Dict
+from database import DatabaseManager
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('migration')
+
+BACKFILL_BATCH_SIZE = 5000
+SWAP_LOCK_TIMEOUT = '5s'
+SWAP_ATTEMPTS = 10
+BENCHMARK_USER_ID = '0'  # Never a real snowflake
+
+
+def user_id_type(cursor) -> str:
+    cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'user_data' AND column_name = 'user_id'
+    """)
+    return cursor.fetchone()[0]
+
+
+def index_sizes(cursor) -> Dict[str, int]:
+    """Size in bytes of every index on user_data"""
+    cursor.execute("""
+        SELECT indexrelname, pg_relation_size(indexrelid)
+        FROM pg_stat_user_indexes WHERE relname = 'user_data'
+        ORDER BY indexrelname
+    """)
+    return dict(cursor.fetchall())
+
+
+def benchmark_upserts(conn, rows: int) -> float:
+    """Upserts per second, one committed statement each, like the bot issues them
+
+    They go to a temporary copy of user_data with the same columns, indexes and
+    constraints but none of its triggers, so running bots get no NOTIFYs and
+    user_stats, tombstones and history are left alone. The copy's id gets its
+    own identity instead of drawing from user_data's sequence.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE user_data_benchmark (LIKE user_data INCLUDING ALL)")
+        cursor.execute("ALTER TABLE user_data_benchmark ALTER COLUMN id DROP DEFAULT")
+        cursor.execute("ALTER TABLE user_data_benchmark ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY")
+        conn.commit()
+        try:
+            started = time.perf_counter()
+            for i in range(rows):
+                cursor.execute("""
+                    INSERT INTO user_data_benchmark (user_id, key, value)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id, key)
+                    DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+                """, (BENCHMARK_USER_ID, f"bench_{i % 100}", f"value_{i}"))
+                conn.commit()
+            elapsed = time.perf_counter() - started
+        finally:
+            conn.rollback()
+            cursor.execute("DROP TABLE IF EXISTS user_data_benchmark")
+            conn.commit()
+    return rows / elapsed
+
+
+def report(label: str, conn, benchmark_rows: int) -> Dict[str, int]:
+    with conn.cursor() as cursor:
+        sizes = index_sizes(cursor)
+    conn.commit()
+    for name, size in sizes.items():
+        logger.info(f"[{label}] index {name}: {size / 1024:.0f} KiB")
+    logger.info(f"[{label}] total index size: {sum(sizes.values()) / 1024:.0f} KiB")
+    if benchmark_rows:
+        rate = benchmark_upserts(conn, benchmark_rows)
+        logger.info(f"[{label}] upsert throughput: {rate:.0f} rows/s ({benchmark_rows} upserts)")
+    return sizes
+
+
+def migrate_user_id_to_bigint(db: DatabaseManager, benchmark_rows: int = 500):
+    conn = psycopg2.connect(**db.connection_params)
+    try:
+        with conn.cursor() as cursor:
+            # Backfills, index builds and VACUUM run far longer than the bot's statement timeout
+            cursor.execute("SET statement_timeout = 0")
+        conn.commit()
+        before = report('before', conn, benchmark_rows)
+
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            logger.info("Dropping redundant indexes...")
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_user_data_user_id")
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_user_data_key")
+
+            if user_id_type(cursor) == 'bigint':
+                logger.info("user_id is already BIGINT, nothing to convert")
+            else:
+                cursor.execute("SELECT COUNT(*) FROM user_data WHERE user_id !~ '^[0-9]+$'")
+                invalid = cursor.fetchone()[0]
+                if invalid:
+                    logger.error(f"{invalid} rows have a non-numeric user_id; fix or delete them first")
+                    return False
+                convert_user_id(cursor)
+            cover_expires_at(cursor)
+
+            logger.info("Vacuuming so index-only scans can use the visibility map...")
+            cursor.execute("VACUUM (ANALYZE) user_data")
+
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        after = report('after', conn, benchmark_rows)
+        saved = sum(before.values()) - sum(after.values())
+        logger.info(f"Index size change: {-saved / 1024:+.0f} KiB")
+        return True
+    finally:
+        conn.close()
+
+
+def convert_user_id(cursor):
+    """Steps 2-6, run on an autocommit cursor"""
+    logger.info("Adding user_id_new column and sync trigger...")
+    cursor.execute("ALTER TABLE user_data ADD COLUMN IF NOT EXISTS user_id_new BIGINT")
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION sync_user_id_new()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            NEW.user_id_new := NEW.user_id::bigint;
+            RETURN NEW;
+        END;
+        $$ language 'plpgsql'
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS sync_user_id_new ON user_data")
+    cursor.execute("""
+        CREATE TRIGGER sync_user_id_new
+            BEFORE INSERT OR UPDATE ON user_data
+            FOR EACH ROW
+            EXECUTE FUNCTION sync_user_id_new()
+    """)
+
+    logger.info("Backfilling user_id_new...")
+    total = 0
+    while True:
+        cursor.execute("""
+            UPDATE user_data SET user_id_new = user_id::bigint
+            WHERE id IN (SELECT id FROM user_data WHERE user_id_new IS NULL LIMIT %s)
+        """, (BACKFILL_BATCH_SIZE,))
+        if cursor.rowcount == 0:
+            break
+        total += cursor.rowcount
+        logger.info(f"Backfilled {total} rows")
+
+    logger.info("Building UNIQUE(user_id_new, key) concurrently...")
+    cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS user_data_user_id_new_key")
+    cursor.execute("""
+        CREATE UNIQUE INDEX CONCURRENTLY user_data_user_id_new_key
+            ON user_data (user_id_new, key) INCLUDE (expires_at)
+    """)
+    logger.info("Building the (user_id_new, key text_pattern_ops) prefix index concurrently...")
+    cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_user_data_user_key_prefix_new")
+    cursor.execute("""
+        CREATE INDEX CONCURRENTLY idx_user_data_user_key_prefix_new
+            ON user_data (user_id_new, key text_pattern_ops) INCLUDE (expires_at)
+    """)
+
+    logger.info("Validating NOT NULL without a long lock...")
+    cursor.execute("ALTER TABLE user_data DROP CONSTRAINT IF EXISTS user_id_new_not_null")
+    cursor.execute("ALTER TABLE user_data ADD CONSTRAINT user_id_new_not_null CHECK (user_id_new IS NOT NULL) NOT VALID")
+    cursor.execute("ALTER TABLE user_data VALIDATE CONSTRAINT user_id_new_not_null")
+
+    with_lock_retries(cursor, swap_columns, "swap user_id columns")
+    logger.info("user_id is now BIGINT")
+
+
+def with_lock_retries(cursor, step, what: str):
+    """Run a transaction that takes an ACCESS EXCLUSIVE lock, retrying while lock_timeout expires"""
+    for attempt in range(1, SWAP_ATTEMPTS + 1):
+        try:
+            step(cursor)
+            return
+        except psycopg2.errors.LockNotAvailable:
+            cursor.execute("ROLLBACK")
+            logger.warning(f"Attempt {attempt} to {what} timed out waiting for a lock, retrying")
+            time.sleep(attempt)
+    raise RuntimeError(f"Could not acquire the lock needed to {what}")
+
+
+def index_includes_expires_at(cursor, index_name: str) -> bool:
+    """False also when the index does not exist"""
+    cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indexrelid = to_regclass(%s) AND a.attname = 'expires_at'
+        )
+    """, (index_name,))
+    return cursor.fetchone()[0]
+
+
+def cover_expires_at(cursor):
+    """Step 7, run on an autocommit cursor"""
+    if not index_includes_expires_at(cursor, 'idx_user_data_user_key_prefix'):
+        logger.info("Rebuilding the prefix index with INCLUDE (expires_at) concurrently...")
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_user_data_user_key_prefix_new")
+        cursor.execute("""
+            CREATE INDEX CONCURRENTLY idx_user_data_user_key_prefix_new
+                ON user_data (user_id, key text_pattern_ops) INCLUDE (expires_at)
+        """)
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_user_data_user_key_prefix")
+        cursor.execute("ALTER INDEX idx_user_data_user_key_prefix_new RENAME TO idx_user_data_user_key_prefix")
+    if not index_includes_expires_at(cursor, 'user_data_user_id_key_key'):
+        logger.info("Rebuilding UNIQUE(user_id, key) with INCLUDE (expires_at) concurrently...")
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS user_data_user_id_key_covering")
+        cursor.execute("""
+            CREATE UNIQUE INDEX CONCURRENTLY user_data_user_id_key_covering
+                ON user_data (user_id, key) INCLUDE (expires_at)
+        """)
+        with_lock_retries(cursor, swap_unique_index, "swap the UNIQUE(user_id, key) index")
+
+
+def swap_unique_index(cursor):
+    cursor.execute("BEGIN")
+    cursor.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+    cursor.execute("""
+        ALTER TABLE user_data
+            DROP CONSTRAINT user_data_user_id_key_key,
+            ADD CONSTRAINT user_data_user_id_key_key UNIQUE USING INDEX user_data_user_id_key_covering
+    """)
+    cursor.execute("COMMIT")
+
+
+def swap_columns(cursor):
+    cursor.execute("BEGIN")
+    cursor.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+    cursor.execute("LOCK TABLE user_data IN ACCESS EXCLUSIVE MODE")
+    cursor.execute("""
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = 'user_data'::regclass AND contype = 'u'
+    """)
+    for (constraint_name,) in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE user_data DROP CONSTRAINT "{constraint_name}"')
+    cursor.execute("ALTER TABLE user_data ALTER COLUMN user_id_new SET NOT NULL")
+    cursor.execute("ALTER TABLE user_data DROP CONSTRAINT user_id_new_not_null")
+    cursor.execute("DROP TRIGGER sync_user_id_new ON user_data")
+    cursor.execute("ALTER TABLE user_data DROP COLUMN user_id")
+    cursor.execute("ALTER TABLE user_data RENAME COLUMN user_id_new TO user_id")
+    cursor.execute("""
+        ALTER TABLE user_data ADD CONSTRAINT user_data_user_id_key_key
+            UNIQUE USING INDEX user_data_user_id_new_key
+    """)
+    # The old prefix index went with the old column
+    cursor.execute("ALTER INDEX idx_user_data_user_key_prefix_new RENAME TO idx_user_data_user_key_prefix")
+    cursor.execute("DROP FUNCTION sync_user_id_new()")
+    cursor.execute("COMMIT")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert user_data.user_id to BIGINT online and drop redundant indexes')
+    parser.add_argument('--benchmark-rows', type=int, default=500,
+                        help='Upserts to time before and after the migration (0 to skip, default: 500)')
+
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    if not db.test_connection():
+        logger.error("Cannot connect to database")
+        exit(1)
+    exit(0 if migrate_user_id_to_bigint(db, args.benchmark_rows) else 1)
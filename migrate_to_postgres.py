@@ -5,6 +5,7 @@ Migration script to transfer data from JSON file to PostgreSQL database
 
 import os
 import json
+import time
 import logging
 from database import DatabaseManager
 from dotenv import load_dotenv
@@ -53,20 +54,42 @@ def migrate_json_to_postgres(json_file_path: str = 'user_data.json'):
     # Migrate data
     total_entries = 0
     successful_entries = 0
+    total_versions = 0
+    migrated_versions = 0
     
     for user_id, user_data in json_data.items():
         if not isinstance(user_data, dict):
             logger.warning(f"Skipping invalid data for user {user_id}")
             continue
         
+        # user_id is a BIGINT column, so only Discord snowflakes can be stored
+        if not str(user_id).isdigit():
+            logger.warning(f"Skipping non-numeric user ID {user_id} ({len(user_data)} entries)")
+            total_entries += len(user_data)
+            continue
+        
         for key, value in user_data.items():
             total_entries += 1
-            if db.set_user_data(user_id, key, str(value)):
-                successful_entries += 1
-            else:
+            # Entries saved with a TTL are stored as {"value": ..., "expires_at": <epoch seconds>},
+            # and entries with replaced values as {"value": ..., "history": [[<replaced at>, <old value>], ...]}
+            expires_at = None
+            history = []
+            if isinstance(value, dict):
+                value, expires_at, history = value.get('value'), value.get('expires_at'), value.get('history', [])
+            if not db.set_user_data(user_id, key, str(value), expires_at):
                 logger.error(f"Failed to migrate data for user {user_id}, key {key}")
+                continue
+            successful_entries += 1
+            # Inserted after the entry, since the first write of a key does not record history
+            total_versions += len(history)
+            versions = [(replaced_at, str(old_value)) for replaced_at, old_value in history]
+            if db.import_history(user_id, key, versions):
+                migrated_versions += len(versions)
+            else:
+                logger.error(f"Failed to migrate history for user {user_id}, key {key}")
     
     logger.info(f"Migration completed: {successful_entries}/{total_entries} entries migrated successfully")
+    logger.info(f"History: {migrated_versions}/{total_versions} replaced values migrated")
     
     # Create backup of original JSON file
     backup_file = f"{json_file_path}.backup"
@@ -106,7 +129,7 @@ def verify_migration(json_file_path: str = 'user_data.json'):
     verification_passed = True
     
     for user_id, user_data in json_data.items():
-        if not isinstance(user_data, dict):
+        if not isinstance(user_data, dict) or not str(user_id).isdigit():
             continue
         
         # Get all data for this user from database
@@ -119,6 +142,10 @@ def verify_migration(json_file_path: str = 'user_data.json'):
         
         # Compare each key-value pair
         for key, value in user_data.items():
+            if isinstance(value, dict):
+                if value.get('expires_at') is not None and value['expires_at'] <= time.time():
+                    continue  # Expired since the migration; reads no longer return it
+                value = value.get('value')
             if key not in db_user_data:
                 logger.error(f"Key {key} for user {user_id} not found in database")
                 verification_passed = False
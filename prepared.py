@@ -0,0 +1,128 @@
+"""
+Server-side prepared statements for the hot queries
+
+StatementRegistry holds named SQL statements, written with psycopg2's %s
+placeholders. On a connection it has been told to track (every pooled
+connection, primary or replica, which is reused until it breaks or its pool
+is closed), a statement is PREPAREd the first time it is used and run with
+EXECUTE from then on, so the server parses and plans it once per connection
+instead of once per query. On any other connection (the one-off connections
+opened when a pool is exhausted or not open yet, closed after one use) the
+SQL text is sent as before.
+
+The registry remembers, per tracked connection, which statements that
+session has prepared; the entry goes away with the connection object.
+Prepared statements belong to the server session, so a reconnect (a new
+pooled connection, or a replica pool reopened after it was marked down)
+starts with none and prepares again. invalidate() makes
+every connection drop and re-prepare its statements, e.g. after this process
+applied a schema change. If the server reports a statement missing or its plan
+stale (a schema change from elsewhere, or DISCARD ALL), the connection's
+statements are dropped and the query is retried once when it opened the
+transaction; otherwise the error is raised and the next use re-prepares.
+
+Parameters are left untyped, so PREPARE infers each one's type from the
+column it is compared with, which keeps one statement text working for both
+VARCHAR and BIGINT user_id (see migrate_schema.py). The inferred types are
+fixed at PREPARE time, though: after the column type changes, the server's
+re-analysis fails with "operator does not exist" or "datatype mismatch",
+which is handled like any other stale statement.
+"""
+
+import re
+import logging
+import threading
+import weakref
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from typing import Any, Dict, Optional, Sequence, Set
+
+logger = logging.getLogger('vault.prepared')
+
+# Statement missing on the server, "cached plan must not change result type", or a
+# parameter type inferred before a column changed type (42883, 42804)
+STALE_STATEMENT_ERRORS = (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.FeatureNotSupported,
+                          psycopg2.errors.UndefinedFunction, psycopg2.errors.DatatypeMismatch)
+
+
+def numbered_placeholders(sql: str) -> str:
+    """Turn %s placeholders into $1, $2, ... (and %% into %) for PREPARE"""
+    counter = iter(range(1, sql.count('%s') + 1))
+    return re.sub(r'%[s%]', lambda m: '%' if m.group() == '%%' else f'${next(counter)}', sql)
+
+
+class _ConnectionState:
+    __slots__ = ('generation', 'prepared')
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.prepared: Set[str] = set()
+
+
+class StatementRegistry:
+    def __init__(self, statements: Dict[str, str], prefix: str = 'vault_', enabled: bool = True):
+        """statements maps a short name to SQL with %s placeholders"""
+        self.statements = dict(statements)
+        self.prefix = prefix
+        self.enabled = enabled
+        self._prepare_sql = {name: f"PREPARE {prefix}{name} AS {numbered_placeholders(sql)}"
+                             for name, sql in self.statements.items()}
+        self._execute_sql = {name: f"EXECUTE {prefix}{name}" + (f" ({', '.join(['%s'] * sql.count('%s'))})"
+                                                                 if '%s' in sql else '')
+                             for name, sql in self.statements.items()}
+        self._lock = threading.Lock()
+        self._connections: 'weakref.WeakKeyDictionary[Any, _ConnectionState]' = weakref.WeakKeyDictionary()
+        self._generation = 0
+        self.stats: Dict[str, int] = {'prepared': 0, 'executed': 0, 'plain': 0, 'reprepared': 0}
+
+    def track(self, conn):
+        """Use prepared statements on conn from now on (call for long-lived connections)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if conn not in self._connections:
+                self._connections[conn] = _ConnectionState(self._generation)
+
+    def invalidate(self):
+        """Make every tracked connection drop and re-prepare its statements on next use"""
+        with self._lock:
+            self._generation += 1
+
+    def execute(self, cursor, name: str, params: Optional[Sequence[Any]] = None):
+        """Run the named statement on cursor, through EXECUTE where the connection is tracked"""
+        with self._lock:
+            state = self._connections.get(cursor.connection)
+            generation = self._generation
+        if state is None:
+            self.stats['plain'] += 1
+            cursor.execute(self.statements[name], params)
+            return
+        conn = cursor.connection
+        opened_transaction = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            self._execute_prepared(cursor, state, generation, name, params)
+        except STALE_STATEMENT_ERRORS as e:
+            # Reached the server, so the session still exists; its statements do not
+            state.generation = -1
+            if not opened_transaction:
+                raise
+            logger.info(f"Re-preparing statements after: {e}")
+            conn.rollback()
+            self.stats['reprepared'] += 1
+            self._execute_prepared(cursor, state, generation, name, params)
+
+    def _execute_prepared(self, cursor, state: _ConnectionState, generation: int, name: str,
+                          params: Optional[Sequence[Any]]):
+        if state.generation != generation:
+            if state.prepared or state.generation < 0:
+                cursor.execute("DEALLOCATE ALL")
+            state.prepared.clear()
+            state.generation = generation
+        if name not in state.prepared:
+            cursor.execute(self._prepare_sql[name])
+            # Prepared statements are not transactional: it stays even if this transaction rolls back
+            state.prepared.add(name)
+            self.stats['prepared'] += 1
+        self.stats['executed'] += 1
+        cursor.execute(self._execute_sql[name], params)
@@ -0,0 +1,219 @@
+"""
+On-demand runtime diagnostics for the running bot
+
+Nothing here is active until a capture is asked for: the sampling profiler
+runs its own thread only for the requested time, tracemalloc is started for a
+memory capture and stopped again afterwards, and event loop lag is measured
+only while a report is being made.
+
+- sample_stacks(): a wall-clock sampling profile of every thread, taken from
+  sys._current_frames(), so the event loop thread and the storage worker
+  threads are covered alike. Output includes folded stacks, which
+  flamegraph.pl and speedscope read directly.
+- memory_diff(): tracemalloc snapshots at the start and end of an interval,
+  diffed, i.e. memory allocated during the interval and still held.
+- measure_loop_lag() / task_counts(): how late the loop wakes a sleeping
+  coroutine, and which coroutines have tasks alive.
+"""
+
+import os
+import re
+import sys
+import time
+import asyncio
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+SAMPLE_INTERVAL = 0.005
+TRACE_FRAMES = 10
+LAG_TICK = 0.05
+
+# Leaf frames of threads that are waiting for work rather than doing it
+IDLE_LEAVES = {
+    ('selectors.py', 'select'),   # event loop with nothing ready
+    ('thread.py', '_worker'),     # executor thread waiting on its queue
+    ('threading.py', 'wait'),     # background loops sleeping on an Event
+}
+
+Stack = Tuple[str, ...]
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_group(name: str) -> str:
+    """Pool threads (asyncio_0, asyncio_1, ...) are reported as one group"""
+    return re.sub(r'[_-]?\d+$', '', name) or name
+
+
+class Profile:
+    def __init__(self, seconds: float, interval: float):
+        self.seconds = seconds
+        self.interval = interval
+        self.ticks = 0
+        # (thread group, outermost frame, ..., leaf frame) -> samples
+        self.stacks: Counter = Counter()
+        self.idle: Counter = Counter()
+
+    def add(self, group: str, stack: Stack, idle: bool):
+        self.stacks[(group,) + stack] += 1
+        if idle:
+            self.idle[(group,) + stack] += 1
+
+    @property
+    def busy_samples(self) -> int:
+        return sum(self.stacks.values()) - sum(self.idle.values())
+
+    def top_self(self, limit: int) -> List[Tuple[str, int]]:
+        """Leaf frames by samples, leaving out idle waits"""
+        counts: Counter = Counter()
+        for stack, samples in self.stacks.items():
+            samples -= self.idle.get(stack, 0)
+            if samples and len(stack) > 1:
+                counts[f"[{stack[0]}] {stack[-1]}"] += samples
+        return counts.most_common(limit)
+
+    def top_inclusive(self, limit: int) -> List[Tuple[str, int]]:
+        """Frames by samples spent in them or anything they called, leaving out idle waits"""
+        counts: Counter = Counter()
+        for stack, samples in self.stacks.items():
+            samples -= self.idle.get(stack, 0)
+            if samples:
+                for label in set(stack[1:]):
+                    counts[label] += samples
+        return counts.most_common(limit)
+
+    def folded(self) -> List[str]:
+        return [f"{';'.join(stack)} {samples}" for stack, samples in self.stacks.most_common()]
+
+    def report(self, limit: int = 40) -> str:
+        busy = max(self.busy_samples, 1)
+        lines = [f"# {self.ticks} ticks over {self.seconds:.1f}s every {self.interval * 1000:.0f}ms, "
+                 f"{self.busy_samples} busy thread samples", "", "## Self (busy samples)"]
+        lines += [f"{samples:7d} {samples / busy:6.1%}  {label}" for label, samples in self.top_self(limit)]
+        lines += ["", "## Inclusive (busy samples)"]
+        lines += [f"{samples:7d} {samples / busy:6.1%}  {label}" for label, samples in self.top_inclusive(limit)]
+        lines += ["", "## Folded stacks (all samples, idle included)"]
+        lines += self.folded()
+        return '\n'.join(lines) + '\n'
+
+
+def sample_stacks(seconds: float, interval: float = SAMPLE_INTERVAL,
+                  clock: Callable[[], float] = time.perf_counter) -> Profile:
+    """Sample every other thread's stack each interval for seconds (blocks the calling thread)"""
+    profile = Profile(seconds, interval)
+    own = threading.get_ident()
+    deadline = clock() + seconds
+    while clock() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            leaf = frame.f_code
+            stack: List[str] = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.reverse()
+            idle = (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_LEAVES
+            profile.add(thread_group(names.get(ident, str(ident))), tuple(stack), idle)
+        profile.ticks += 1
+        time.sleep(interval)
+    return profile
+
+
+async def capture_profile(seconds: float, interval: float = SAMPLE_INTERVAL) -> Profile:
+    """sample_stacks() on a thread of its own, so it takes no executor thread from storage calls"""
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def settle(setter, value):
+        if not done.done():
+            setter(value)
+
+    def run():
+        try:
+            profile = sample_stacks(seconds, interval)
+        except Exception as e:
+            loop.call_soon_threadsafe(settle, done.set_exception, e)
+            return
+        loop.call_soon_threadsafe(settle, done.set_result, profile)
+
+    threading.Thread(target=run, name='vault-profiler', daemon=True).start()
+    return await done
+
+
+class MemoryDiff:
+    def __init__(self, seconds: float, before: tracemalloc.Snapshot, after: tracemalloc.Snapshot):
+        self.seconds = seconds
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')]
+        before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+        self.by_line = after.compare_to(before, 'lineno')
+        self.by_traceback = after.compare_to(before, 'traceback')
+        self.traced = sum(stat.size for stat in after.statistics('filename'))
+
+    def summary(self, limit: int = 10) -> List[str]:
+        return [f"{stat.size_diff / 1024:+.1f} KiB ({stat.count_diff:+d}) {stat.traceback[0]}"
+                for stat in self.by_line[:limit] if stat.size_diff]
+
+    def report(self, limit: int = 50, tracebacks: int = 5) -> str:
+        lines = [f"# Allocations held after {self.seconds:.1f}s: {self.traced / 1024:.1f} KiB traced", "",
+                 "## By line"]
+        lines += [str(stat) for stat in self.by_line[:limit]]
+        for stat in self.by_traceback[:tracebacks]:
+            lines += ["", f"## {stat.size_diff / 1024:+.1f} KiB in {stat.count_diff:+d} blocks allocated at"]
+            lines += stat.traceback.format()
+        return '\n'.join(lines) + '\n'
+
+
+async def memory_diff(seconds: float, frames: int = TRACE_FRAMES) -> MemoryDiff:
+    """Trace allocations for seconds and diff the snapshots
+
+    tracemalloc is stopped afterwards unless it was already running.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    # Comparing large snapshots takes a while; keep it off the event loop
+    return await asyncio.to_thread(MemoryDiff, seconds, before, after)
+
+
+async def measure_loop_lag(seconds: float, tick: float = LAG_TICK) -> List[float]:
+    """How late each tick-long sleep wakes up, over seconds"""
+    loop = asyncio.get_running_loop()
+    lags = []
+    deadline = loop.time() + seconds
+    while loop.time() < deadline:
+        started = loop.time()
+        await asyncio.sleep(tick)
+        lags.append(max(0.0, loop.time() - started - tick))
+    return lags
+
+
+def describe_lag(lags: List[float]) -> str:
+    if not lags:
+        return "no samples"
+    ordered = sorted(lags)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return (f"mean {sum(lags) / len(lags) * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms, "
+            f"max {ordered[-1] * 1000:.1f}ms over {len(lags)} ticks")
+
+
+def task_counts() -> Dict[str, int]:
+    """Live tasks on the running loop by coroutine, most numerous first"""
+    counts: Counter = Counter()
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        counts[getattr(coro, '__qualname__', type(coro).__name__)] += 1
+    return dict(counts.most_common())
@@ -3,29 +3,261 @@
 
 CREATE TABLE IF NOT EXISTS user_data (
     id SERIAL PRIMARY KEY,
-    user_id VARCHAR(50) NOT NULL,
+    user_id BIGINT NOT NULL,  -- Discord snowflake (see migrate_schema.py for VARCHAR installs)
     key VARCHAR(255) NOT NULL,
     value TEXT NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE(user_id, key)
+    expires_at TIMESTAMPTZ,
+    UNIQUE(user_id, key) INCLUDE (expires_at)
 );
 
--- Index for faster queries
-CREATE INDEX IF NOT EXISTS idx_user_data_user_id ON user_data(user_id);
-CREATE INDEX IF NOT EXISTS idx_user_data_key ON user_data(key);
+-- The UNIQUE(user_id, key) index serves every lookup, including index-only
+-- scans for key listings and counts; it carries expires_at so the live-row
+-- filter is answered from the index too. These older indexes only slowed down
+-- writes: user_id is its leading column and nothing queries by key alone.
+DROP INDEX IF EXISTS idx_user_data_user_id;
+DROP INDEX IF EXISTS idx_user_data_key;
+
+-- Optional TTL (/save ttl:). Rows past expires_at read as absent and are
+-- deleted in batches by the bot's expiry sweeper. Adding a nullable column
+-- without a default does not rewrite the table, and the partial index only
+-- holds rows that have a TTL, so sweeps and look-aheads never scan the table.
+ALTER TABLE user_data ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS idx_user_data_expires_at ON user_data (expires_at) WHERE expires_at IS NOT NULL;
+
+-- Namespaced names ("work/github/token"): /list prefix: and /delete prefix:
+-- query key LIKE 'work/%'. The UNIQUE index compares with the database
+-- collation, which cannot turn LIKE into a range; text_pattern_ops compares
+-- bytewise, so the prefix becomes an index range scan within the user.
+-- Like the UNIQUE index it INCLUDEs expires_at: every read filters out expired
+-- rows, and without it each listed key costs a heap fetch. Databases created
+-- before this keep their old indexes (IF NOT EXISTS); migrate_schema.py
+-- rebuilds them concurrently.
+CREATE INDEX IF NOT EXISTS idx_user_data_user_key_prefix ON user_data (user_id, key text_pattern_ops) INCLUDE (expires_at);
 
 -- Function to automatically update the updated_at timestamp
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
 BEGIN
-    NEW.updated_at = CURRENT_TIMESTAMP;
+    -- Only content changes count; maintenance updates (e.g. column backfills
+    -- in migrate_schema.py) keep the original timestamp
+    IF ROW(NEW.user_id, NEW.key, NEW.value) IS DISTINCT FROM ROW(OLD.user_id, OLD.key, OLD.value) THEN
+        NEW.updated_at = CURRENT_TIMESTAMP;
+    END IF;
     RETURN NEW;
 END;
 $$ language 'plpgsql';
 
 -- Trigger to call the function on updates
+DROP TRIGGER IF EXISTS update_user_data_updated_at ON user_data;
 CREATE TRIGGER update_user_data_updated_at 
     BEFORE UPDATE ON user_data 
     FOR EACH ROW 
-    EXECUTE FUNCTION update_updated_at_column();
\ No newline at end of file
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- Change feed: every write publishes (user_id, key) so other bot instances
+-- can invalidate their in-process caches
+CREATE OR REPLACE FUNCTION notify_user_data_change()
+RETURNS TRIGGER AS $$
+DECLARE
+    changed RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+    ELSE
+        changed := NEW;
+    END IF;
+    PERFORM pg_notify(
+        'user_data_changes',
+        json_build_object('user_id', changed.user_id::text, 'key', changed.key)::text
+    );
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS notify_user_data_change ON user_data;
+CREATE TRIGGER notify_user_data_change
+    AFTER INSERT OR UPDATE OR DELETE ON user_data
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_user_data_change();
+
+-- Per-user counters kept in step with user_data by trigger (same transaction
+-- as the write), so quota checks read one row instead of counting rows
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id BIGINT PRIMARY KEY,
+    item_count INTEGER NOT NULL DEFAULT 0,
+    total_bytes BIGINT NOT NULL DEFAULT 0
+);
+
+-- user_id is cast explicitly so the trigger also works while migrate_schema.py
+-- is converting a VARCHAR user_id column. The trigger fires on every UPDATE and
+-- skips unrelated ones here: an UPDATE OF user_id trigger would depend on the
+-- column and stop migrate_schema.py from dropping the old one.
+CREATE OR REPLACE FUNCTION maintain_user_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.user_id IS NOT DISTINCT FROM NEW.user_id AND OLD.value IS NOT DISTINCT FROM NEW.value THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.user_id::bigint = OLD.user_id::bigint THEN
+        UPDATE user_stats
+        SET total_bytes = total_bytes + octet_length(NEW.value) - octet_length(OLD.value)
+        WHERE user_id = NEW.user_id::bigint;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_stats
+        SET item_count = item_count - 1,
+            total_bytes = total_bytes - octet_length(OLD.value)
+        WHERE user_id = OLD.user_id::bigint;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO user_stats (user_id, item_count, total_bytes)
+        VALUES (NEW.user_id::bigint, 1, octet_length(NEW.value))
+        ON CONFLICT (user_id) DO UPDATE
+        SET item_count = user_stats.item_count + 1,
+            total_bytes = user_stats.total_bytes + EXCLUDED.total_bytes;
+    END IF;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS maintain_user_stats ON user_data;
+CREATE TRIGGER maintain_user_stats
+    AFTER INSERT OR UPDATE OR DELETE ON user_data
+    FOR EACH ROW
+    EXECUTE FUNCTION maintain_user_stats();
+
+-- One-time backfill when the counters table is new. The trigger lock above
+-- blocks concurrent writes until this transaction commits.
+INSERT INTO user_stats (user_id, item_count, total_bytes)
+SELECT user_id::bigint, COUNT(*), SUM(octet_length(value))
+FROM user_data
+WHERE NOT EXISTS (SELECT 1 FROM user_stats)
+GROUP BY user_id;
+
+
+-- Incremental backups (backup.py): rows changed since a watermark are found
+-- through updated_at, deletes through tombstones recorded in the same
+-- transaction as the DELETE
+CREATE INDEX IF NOT EXISTS idx_user_data_updated_at ON user_data(updated_at);
+
+CREATE TABLE IF NOT EXISTS user_data_tombstones (
+    user_id BIGINT NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    deleted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_data_tombstones_deleted_at ON user_data_tombstones(deleted_at);
+
+CREATE OR REPLACE FUNCTION record_user_data_tombstone()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO user_data_tombstones (user_id, key) VALUES (OLD.user_id::bigint, OLD.key);
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS record_user_data_tombstone ON user_data;
+CREATE TRIGGER record_user_data_tombstone
+    AFTER DELETE ON user_data
+    FOR EACH ROW
+    EXECUTE FUNCTION record_user_data_tombstone();
+
+-- Version history (/history, /restore): an overwrite keeps the replaced value.
+-- Written by trigger, so it shares the transaction of whichever statement
+-- overwrote the row (single saves, batched upserts, imports, write-behind
+-- replay). Range-partitioned by month so old history lives in its own
+-- partitions; rows beyond the newest versions per key are pruned in batches
+-- by DatabaseManager.prune_history, off the write path.
+CREATE TABLE IF NOT EXISTS user_data_history (
+    id BIGSERIAL,
+    user_id BIGINT NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    value TEXT NOT NULL,
+    replaced_at TIMESTAMPTZ NOT NULL DEFAULT now()
+) PARTITION BY RANGE (replaced_at);
+
+-- Catches rows when a monthly partition was not created in time
+CREATE TABLE IF NOT EXISTS user_data_history_default PARTITION OF user_data_history DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_user_data_history_key ON user_data_history (user_id, key, replaced_at DESC);
+-- History is appended in time order, so a BRIN index finds recent rows for the pruner at almost no write cost
+CREATE INDEX IF NOT EXISTS idx_user_data_history_replaced_at ON user_data_history USING brin (replaced_at);
+
+-- Creates this month's partition and the next months_ahead ones (the bot
+-- calls this at startup and hourly, see DatabaseManager.create_history_partitions).
+-- A partition cannot be created while the default partition holds rows in
+-- its range, so rows that landed there while a month was missing are moved
+-- over: the default partition is detached, the month created, its rows
+-- moved, and the default attached again, all in one transaction.
+CREATE OR REPLACE FUNCTION create_user_data_history_partitions(months_ahead INTEGER DEFAULT 2)
+RETURNS void AS $$
+DECLARE
+    month_start TIMESTAMPTZ;
+    month_end TIMESTAMPTZ;
+    partition_name TEXT;
+    stranded BOOLEAN;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        month_start := date_trunc('month', now()) + make_interval(months => i);
+        month_end := month_start + interval '1 month';
+        partition_name := 'user_data_history_' || to_char(month_start, 'YYYYMM');
+        IF to_regclass(partition_name) IS NULL THEN
+            SELECT EXISTS (
+                SELECT 1 FROM user_data_history_default
+                WHERE replaced_at >= month_start AND replaced_at < month_end
+            ) INTO stranded;
+            IF stranded THEN
+                ALTER TABLE user_data_history DETACH PARTITION user_data_history_default;
+            END IF;
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF user_data_history FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+            IF stranded THEN
+                EXECUTE format(
+                    'WITH moved AS (
+                        DELETE FROM user_data_history_default
+                        WHERE replaced_at >= %L AND replaced_at < %L
+                        RETURNING *
+                    ) INSERT INTO %I SELECT * FROM moved',
+                    month_start, month_end, partition_name
+                );
+                ALTER TABLE user_data_history ATTACH PARTITION user_data_history_default DEFAULT;
+            END IF;
+        END IF;
+    END LOOP;
+END;
+$$ language 'plpgsql';
+
+SELECT create_user_data_history_partitions();
+
+-- TTL entries are meant to disappear, so their values are never kept, and
+-- deleting an entry deletes its history with it
+CREATE OR REPLACE FUNCTION record_user_data_history()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM user_data_history WHERE user_id = OLD.user_id::bigint AND key = OLD.key;
+    ELSIF NEW.value IS DISTINCT FROM OLD.value AND OLD.expires_at IS NULL THEN
+        INSERT INTO user_data_history (user_id, key, value) VALUES (OLD.user_id::bigint, OLD.key, OLD.value);
+    END IF;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+DROP TRIGGER IF EXISTS record_user_data_history ON user_data;
+CREATE TRIGGER record_user_data_history
+    AFTER UPDATE OF value OR DELETE ON user_data
+    FOR EACH ROW
+    EXECUTE FUNCTION record_user_data_history();
+
+-- Hash of the schema.sql last applied (see DatabaseManager.ensure_schema), so a
+-- restart can skip re-running this file when nothing changed
+CREATE TABLE IF NOT EXISTS schema_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    schema_hash TEXT NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
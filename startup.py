@@ -0,0 +1,60 @@
+"""
+Startup timing
+
+StartupTimeline records when startup milestones were reached (measured from
+process start, so interpreter start-up and imports are included) and how long
+individual startup phases took, and renders both as one log line.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+
+def process_age() -> float:
+    """Seconds since this process started (0.0 where /proc is unavailable)"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the parenthesised command name; starttime is field 22
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupTimeline:
+    def __init__(self):
+        self.started = time.perf_counter() - process_age()
+        self._lock = threading.Lock()
+        self.marks: Dict[str, float] = {}
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, name: str) -> float:
+        """Record that a milestone was reached; returns seconds since process start"""
+        offset = time.perf_counter() - self.started
+        with self._lock:
+            self.marks.setdefault(name, offset)
+        return offset
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a block of startup work (recorded even if it raises)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, time.perf_counter() - started))
+
+    def summary(self) -> str:
+        with self._lock:
+            marks = sorted(self.marks.items(), key=lambda item: item[1])
+            phases = list(self.phases)
+        parts = [f"{name} at {offset:.2f}s" for name, offset in marks]
+        if phases:
+            parts.append('phases: ' + ', '.join(f"{name} {elapsed:.2f}s" for name, elapsed in phases))
+        return ' | '.join(parts)
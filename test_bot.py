@@ -4,15 +4,36 @@ Discord Vault Bot テストスイート
 """
 
 import os
+import io
 import json
 import tempfile
+import time
+import asyncio
 import unittest
-from unittest.mock import Mock, patch
+import threading
+import subprocess
+import psycopg2
+import psycopg2.errors
+from unittest.mock import Mock, MagicMock, AsyncMock, patch
 import sys
 
 # テスト用にbot.pyをインポート
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from bot import UserDataManager, validate_name, validate_value, MAX_NAME_LENGTH, MAX_VALUE_LENGTH, MAX_ITEMS_PER_USER
+from bot import (UserDataManager, SingleFlight, validate_name, validate_prefix, validate_value, parse_import_lines, parse_names, write_export,
+                 parse_ttl, describe_ttl, respond_owner_only, debug_loop_reply, debug_profile_reply,
+                 MAX_NAME_LENGTH, MAX_VALUE_LENGTH, MAX_ITEMS_PER_USER, MAX_NAMES_PER_COMMAND)
+from launcher import split_shards
+from database import (DatabaseManager, SCHEMA_FILE, WriteOp, WriteBatcher, plan_write_batch, resolve_write_batch,
+                      CircuitBreaker, WriteBehindQueue, UserEntries, BREAKER_FAILURE_THRESHOLD,
+                      is_connection_error)
+from backup import write_chunks, read_chunks
+from compact_store import CompactStore
+from startup import StartupTimeline
+from admission import AdmissionController, Overloaded
+from interactions import ResponseStats, respond_with_deferral
+from expiry import ExpiryScheduler
+from prepared import StatementRegistry, numbered_placeholders
+from profiling import sample_stacks, memory_diff, measure_loop_lag, task_counts
 
 
 class TestUserDataManager(unittest.TestCase):
@@ -118,9 +139,1476 @@ class TestUserDataManager(unittest.TestCase):
         self.assertEqual(self.manager.get_user_data_count(user_id), 1)
 
 
+    def test_get_user_data_bytes(self):
+        """ユーザーデータ合計バイト数の追跡テスト"""
+        user_id = "123456789"
+        self.assertEqual(self.manager.get_user_data_bytes(user_id), 0)
+        
+        self.manager.set_user_data(user_id, "key1", "abc")
+        self.manager.set_user_data(user_id, "key2", "日本語")
+        self.assertEqual(self.manager.get_user_data_bytes(user_id), 3 + 9)
+        
+        # 上書き・削除で差分が反映される
+        self.manager.set_user_data(user_id, "key1", "a")
+        self.assertEqual(self.manager.get_user_data_bytes(user_id), 1 + 9)
+        self.manager.delete_user_data(user_id, "key2")
+        self.assertEqual(self.manager.get_user_data_bytes(user_id), 1)
+        
+        # 再読み込み後も同じ値になる
+        reloaded = UserDataManager(self.temp_file.name)
+        self.assertEqual(reloaded.get_user_data_bytes(user_id), 1)
+    
+    def test_get_and_delete_many(self):
+        """複数データの一括取得・一括削除（保存は1回）のテスト"""
+        user_id = "123456789"
+        for key in ("a", "b", "c"):
+            self.manager.set_user_data(user_id, key, key.upper())
+        
+        self.assertEqual(self.manager.get_user_data_many(user_id, ["c", "missing", "a"]), {"c": "C", "a": "A"})
+        with patch.object(self.manager, 'save_data', wraps=self.manager.save_data) as save_data:
+            deleted = self.manager.delete_user_data_many(user_id, ["a", "missing", "c"])
+        self.assertEqual(deleted, ["a", "c"])
+        self.assertEqual(save_data.call_count, 1)
+        self.assertEqual(UserDataManager(self.temp_file.name).get_user_data(user_id), {"b": "B"})
+
+    def test_prefix_list_and_delete(self):
+        """階層化した名前のプレフィックス一覧・一括削除（保存は1回）のテスト"""
+        user_id = "123456789"
+        for key in ("work/github/token", "work/aws", "workshop", "home/wifi"):
+            self.manager.set_user_data(user_id, key, "v")
+        
+        self.assertEqual(self.manager.list_user_keys(user_id, "work/"), ["work/aws", "work/github/token"])
+        self.assertEqual(self.manager.list_user_keys(user_id, "work"), ["work/aws", "work/github/token", "workshop"])
+        with patch.object(self.manager, 'save_data', wraps=self.manager.save_data) as save_data:
+            deleted = self.manager.delete_user_data_prefix(user_id, "work/")
+        self.assertEqual(deleted, ["work/aws", "work/github/token"])
+        self.assertEqual(save_data.call_count, 1)
+        self.assertEqual(self.manager.delete_user_data_prefix(user_id, "work/"), [])
+        self.assertEqual(UserDataManager(self.temp_file.name).list_user_keys(user_id), ["home/wifi", "workshop"])
+
+    def test_expired_entries_absent_and_swept(self):
+        """期限切れのデータは削除前から存在しない扱いになり、掃除で消えるテスト"""
+        user_id = "123456789"
+        self.manager.set_user_data(user_id, "otp", "123456", time.time() - 1)
+        self.manager.set_user_data(user_id, "temp", "pw", time.time() + 3600)
+        self.manager.set_user_data(user_id, "keep", "v")
+        
+        self.assertIsNone(self.manager.get_user_data(user_id, "otp"))
+        self.assertEqual(self.manager.get_user_data(user_id), {"temp": "pw", "keep": "v"})
+        self.assertEqual(self.manager.list_user_keys(user_id), ["keep", "temp"])
+        self.assertEqual(self.manager.get_user_data_count(user_id), 2)
+        self.assertFalse(self.manager.delete_user_data(user_id, "otp"))
+        
+        self.manager.set_user_data(user_id, "otp", "654321", time.time() - 1)
+        self.assertEqual(self.manager.upcoming_expiries(time.time() + 7200, 10)[0], self.manager.data.expires_at(user_id, "otp"))
+        self.assertEqual(self.manager.sweep_expired(100), 1)
+        self.assertEqual(self.manager.sweep_expired(100), 0)
+        reloaded = UserDataManager(self.temp_file.name)
+        self.assertEqual(reloaded.get_user_data(user_id), {"temp": "pw", "keep": "v"})
+        self.assertIsNotNone(reloaded.data.expires_at(user_id, "temp"))
+        
+        # TTLなしで保存し直すと期限は消える
+        self.manager.set_user_data(user_id, "temp", "pw2")
+        self.assertIsNone(self.manager.data.expires_at(user_id, "temp"))
+
+    def test_history_kept_across_reload(self):
+        """上書き前の値が新しい順に残り、再読み込み後も使えるテスト"""
+        user_id = "123456789"
+        for value in ("v1", "v2", "v3"):
+            self.manager.set_user_data(user_id, "password", value)
+        self.manager.set_user_data(user_id, "password", "v3")  # 同じ値は履歴に残さない
+        self.assertEqual([value for _, value in self.manager.get_user_history(user_id, "password")], ["v2", "v1"])
+        reloaded = UserDataManager(self.temp_file.name)
+        self.assertEqual(reloaded.get_user_history(user_id, "password"), self.manager.get_user_history(user_id, "password"))
+        self.assertEqual(reloaded.get_user_data(user_id, "password"), "v3")
+        
+        # 削除すると履歴も消える
+        self.manager.delete_user_data(user_id, "password")
+        self.manager.set_user_data(user_id, "password", "new")
+        self.assertEqual(self.manager.get_user_history(user_id, "password"), [])
+
+    def test_list_user_keys(self):
+        """データ名一覧取得テスト"""
+        user_id = "123456789"
+        self.assertEqual(self.manager.list_user_keys(user_id), [])
+        
+        self.manager.set_user_data(user_id, "key1", "value1")
+        self.manager.set_user_data(user_id, "key2", "value2")
+        self.assertEqual(self.manager.list_user_keys(user_id), ["key1", "key2"])
+
+
+    def test_export_user_data(self):
+        """エクスポートが名前順に全データを返すテスト"""
+        user_id = "123456789"
+        self.manager.set_user_data(user_id, "b", "2")
+        self.manager.set_user_data(user_id, "a", "1")
+        self.assertEqual(list(self.manager.export_user_data(user_id)), [("a", "1", None), ("b", "2", None)])
+        self.assertEqual(list(self.manager.export_user_data("999")), [])
+    
+    def test_export_import_keeps_ttl(self):
+        """有効期限付きのデータはエクスポート・インポート後も期限付きのままのテスト"""
+        user_id = "123456789"
+        expires_at = time.time() + 600
+        self.manager.set_user_data(user_id, "otp", "123456", expires_at)
+        self.manager.set_user_data(user_id, "memo", "keep")
+        buffer = io.BytesIO()
+        self.assertEqual(write_export(self.manager, user_id, buffer), 2)
+        lines = buffer.getvalue().decode('utf-8').splitlines()
+        self.assertNotIn("expires_at", json.loads(lines[0]))
+        self.assertEqual(json.loads(lines[1])["expires_at"], expires_at)
+        
+        items, expiries, error = parse_import_lines(lines + ['{"name": "old", "value": "x", "expires_at": 1}'])
+        self.assertIsNone(error)
+        self.assertEqual(items, {"memo": "keep", "otp": "123456"})  # 期限切れの行は読み飛ばす
+        self.assertEqual(self.manager.import_user_data("42", items, expiries), 2)
+        self.assertEqual(self.manager.data.expires_at("42", "otp"), expires_at)
+        self.assertIsNone(self.manager.data.expires_at("42", "memo"))
+    
+    def test_import_user_data(self):
+        """一括インポートテスト"""
+        user_id = "123456789"
+        self.manager.set_user_data(user_id, "a", "old")
+        
+        result = self.manager.import_user_data(user_id, {"a": "new", "b": "2"})
+        self.assertEqual(result, 2)
+        self.assertEqual(self.manager.get_user_data(user_id), {"a": "new", "b": "2"})
+        
+        reloaded = UserDataManager(self.temp_file.name)
+        self.assertEqual(reloaded.get_user_data(user_id), {"a": "new", "b": "2"})
+    
+    def test_import_user_data_over_limit(self):
+        """上限を超えるインポートは何も保存しないテスト"""
+        user_id = "123456789"
+        for i in range(MAX_ITEMS_PER_USER - 1):
+            self.manager.set_user_data(user_id, f"key{i}", "v")
+        
+        result = self.manager.import_user_data(user_id, {"new1": "v", "new2": "v"})
+        self.assertIsNone(result)
+        self.assertEqual(self.manager.get_user_data_count(user_id), MAX_ITEMS_PER_USER - 1)
+        
+        # 既存データの上書きは件数に含まれない
+        self.assertEqual(self.manager.import_user_data(user_id, {"key0": "x", "new1": "v"}), 2)
+
+
+class TestCompactStore(unittest.TestCase):
+    """JSONバックエンドの省メモリ表現のテスト"""
+    
+    DATA = {
+        "123456789": {"memo": "日本語\n\"引用\"", "password": "secret"},
+        "0123": {"password": ""},
+        "legacy_user": {"k": "v"},
+    }
+    
+    def setUp(self):
+        self.store = CompactStore.from_dict(json.loads(json.dumps(self.DATA)))
+    
+    def test_reads_like_dict(self):
+        """従来の辞書と同じように読めるテスト"""
+        self.assertEqual(self.store, self.DATA)
+        self.assertEqual(list(self.store), list(self.DATA))
+        self.assertIn("0123", self.store)
+        self.assertNotIn("123", self.store)
+        self.assertEqual(self.store.get_value("123456789", "memo"), "日本語\n\"引用\"")
+        self.assertIsNone(self.store.get_value("123456789", "missing"))
+        self.assertEqual(self.store.user_bytes("123456789"), 6 + len("日本語\n\"引用\"".encode('utf-8')))
+    
+    def test_file_format_unchanged(self):
+        """保存形式が json.dump(indent=2) と同一（各ユーザー内は名前順）であるテスト"""
+        buffer = io.StringIO()
+        self.store.write_json(buffer)
+        self.assertEqual(buffer.getvalue(), json.dumps(self.DATA, ensure_ascii=False, indent=2))
+        empty = io.StringIO()
+        CompactStore().write_json(empty)
+        self.assertEqual(empty.getvalue(), "{}")
+    
+    def test_saved_from_arena_without_cache(self):
+        """TTL・履歴のないユーザーは辞書を作らずに書き出し、保存後も文字列を保持しないテスト"""
+        self.store.set_value("123456789", "email", "x@example.com")
+        self.store.set_value("0123", "otp", "111", time.time() + 60)
+        with patch('compact_store.json.dumps', wraps=json.dumps) as dumps:
+            buffer = io.StringIO()
+            self.store.write_json(buffer)
+        self.assertEqual({c.args[0] for c in dumps.call_args_list if isinstance(c.args[0], str)}, {"0123"})
+        saved = json.loads(buffer.getvalue())
+        self.assertEqual(saved["123456789"]["email"], "x@example.com")
+        self.assertEqual(saved["0123"]["otp"]["value"], "111")
+        self.assertEqual(saved["legacy_user"], {"k": "v"})
+    
+    def test_non_string_values_loaded_as_text(self):
+        """手で編集されたファイルの文字列以外の値は str() で文字列として読み込むテスト"""
+        store = CompactStore.from_dict({"1": {"n": 42, "b": True, "t": {"value": 1.5, "expires_at": None}}})
+        self.assertEqual(store["1"], {"n": "42", "b": "True", "t": "1.5"})
+    
+    def test_update_and_delete(self):
+        """上書き・追加・削除で他の値が崩れないテスト"""
+        self.store.set_value("123456789", "password", "a much longer secret")
+        self.store.set_value("123456789", "email", "x@example.com")
+        self.assertTrue(self.store.delete_value("123456789", "memo"))
+        self.assertFalse(self.store.delete_value("123456789", "memo"))
+        self.assertEqual(self.store["123456789"], {"password": "a much longer secret", "email": "x@example.com"})
+        self.assertEqual(self.store.user_keys("123456789"), ["email", "password"])
+        self.assertTrue(self.store.delete_value("0123", "password"))
+        self.assertNotIn("0123", self.store)
+    
+    def test_prefix_range(self):
+        """名前順に並んだ範囲だけを一覧・削除するテスト"""
+        for key in ("work/b", "work/a", "work-x", "works"):
+            self.store.set_value("1", key, key.upper())
+        self.assertEqual(self.store.user_keys("1"), ["work-x", "work/a", "work/b", "works"])
+        self.assertEqual(self.store.user_keys("1", "work/"), ["work/a", "work/b"])
+        self.assertEqual(self.store.user_keys("1", "zzz"), [])
+        self.assertEqual(self.store.delete_prefix("1", "work/"), ["work/a", "work/b"])
+        self.assertEqual(self.store["1"], {"work-x": "WORK-X", "works": "WORKS"})
+        self.assertEqual(self.store.delete_prefix("1", "work"), ["work-x", "works"])
+        self.assertNotIn("1", self.store)
+    
+    def test_expiring_entries_file_format(self):
+        """期限付きデータは {"value", "expires_at"} で保存され、読み込み時に期限切れは捨てるテスト"""
+        future, past = time.time() + 60, time.time() - 60
+        self.store.set_value("1", "otp", "111", future)
+        self.store.set_value("1", "old", "222", past)
+        buffer = io.StringIO()
+        self.store.write_json(buffer)
+        saved = json.loads(buffer.getvalue())
+        self.assertEqual(saved["1"], {"otp": {"value": "111", "expires_at": future}})
+        
+        saved["1"]["stale"] = {"value": "333", "expires_at": past}
+        reloaded = CompactStore.from_dict(saved)
+        self.assertEqual(reloaded["1"], {"otp": "111"})
+        self.assertEqual(reloaded.upcoming_expiries(future, 10), [future])
+        self.assertEqual(reloaded.sweep_expired(time.time(), 10), [])
+    
+    def test_sweep_earliest_first_in_batches(self):
+        """期限の早い順に上限件数ずつ削除するテスト"""
+        now = time.time()
+        for i in range(5):
+            self.store.set_value(str(i), "k", "v", now - 10 + i)
+        self.store.set_value("9", "k", "v", now + 60)
+        self.assertEqual(self.store.sweep_expired(now, 2), [("0", "k"), ("1", "k")])
+        self.assertEqual(len(self.store.sweep_expired(now, 10)), 3)
+        self.assertIn("9", self.store)
+        self.assertEqual(self.store.upcoming_expiries(now, 10), [])
+    
+    def test_history_ring_buffer(self):
+        """履歴はデータごとに指定件数までのリングバッファで、TTL付きの値は残さないテスト"""
+        store = CompactStore(history_versions=2)
+        for value in ("a", "b", "c", "d"):
+            store.set_value("1", "k", value)
+        self.assertEqual([value for _, value in store.history("1", "k")], ["c", "b"])
+        
+        store.set_value("1", "otp", "111", time.time() + 60)
+        store.set_value("1", "otp", "222")
+        self.assertEqual(store.history("1", "otp"), [])
+        store.set_value("1", "k", "e", time.time() + 60)
+        buffer = io.StringIO()
+        store.write_json(buffer)
+        saved = json.loads(buffer.getvalue())
+        self.assertEqual(saved["1"]["k"]["value"], "e")
+        self.assertEqual([value for _, value in saved["1"]["k"]["history"]], ["c", "d"])
+        self.assertEqual(CompactStore.from_dict(saved, history_versions=2).history("1", "k"), store.history("1", "k"))
+        
+        self.assertEqual(store.delete_prefix("1", "k"), ["k"])
+        self.assertEqual(store.history("1", "k"), [])
+    
+    def test_names_shared_and_ids_numeric(self):
+        """データ名は共有され、数値IDは整数で保持されるテスト"""
+        self.assertEqual(self.store._names.count("password"), 1)
+        self.assertIn(123456789, self.store._users)
+        self.assertIn("0123", self.store._users)
+
+
+class TestChangeFeedCache(unittest.TestCase):
+    """DB利用時のキャッシュと変更フィードによる無効化のテスト"""
+    
+    def setUp(self):
+        self.db = Mock()
+        self.db.test_connection.return_value = True
+        self.db.change_feed_active = True
+        self.db.degraded = False
+        self.db.get_user_data.return_value = {"key1": "value1"}
+        with patch.object(UserDataManager, '_should_use_database', return_value=True), \
+                patch('database.DatabaseManager', return_value=self.db):
+            self.manager = UserDataManager()
+    
+    def test_listener_started(self):
+        """起動時に変更フィードの購読を開始するテスト"""
+        self.db.start_change_listener.assert_called_once_with(self.manager._on_data_changed)
+    
+    def test_repeated_reads_use_cache(self):
+        """同じユーザーの読み取りはキャッシュから返すテスト"""
+        self.assertEqual(self.manager.get_user_data("1"), {"key1": "value1"})
+        self.assertEqual(self.manager.get_user_data("1", "key1"), "value1")
+        self.assertEqual(self.manager.get_user_data_count("1"), 1)
+        self.db.get_user_data.assert_called_once_with("1")
+        self.db.get_user_data_count.assert_not_called()
+    
+    def test_cache_dropped_at_earliest_expiry(self):
+        """最も早い有効期限を過ぎたキャッシュは使わないテスト"""
+        entries = UserEntries({"otp": "1"}, next_expiry=time.time() + 60)
+        self.db.get_user_data.return_value = entries
+        self.assertEqual(self.manager.get_user_data("1"), {"otp": "1"})
+        self.assertEqual(self.manager.get_user_data("1", "otp"), "1")
+        self.assertEqual(self.db.get_user_data.call_count, 1)
+        
+        entries.next_expiry = time.time() - 1
+        self.manager._cache["1"] = (self.manager._cache_epoch, entries, entries.next_expiry)
+        self.db.get_user_data.return_value = None
+        self.assertIsNone(self.manager.get_user_data("1", "otp"))
+        self.assertNotIn("1", self.manager._cache)
+    
+    def test_notification_invalidates_cache(self):
+        """他インスタンスからの変更通知でキャッシュが破棄されるテスト"""
+        self.manager.get_user_data("1")
+        self.manager._on_data_changed("1", "key1")
+        self.db.get_user_data.return_value = {"key1": "changed"}
+        self.assertEqual(self.manager.get_user_data("1"), {"key1": "changed"})
+    
+    def test_no_cache_without_change_feed(self):
+        """変更フィード停止中はキャッシュしないテスト"""
+        self.db.change_feed_active = False
+        self.manager.get_user_data("1")
+        self.manager.get_user_data("1")
+        self.assertEqual(self.db.get_user_data.call_count, 2)
+    
+    def test_stale_read_not_cached(self):
+        """読み取り中に無効化された結果はキャッシュしないテスト"""
+        def racing_read(user_id):
+            self.manager._on_data_changed(None, None)
+            return {"key1": "stale"}
+        self.db.get_user_data.side_effect = racing_read
+        self.manager.get_user_data("1")
+        self.manager.get_user_data("1")
+        self.assertEqual(self.db.get_user_data.call_count, 2)
+
+
+class TestSingleFlight(unittest.TestCase):
+    """同時読み取りの合流（シングルフライト）のテスト"""
+    
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+    
+    def slow_read(self, value):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return value
+    
+    def run_concurrently(self, count, target):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(count)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+    
+    def test_concurrent_calls_share_result(self):
+        """同じキーの同時呼び出しが1回の実行を共有するテスト"""
+        flight = SingleFlight()
+        results = self.run_concurrently(5, lambda: flight.do("k", self.slow_read, "v"))
+        self.assertEqual(results, ["v"] * 5)
+        self.assertEqual(self.calls, 1)
+    
+    def test_error_shared(self):
+        """実行時の例外が待っている全員に伝わるテスト"""
+        flight = SingleFlight()
+        errors = []
+        
+        def failing():
+            self.started.set()
+            self.release.wait(5)
+            raise RuntimeError("db down")
+        
+        def call():
+            try:
+                flight.do("k", failing)
+            except RuntimeError as e:
+                errors.append(e)
+        
+        self.run_concurrently(3, call)
+        self.assertEqual(len(errors), 3)
+    
+    def test_manager_coalesces_reads(self):
+        """UserDataManagerの同一ユーザーへの同時読み取りがDB呼び出し1回になるテスト"""
+        db = Mock()
+        db.test_connection.return_value = True
+        db.change_feed_active = False
+        db.degraded = False
+        db.get_user_data.side_effect = lambda user_id, key=None: self.slow_read("value")
+        with patch.object(UserDataManager, '_should_use_database', return_value=True), \
+                patch('database.DatabaseManager', return_value=db):
+            manager = UserDataManager()
+        results = self.run_concurrently(4, lambda: manager.get_user_data("1", "key"))
+        self.assertEqual(results, ["value"] * 4)
+        self.assertEqual(db.get_user_data.call_count, 1)
+    
+    def test_write_detaches_in_flight_read(self):
+        """書き込み後の読み取りは、書き込み前から実行中の読み取りに合流しないテスト"""
+        db = Mock()
+        db.test_connection.return_value = True
+        db.change_feed_active = False
+        db.degraded = False
+        db.get_user_data.side_effect = lambda user_id, key=None: self.slow_read("old")
+        with patch.object(UserDataManager, '_should_use_database', return_value=True), \
+                patch('database.DatabaseManager', return_value=db):
+            manager = UserDataManager()
+        reader = threading.Thread(target=manager.get_user_data, args=("1", "key"))
+        reader.start()
+        self.started.wait(5)
+        manager.set_user_data("1", "key", "new")
+        db.get_user_data.side_effect = lambda user_id, key=None: "new"
+        self.assertEqual(manager.get_user_data("1", "key"), "new")
+        self.release.set()
+        reader.join(5)
+
+
+class TestReadReplicaRouting(unittest.TestCase):
+    """プライマリ/レプリカ読み取り振り分けのテスト"""
+    
+    ENV = {
+        'PGHOST': 'primary', 'PGDATABASE': 'vault', 'PGUSER': 'vault', 'PGPASSWORD': 'pw',
+        'PGHOST_REPLICA': 'replica1,replica2:6432',
+    }
+    
+    def setUp(self):
+        env = patch.dict(os.environ, self.ENV)
+        env.start()
+        self.addCleanup(env.stop)
+        with patch('database.threading.Thread'):
+            self.db = DatabaseManager()
+        connect = patch('database.psycopg2.connect', side_effect=self._connect)
+        self.connect = connect.start()
+        self.addCleanup(connect.stop)
+        execute_values = patch('database.psycopg2.extras.execute_values')
+        execute_values.start()
+        self.addCleanup(execute_values.stop)
+        pool_min = patch('database.REPLICA_POOL_MIN_CONNECTIONS', 1)
+        pool_min.start()
+        self.addCleanup(pool_min.stop)
+        self.down_hosts = set()
+        self.reads = []
+    
+    def _connect(self, **params):
+        host = params['host']
+        if host in self.down_hosts:
+            raise psycopg2.OperationalError("connection refused")
+        conn = MagicMock(closed=0)
+        conn.cursor.return_value.__enter__.return_value.execute.side_effect = lambda *args: self.reads.append(host)
+        return conn
+    
+    def _hosts(self):
+        return [call.kwargs['host'] for call in self.connect.call_args_list]
+    
+    def test_replicas_parsed(self):
+        """レプリカ設定の読み込みテスト"""
+        self.assertEqual([r.name for r in self.db.replicas], ['replica1:5432', 'replica2:6432'])
+    
+    def test_reads_round_robin(self):
+        """読み取りがレプリカにラウンドロビンで振り分けられるテスト"""
+        for _ in range(4):
+            self.db.get_user_data("1", "key")
+        self.assertEqual(self.reads, ['replica1', 'replica2', 'replica1', 'replica2'])
+        # レプリカへの接続はプールで使い回す
+        self.assertEqual(self._hosts(), ['replica1', 'replica2'])
+    
+    def test_read_your_writes(self):
+        """書き込み直後の同一ユーザーの読み取りはプライマリへ行くテスト"""
+        self.db.set_user_data("1", "key", "value")
+        self.db.get_user_data("1", "key")
+        self.db.get_user_data_count("2")
+        self.assertEqual(self._hosts(), ['primary', 'primary', 'replica1'])
+    
+    def test_unreachable_replica_skipped(self):
+        """接続できないレプリカは一定時間スキップされるテスト"""
+        self.down_hosts.add('replica1')
+        self.db.get_user_data("1", "key")
+        self.db.get_user_data("1", "key")
+        self.db.get_user_data("1", "key")
+        self.assertEqual(self._hosts(), ['replica1', 'replica2'])
+        self.assertEqual(self.reads, ['replica2', 'replica2', 'replica2'])
+    
+    def test_down_replica_pool_evicted(self):
+        """停止と判定されたレプリカのプールは閉じられ、復帰後は接続し直すテスト"""
+        replica = self.db.replicas[0]
+        self.db.get_user_data("1", "key")
+        pool = replica.pool
+        self.assertIsNotNone(pool)
+        replica.mark_down()
+        self.assertIsNone(replica.pool)
+        self.assertTrue(pool.closed)
+        replica.down_until = 0.0
+        for _ in range(2):
+            self.db.get_user_data("1", "key")
+        self.assertEqual(self._hosts(), ['replica1', 'replica2', 'replica1'])
+    
+    def test_all_replicas_down_falls_back_to_primary(self):
+        """全レプリカ停止時はプライマリから読むテスト"""
+        self.down_hosts.update({'replica1', 'replica2'})
+        self.db.get_user_data("1", "key")
+        self.assertEqual(self._hosts()[-1], 'primary')
+
+
+class TestWriteBatching(unittest.TestCase):
+    """書き込みバッチ処理のテスト"""
+    
+    def test_plan_merges_ops(self):
+        """同じキーへの操作が最終状態にまとめられるテスト"""
+        ops = [
+            WriteOp('set', '1', 'a', 'v1'),
+            WriteOp('set', '1', 'a', 'v2'),
+            WriteOp('delete', '1', 'b'),
+            WriteOp('set', '1', 'b', 'new'),
+            WriteOp('set', '2', 'c', 'x'),
+            WriteOp('delete', '2', 'c'),
+        ]
+        deletes, upserts = plan_write_batch(ops)
+        self.assertEqual(sorted(deletes), [('1', 'b'), ('2', 'c')])
+        self.assertEqual(sorted(upserts), [('1', 'a', 'v2', None), ('1', 'b', 'new', None)])
+    
+    def test_resolve_results_in_order(self):
+        """各操作が単独実行と同じ結果を受け取るテスト"""
+        ops = [
+            WriteOp('delete', '1', 'a'),
+            WriteOp('delete', '1', 'a'),
+            WriteOp('delete', '1', 'missing'),
+            WriteOp('set', '1', 'b', 'v'),
+            WriteOp('delete', '1', 'b'),
+        ]
+        resolve_write_batch(ops, existed={('1', 'a')})
+        self.assertEqual([op.future.result() for op in ops], [True, False, False, True, True])
+    
+    def test_concurrent_writes_share_batch(self):
+        """短時間に届いた書き込みが1回の適用にまとめられるテスト"""
+        batches = []
+        
+        def apply_batch(ops):
+            batches.append(len(ops))
+            resolve_write_batch(ops, existed=set())
+        
+        batcher = WriteBatcher(apply_batch, window_seconds=0.05)
+        futures = [batcher.submit(WriteOp('set', '1', f'k{i}', 'v')) for i in range(10)]
+        self.assertTrue(all(future.result(5) for future in futures))
+        self.assertEqual(batches, [10])
+    
+    def test_failed_batch_returns_false(self):
+        """適用に失敗したバッチの呼び出し元はFalseを受け取るテスト"""
+        def apply_batch(ops):
+            raise psycopg2.OperationalError("connection lost")
+        
+        batcher = WriteBatcher(apply_batch, window_seconds=0.01)
+        self.assertFalse(batcher.submit(WriteOp('set', '1', 'k', 'v')).result(5))
+
+
+class TestDegradedMode(unittest.TestCase):
+    """DB障害時のサーキットブレーカーと書き込み退避キューのテスト"""
+    
+    ENV = {'PGHOST': 'primary', 'PGDATABASE': 'vault', 'PGUSER': 'vault', 'PGPASSWORD': 'pw'}
+    
+    def setUp(self):
+        env = patch.dict(os.environ, self.ENV)
+        env.start()
+        self.addCleanup(env.stop)
+        self.temp_dir = tempfile.mkdtemp()
+        self.queue_path = os.path.join(self.temp_dir, "pending.ndjson")
+        self.down = False
+        connect = patch('database.psycopg2.connect', side_effect=self._connect)
+        self.connect = connect.start()
+        self.addCleanup(connect.stop)
+        execute_values = patch('database.psycopg2.extras.execute_values')
+        self.execute_values = execute_values.start()
+        self.addCleanup(execute_values.stop)
+        self.db = DatabaseManager()
+        with patch('database.threading.Thread'):
+            self.db.enable_write_behind(self.queue_path)
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def _connect(self, **params):
+        if self.down:
+            raise psycopg2.OperationalError("connection refused")
+        return MagicMock()
+    
+    def test_breaker_opens_and_probes(self):
+        """連続失敗で開き、待機後に1回だけ試行を通すテスト"""
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] += 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())  # 試行中は他を通さない
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] += 10
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.record_success())
+        self.assertTrue(breaker.is_closed)
+    
+    def test_fails_fast_while_open(self):
+        """ブレーカーが開いている間は接続を試みないテスト"""
+        self.down = True
+        for _ in range(BREAKER_FAILURE_THRESHOLD + 3):
+            self.db.get_user_data_count("1")
+        self.assertEqual(self.connect.call_count, BREAKER_FAILURE_THRESHOLD)
+        self.assertTrue(self.db.degraded)
+    
+    def test_failure_in_use_opens_breaker(self):
+        """接続後の問い合わせで接続が切れた場合も失敗として数えるテスト"""
+        conn = MagicMock(closed=0)
+        conn.cursor.return_value.__enter__.return_value.execute.side_effect = \
+            psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.connect.side_effect = None
+        self.connect.return_value = conn
+        for _ in range(BREAKER_FAILURE_THRESHOLD):
+            self.assertTrue(self.db.breaker.is_closed)
+            self.db.get_user_data_count("1")
+        self.assertFalse(self.db.breaker.is_closed)
+        params = self.connect.call_args.kwargs
+        self.assertEqual(params['keepalives'], 1)
+        self.assertIn('statement_timeout=', params['options'])
+    
+    def test_writes_queued_and_replayed_in_order(self):
+        """障害中の書き込みは退避され、復旧後に順番どおり反映されるテスト"""
+        self.down = True
+        self.assertTrue(self.db.set_user_data("1", "a", "v1"))
+        self.assertTrue(self.db.set_user_data("1", "a", "v2"))
+        self.assertTrue(self.db.delete_user_data("1", "b"))
+        self.assertEqual(len(self.db.write_behind), 3)
+        # 反映前の値も読み取りに見える
+        self.assertEqual(self.db.get_user_data("1", "a"), "v2")
+        
+        # 再起動しても退避分は残る
+        self.assertEqual(len(WriteBehindQueue(self.queue_path)), 3)
+        
+        self.down = False
+        self.db.breaker.reset_seconds = 0
+        self.assertEqual(self.db.replay_write_behind(), 3)
+        self.assertFalse(self.db.degraded)
+        self.assertFalse(os.path.exists(self.queue_path))
+        rows = self.execute_values.call_args.args[2]
+        self.assertEqual(rows, [("1", "a", "v2", None)])
+    
+    def test_deadlock_retried_not_queued(self):
+        """デッドロックは障害扱いせず再実行し、退避キューにも積まないテスト"""
+        class DeadlockDetected(psycopg2.errors.DeadlockDetected):
+            pgcode = '40P01'
+        self.assertFalse(is_connection_error(DeadlockDetected()))
+        self.assertTrue(is_connection_error(psycopg2.OperationalError("connection refused")))
+        self.execute_values.side_effect = [DeadlockDetected(), None]
+        with patch('database.WRITE_RETRY_BACKOFF_SECONDS', 0):
+            self.db._apply_write_batch([WriteOp('set', '1', 'a', 'v')])
+            self.assertEqual(self.execute_values.call_count, 2)
+            self.assertEqual(len(self.db.write_behind), 0)
+            self.assertTrue(self.db.breaker.is_closed)
+            
+            self.execute_values.side_effect = DeadlockDetected()
+            with self.assertRaises(psycopg2.errors.DeadlockDetected):
+                self.db._apply_write_batch([WriteOp('set', '1', 'a', 'v')])
+        self.assertEqual(len(self.db.write_behind), 0)
+    
+    def test_count_includes_queued_writes(self):
+        """障害中の件数は退避中の保存も数え、上限チェックをすり抜けないテスト"""
+        self.down = True
+        for key in ("a", "b", "c"):
+            self.assertTrue(self.db.set_user_data("1", key, "v"))
+        self.assertTrue(self.db.delete_user_data("1", "c"))
+        self.assertEqual(self.db.get_user_data_count("1"), 2)
+        self.assertEqual(self.db.get_user_data_count("2"), 0)
+    
+    def test_torn_line_ignored(self):
+        """書き込み途中で落ちた末尾行は読み飛ばすテスト"""
+        queue = WriteBehindQueue(self.queue_path)
+        queue.append([WriteOp('set', '1', 'a', 'v')])
+        with open(self.queue_path, 'a', encoding='utf-8') as f:
+            f.write('{"kind": "set", "us')
+        reloaded = WriteBehindQueue(self.queue_path)
+        self.assertEqual(len(reloaded), 1)
+        self.assertEqual(reloaded.pending("1", "a"), (True, "v"))
+        self.assertEqual(reloaded.pending("1", "b"), (False, None))
+    
+    def test_manager_serves_cache_while_degraded(self):
+        """障害中は古い世代のキャッシュからも読み取り、書き込みを反映するテスト"""
+        db = Mock()
+        db.test_connection.return_value = True
+        db.change_feed_active = True
+        db.degraded = False
+        db.get_user_data.return_value = {"key1": "value1"}
+        with patch.object(UserDataManager, '_should_use_database', return_value=True), \
+                patch('database.DatabaseManager', return_value=db):
+            manager = UserDataManager()
+        manager.get_user_data("1")
+        # 変更フィードが切れ、DBにも届かなくなる
+        manager._on_data_changed(None, None)
+        db.change_feed_active = False
+        db.degraded = True
+        db.get_user_data.return_value = None
+        self.assertEqual(manager.get_user_data("1", "key1"), "value1")
+        db.set_user_data.return_value = True
+        manager.set_user_data("1", "key2", "value2")
+        self.assertEqual(manager.get_user_data("1"), {"key1": "value1", "key2": "value2"})
+        self.assertFalse(manager.delete_user_data("1", "missing"))
+        db.delete_user_data.assert_not_called()
+
+
+class TestMultiKeyQueries(unittest.TestCase):
+    """複数キーの取得・削除を1回の問い合わせで行うテスト"""
+    
+    def setUp(self):
+        with patch.dict(os.environ, TestDegradedMode.ENV):
+            self.db = DatabaseManager()
+        self.conn = MagicMock()
+        self.cursor = self.conn.cursor.return_value.__enter__.return_value
+        connect = patch('database.psycopg2.connect', return_value=self.conn)
+        self.connect = connect.start()
+        self.addCleanup(connect.stop)
+    
+    def test_get_many_single_query(self):
+        """ANY(%s) の1クエリで取得し、指定順で返すテスト"""
+        self.cursor.fetchall.return_value = [("b", "2"), ("a", "1")]
+        self.assertEqual(self.db.get_user_data_many("1", ["a", "missing", "b"]), {"a": "1", "b": "2"})
+        self.assertEqual(self.connect.call_count, 1)
+        sql, params = self.cursor.execute.call_args.args
+        self.assertIn("ANY(%s)", sql)
+        self.assertEqual(params, ("1", ["a", "missing", "b"]))
+    
+    def test_delete_many_single_statement(self):
+        """1つのDELETE文・1トランザクションで削除し、存在した名前を返すテスト"""
+        self.cursor.fetchall.return_value = [("c", True), ("a", True)]
+        self.assertEqual(self.db.delete_user_data_many("1", ["a", "b", "c"]), ["a", "c"])
+        self.assertEqual(self.cursor.execute.call_count, 1)
+        self.conn.commit.assert_called_once()
+    
+    def test_prefix_queries_use_like_range(self):
+        """プレフィックス指定は LIKE 'prefix%'（_ はエスケープ）の1文で一覧・削除するテスト"""
+        self.cursor.fetchall.return_value = [("my_app/b",), ("my_app/a",)]
+        self.assertEqual(self.db.list_user_keys("1", "my_app/"), ["my_app/b", "my_app/a"])
+        sql, params = self.cursor.execute.call_args.args
+        self.assertIn("key LIKE %s", sql)
+        self.assertEqual(params, ("1", "my\\_app/%"))
+        
+        self.cursor.execute.reset_mock()
+        self.cursor.fetchall.return_value = [("my_app/b", True), ("my_app/a", True)]
+        self.assertEqual(self.db.delete_user_data_prefix("1", "my_app/"), ["my_app/a", "my_app/b"])
+        sql, params = self.cursor.execute.call_args.args
+        self.assertTrue(sql.startswith("DELETE") and "RETURNING key" in sql)
+        self.assertEqual(self.cursor.execute.call_count, 1)
+    
+    def test_prefix_delete_queued_while_degraded(self):
+        """DB障害中は対象の名前を解決してから個別の削除としてキューに積むテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.db.write_behind = WriteBehindQueue(os.path.join(temp_dir, "pending.ndjson"))
+            self.db.write_behind.append([WriteOp('set', "1", "work/new", "v")])
+            self.cursor.fetchall.return_value = [("work/old",)]
+            self.assertEqual(self.db.delete_user_data_prefix("1", "work/"), ["work/new", "work/old"])
+            self.assertEqual(self.db.write_behind.pending_for_user("1"), {"work/new": None, "work/old": None})
+
+
+class TestHistory(unittest.TestCase):
+    """DBの変更履歴の取得と、保持数を超えた版の削除のテスト"""
+    
+    def setUp(self):
+        with patch.dict(os.environ, TestDegradedMode.ENV):
+            self.db = DatabaseManager()
+        self.conn = MagicMock()
+        self.cursor = self.conn.cursor.return_value.__enter__.return_value
+        connect = patch('database.psycopg2.connect', return_value=self.conn)
+        connect.start()
+        self.addCleanup(connect.stop)
+    
+    def test_history_newest_first(self):
+        """履歴は (user_id, key) のインデックス順に上限件数だけ読むテスト"""
+        self.cursor.fetchall.return_value = [(2000.0, "v2"), (1000.0, "v1")]
+        self.assertEqual(self.db.get_user_history("1", "k", 5), [(2000.0, "v2"), (1000.0, "v1")])
+        sql, params = self.cursor.execute.call_args.args
+        self.assertIn("ORDER BY replaced_at DESC", sql)
+        self.assertEqual(params, ("1", "k", 5))
+    
+    def test_prune_in_key_batches(self):
+        """前回以降に履歴が増えたキーだけを、一定件数ずつ別トランザクションで削除するテスト"""
+        self.cursor.fetchone.return_value = (5000.0,)
+        self.cursor.fetchall.side_effect = [[(1, "a"), (1, "b")], [(2, "c")]]
+        self.cursor.rowcount = 3
+        self.assertEqual(self.db.prune_history(keep=5, batch_size=2), 6)
+        
+        statements = [call.args for call in self.cursor.execute.call_args_list]
+        self.assertIn("create_user_data_history_partitions", statements[1][0])
+        statements = [args for args in statements if len(args) == 2]
+        prunes = [params for sql, params in statements if "row_number()" in sql]
+        self.assertEqual(prunes, [([1, 1], ["a", "b"], 5), ([2], ["c"], 5)])
+        scans = [params for sql, params in statements if "SELECT DISTINCT" in sql]
+        self.assertEqual(scans[0][0], 5000.0 - 86400.0)
+        self.assertEqual(scans[1][1:3], (1, "b"))
+        self.assertEqual(self.conn.commit.call_count, 3)
+        
+        # 次の回は前回の開始時刻（少し手前）から
+        self.cursor.execute.reset_mock()
+        self.cursor.fetchall.side_effect = [[]]
+        self.assertEqual(self.db.prune_history(keep=5), 0)
+        scan = [call.args[1] for call in self.cursor.execute.call_args_list if "SELECT DISTINCT" in call.args[0]]
+        self.assertEqual(scan[0][0], 5000.0 - 60.0)
+    
+    def test_partition_failure_does_not_stop_prune(self):
+        """パーティション作成の失敗は間引きを止めず、次の回に再試行するテスト"""
+        def execute(sql, params=None):
+            if "create_user_data_history_partitions" in sql:
+                raise psycopg2.errors.LockNotAvailable("lock timeout")
+        self.cursor.execute.side_effect = execute
+        self.cursor.fetchone.return_value = (5000.0,)
+        self.cursor.fetchall.side_effect = [[(1, "a")]]
+        self.cursor.rowcount = 1
+        self.assertEqual(self.db.prune_history(keep=5), 1)
+        
+        self.cursor.execute.side_effect = None
+        self.cursor.fetchall.side_effect = [[]]
+        self.assertEqual(self.db.prune_history(keep=5), 0)
+        self.assertTrue(any("create_user_data_history_partitions" in call.args[0]
+                            for call in self.cursor.execute.call_args_list[-3:]))
+    
+    def test_partitions_created_at_startup(self):
+        """スキーマが最新で再適用しない起動時も、先の月のパーティションを作るテスト"""
+        with open(SCHEMA_FILE, encoding='utf-8') as f:
+            schema_hash = DatabaseManager._schema_hash(f.read())
+        self.cursor.fetchone.side_effect = [(True,), (schema_hash,)]
+        self.assertFalse(self.db.ensure_schema())
+        self.assertIn("create_user_data_history_partitions", self.cursor.execute.call_args.args[0])
+
+
+class TestPreparedStatements(unittest.TestCase):
+    """プール接続ごとに一度だけPREPAREし、以降はEXECUTEで実行するテスト"""
+    
+    def setUp(self):
+        self.registry = StatementRegistry({'get': "SELECT value FROM user_data WHERE user_id = %s AND key = %s"})
+    
+    def make_cursor(self):
+        cursor = MagicMock()
+        cursor.connection.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return cursor
+    
+    def statements(self, cursor):
+        return [call.args[0] for call in cursor.execute.call_args_list]
+    
+    def test_placeholders(self):
+        """%s は $1, $2 ... に、%% は % に変換されるテスト"""
+        self.assertEqual(numbered_placeholders("a = %s AND b LIKE '%%' || %s"), "a = $1 AND b LIKE '%' || $2")
+    
+    def test_untracked_connection_sends_sql(self):
+        """使い捨て接続ではSQLをそのまま送るテスト"""
+        cursor = self.make_cursor()
+        self.registry.execute(cursor, 'get', ("1", "k"))
+        cursor.execute.assert_called_once_with("SELECT value FROM user_data WHERE user_id = %s AND key = %s", ("1", "k"))
+    
+    def test_prepared_once_per_connection(self):
+        """接続ごとに最初の一回だけPREPAREし、再接続後とスキーマ変更後は作り直すテスト"""
+        cursor = self.make_cursor()
+        self.registry.track(cursor.connection)
+        self.registry.execute(cursor, 'get', ("1", "k"))
+        self.registry.execute(cursor, 'get', ("1", "other"))
+        self.assertEqual(self.statements(cursor), [
+            "PREPARE vault_get AS SELECT value FROM user_data WHERE user_id = $1 AND key = $2",
+            "EXECUTE vault_get (%s, %s)",
+            "EXECUTE vault_get (%s, %s)",
+        ])
+        self.assertEqual(cursor.execute.call_args.args[1], ("1", "other"))
+        
+        reconnected = self.make_cursor()
+        self.registry.track(reconnected.connection)
+        self.registry.execute(reconnected, 'get', ("1", "k"))
+        self.assertEqual(self.statements(reconnected)[0][:7], "PREPARE")
+        
+        self.registry.invalidate()
+        cursor.execute.reset_mock()
+        self.registry.execute(cursor, 'get', ("1", "k"))
+        self.assertEqual([sql.split()[0] for sql in self.statements(cursor)], ["DEALLOCATE", "PREPARE", "EXECUTE"])
+    
+    def test_stale_statement_reprepared(self):
+        """サーバー側で消えた文は、トランザクションの最初の文なら作り直して再実行するテスト"""
+        cursor = self.make_cursor()
+        self.registry.track(cursor.connection)
+        self.registry.execute(cursor, 'get', ("1", "k"))
+        cursor.execute.reset_mock()
+        cursor.execute.side_effect = [psycopg2.errors.InvalidSqlStatementName("prepared statement does not exist"),
+                                      None, None, None]
+        self.registry.execute(cursor, 'get', ("1", "k"))
+        cursor.connection.rollback.assert_called_once()
+        self.assertEqual([sql.split()[0] for sql in self.statements(cursor)], ["EXECUTE", "DEALLOCATE", "PREPARE", "EXECUTE"])
+        self.assertEqual(self.registry.stats['reprepared'], 1)
+        
+        # トランザクションの途中なら作り直さずにエラーを返し、次の実行で作り直す
+        cursor.execute.reset_mock()
+        cursor.execute.side_effect = [psycopg2.errors.FeatureNotSupported("cached plan must not change result type"),
+                                      None, None, None]
+        cursor.connection.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        with self.assertRaises(psycopg2.errors.FeatureNotSupported):
+            self.registry.execute(cursor, 'get', ("1", "k"))
+        self.registry.execute(cursor, 'get', ("1", "k"))
+        self.assertEqual([sql.split()[0] for sql in self.statements(cursor)], ["EXECUTE", "DEALLOCATE", "PREPARE", "EXECUTE"])
+    
+    def test_reprepared_after_column_type_change(self):
+        """列の型が変わり、PREPARE時に推論した引数の型が合わなくなった文も作り直すテスト"""
+        cursor = self.make_cursor()
+        self.registry.track(cursor.connection)
+        self.registry.execute(cursor, 'get', ("1", "k"))
+        for error in (psycopg2.errors.UndefinedFunction("operator does not exist: bigint = character varying"),
+                      psycopg2.errors.DatatypeMismatch("argument of WHERE must be type boolean")):
+            cursor.execute.reset_mock()
+            cursor.execute.side_effect = [error, None, None, None]
+            self.registry.execute(cursor, 'get', ("1", "k"))
+            self.assertEqual([sql.split()[0] for sql in self.statements(cursor)],
+                             ["EXECUTE", "DEALLOCATE", "PREPARE", "EXECUTE"])
+        self.assertEqual(self.registry.stats['reprepared'], 2)
+    
+    def test_pooled_connections_use_prepared_statements(self):
+        """DatabaseManagerはプールから取った接続だけでPREPAREを使うテスト"""
+        with patch.dict(os.environ, TestDegradedMode.ENV):
+            db = DatabaseManager()
+        conn = MagicMock(closed=0)
+        conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.connection = conn
+        cursor.fetchone.return_value = {'value': 'v'}
+        db._pool = MagicMock()
+        db._pool.getconn.return_value = conn
+        self.assertEqual(db.get_user_data("1", "k"), "v")
+        self.assertEqual(db.get_user_data("1", "k"), "v")
+        self.assertEqual([sql.split()[:2] for sql in self.statements(cursor)],
+                         [["PREPARE", "vault_select_one"], ["EXECUTE", "vault_select_one"], ["EXECUTE", "vault_select_one"]])
+        db._pool.putconn.assert_called_with(conn, close=False)
+        
+        # 汎用プランでは LIKE を索引の範囲にできないため、プレフィックス指定の文はPREPAREしない
+        cursor.execute.reset_mock()
+        cursor.fetchall.return_value = [("work/a",)]
+        self.assertEqual(db.list_user_keys("1", "work/"), ["work/a"])
+        self.assertIn("key LIKE %s", self.statements(cursor)[0])
+
+
+class TestExpiry(unittest.TestCase):
+    """期限付きデータ（TTL）の掃除と予定管理のテスト"""
+    
+    def setUp(self):
+        self.now = 1000.0
+        self.swept_batches = []
+        self.due = 0
+        
+        async def sweep(limit):
+            count = min(limit, self.due)
+            self.due -= count
+            self.swept_batches.append(count)
+            return count
+        
+        self.upcoming = AsyncMock(return_value=[])
+        self.scheduler = ExpiryScheduler(sweep, self.upcoming, batch_size=2, lookahead=60, clock=lambda: self.now)
+    
+    def test_due_entries_swept_in_batches(self):
+        """期限が来たら上限件数ずつ、残りがなくなるまで掃除するテスト"""
+        self.scheduler.schedule(1005.0)
+        self.scheduler.schedule(1005.0)
+        self.assertEqual(len(self.scheduler), 1)
+        asyncio.run(self.scheduler._step())
+        self.assertEqual(self.swept_batches, [])
+        
+        self.now, self.due = 1006.0, 5
+        asyncio.run(self.scheduler._step())
+        self.assertEqual(self.swept_batches, [2, 2, 1])
+        self.assertEqual(self.scheduler.stats, {'sweeps': 3, 'swept': 5})
+        self.assertEqual(len(self.scheduler), 0)
+    
+    def test_lookahead_fills_heap(self):
+        """先読みで他プロセスの期限も取り込み、遠い期限は先読みに任せるテスト"""
+        self.scheduler.schedule(5000.0)
+        self.assertEqual(len(self.scheduler), 0)
+        self.upcoming.return_value = [1010.0, 1020.0]
+        asyncio.run(self.scheduler._step())
+        self.upcoming.assert_awaited_once_with(1060.0, 1000)
+        self.assertEqual(len(self.scheduler), 2)
+        # 次の先読みは窓の半分後
+        self.assertEqual(self.scheduler._next_lookahead, 1030.0)
+    
+    def test_sweep_and_reads_use_expiry_index(self):
+        """掃除は部分インデックス順の LIMIT 付き DELETE、読み取りは期限切れを除外するテスト"""
+        with patch.dict(os.environ, TestDegradedMode.ENV):
+            db = DatabaseManager()
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [("1", "otp")]
+        with patch('database.psycopg2.connect', return_value=conn):
+            self.assertEqual(db.sweep_expired(100), [("1", "otp")])
+            sql, params = cursor.execute.call_args.args
+            self.assertIn("ORDER BY expires_at", sql)
+            self.assertIn("SKIP LOCKED", sql)
+            self.assertEqual(params, (100,))
+            
+            cursor.fetchone.return_value = None
+            self.assertIsNone(db.get_user_data("1", "otp"))
+            self.assertIn("expires_at > now()", cursor.execute.call_args.args[0])
+    
+    def test_quota_count_skips_unswept_rows(self):
+        """掃除前の期限切れデータを件数上限の計算に含めないテスト"""
+        with patch.dict(os.environ, TestDegradedMode.ENV):
+            db = DatabaseManager()
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (3,)
+        with patch('database.psycopg2.connect', return_value=conn):
+            self.assertEqual(db.get_user_data_count("1"), 3)
+            self.assertIn("expires_at <= now()", cursor.execute.call_args.args[0])
+            
+            cursor.reset_mock()
+            cursor.fetchone.side_effect = [(3,), (1,)]
+            with patch('database.psycopg2.extras.execute_values'):
+                self.assertEqual(db.import_user_data("1", {"a": "v"}, max_items=3), 1)
+            counts = [c.args[0] for c in cursor.execute.call_args_list if "COUNT(*)" in c.args[0]]
+            self.assertIn("expires_at <= now()", counts[0])
+            self.assertIn("expires_at > now()", counts[1])
+    
+    def test_queued_set_expires(self):
+        """書き込み待ちの期限付きデータも期限を過ぎれば見えなくなるテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            queue = WriteBehindQueue(os.path.join(temp_dir, "pending.ndjson"))
+            queue.append([WriteOp('set', "1", "a", "v", time.time() - 1), WriteOp('set', "1", "b", "v", time.time() + 60)])
+            self.assertEqual(queue.pending("1", "a"), (True, None))
+            self.assertEqual(WriteBehindQueue(queue.path).pending_for_user("1"), {"a": None, "b": "v"})
+    
+    def test_parse_ttl(self):
+        """有効期間の解析テスト"""
+        self.assertEqual(parse_ttl("30s"), (30, None))
+        self.assertEqual(parse_ttl("10m"), (600, None))
+        self.assertEqual(parse_ttl(" 2H "), (7200, None))
+        self.assertEqual(parse_ttl("7d"), (7 * 86400, None))
+        for text in ["", "10", "m", "1.5h", "0s", "9999d"]:
+            with self.subTest(text=text):
+                self.assertIsNotNone(parse_ttl(text)[1])
+        self.assertEqual(describe_ttl(7200), "2時間")
+        self.assertEqual(describe_ttl(90), "90秒")
+
+
+class TestColdStart(unittest.TestCase):
+    """起動高速化（遅延初期化・スキーマ確認・キャッシュ先読み）のテスト"""
+    
+    def test_lazy_manager_waits_for_warm_up(self):
+        """lazy=True では warm_up まで何も読み込まないテスト"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "data.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({"1": {"k": "v"}}, f)
+            manager = UserDataManager(path, lazy=True)
+            self.assertFalse(hasattr(manager, 'data'))
+            timeline = StartupTimeline()
+            manager.warm_up(timeline)
+            self.assertEqual(manager.get_user_data("1", "k"), "v")
+            self.assertEqual([name for name, _ in timeline.phases], ['json_load'])
+    
+    def test_json_backend_skips_database_import(self):
+        """JSONバックエンドでは psycopg2 を読み込まないテスト"""
+        env = {k: v for k, v in os.environ.items() if not k.startswith('PG')}
+        code = "import sys, bot; bot.bot.data_manager.warm_up(); print('psycopg2' in sys.modules)"
+        output = subprocess.check_output([sys.executable, "-c", code], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL)
+        self.assertEqual(output.decode().strip().splitlines()[-1], "False")
+    
+    def test_preload_fills_cache(self):
+        """最近のユーザーを先読みし、以後の読み取りがDBに行かないテスト"""
+        db = Mock()
+        db.test_connection.return_value = True
+        db.change_feed_active = True
+        db.degraded = False
+        db.change_feed_ready.wait.return_value = True
+        db.load_recent_users.return_value = {"1": {"k": "v"}}
+        with patch.object(UserDataManager, '_should_use_database', return_value=True), \
+                patch('database.DatabaseManager', return_value=db):
+            manager = UserDataManager(lazy=True)
+            manager.warm_up(preload_users=10)
+        db.open_pool.assert_called_once()
+        db.ensure_schema.assert_called_once()
+        db.load_recent_users.assert_called_once_with(10)
+        self.assertEqual(manager.get_user_data("1"), {"k": "v"})
+        db.get_user_data.assert_not_called()
+    
+    def test_fallback_stops_listener_and_pool(self):
+        """スキーマ確認に失敗してJSONに切り替えるときは、受信スレッドと接続プールを止めるテスト"""
+        db = Mock()
+        db.test_connection.return_value = True
+        db.ensure_schema.side_effect = RuntimeError("permission denied")
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                patch.object(UserDataManager, '_should_use_database', return_value=True), \
+                patch('database.DatabaseManager', return_value=db):
+            manager = UserDataManager(os.path.join(temp_dir, "data.json"), lazy=True)
+            manager.warm_up()
+        self.assertFalse(manager.use_database)
+        db.start_change_listener.assert_called_once()
+        db.stop_change_listener.assert_called_once()
+        db.close_pool.assert_called_once()
+    
+    def test_schema_applied_only_when_changed(self):
+        """schema.sql のハッシュが一致すれば再適用しないテスト"""
+        with patch.dict(os.environ, TestDegradedMode.ENV):
+            db = DatabaseManager()
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'), encoding='utf-8') as f:
+            current = DatabaseManager._schema_hash(f.read())
+        for stored, applied in ((current, False), ("old", True)):
+            conn = MagicMock()
+            cursor = conn.cursor.return_value.__enter__.return_value
+            cursor.fetchone.side_effect = [(True,), (stored,)]
+            with patch('database.psycopg2.connect', return_value=conn):
+                self.assertEqual(db.ensure_schema(), applied)
+            statements = [call.args[0] for call in cursor.execute.call_args_list]
+            self.assertEqual(any("CREATE TABLE IF NOT EXISTS user_data" in sql for sql in statements), applied)
+    
+    def test_timeline_summary(self):
+        """起動時間の内訳が記録されるテスト"""
+        timeline = StartupTimeline()
+        timeline.mark('login')
+        with timeline.phase('schema_check'):
+            pass
+        summary = timeline.summary()
+        self.assertIn("login at", summary)
+        self.assertIn("schema_check", summary)
+
+
+class TestSchemaMigration(unittest.TestCase):
+    """schema.sql と migrate_schema.py（user_id のBIGINT化）の整合性のテスト"""
+    
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'), encoding='utf-8') as f:
+            self.schema = f.read()
+    
+    def test_no_trigger_depends_on_user_id(self):
+        """user_id 列に依存するトリガーがなく、移行で旧列を削除できるテスト"""
+        import re
+        columns = re.findall(r'UPDATE OF ([\w\s,]+?) (?:OR|ON)\b', self.schema)
+        self.assertTrue(all('user_id' not in found for found in columns), columns)
+    
+    def test_migration_rebuilds_prefix_index(self):
+        """旧 user_id 列とともに消えるプレフィックス索引を、切り替え前に新しい列で作り直すテスト"""
+        import migrate_schema
+        cursor = MagicMock(rowcount=0)
+        migrate_schema.convert_user_id(cursor)
+        statements = [' '.join(c.args[0].split()) for c in cursor.execute.call_args_list]
+        build = next(i for i, sql in enumerate(statements)
+                     if sql.startswith("CREATE INDEX CONCURRENTLY idx_user_data_user_key_prefix_new")
+                     and "(user_id_new, key text_pattern_ops)" in sql)
+        drop = statements.index("ALTER TABLE user_data DROP COLUMN user_id")
+        rename = statements.index("ALTER INDEX idx_user_data_user_key_prefix_new RENAME TO idx_user_data_user_key_prefix")
+        self.assertLess(build, drop)
+        self.assertLess(drop, rename)
+        self.assertLess(rename, statements.index("COMMIT"))
+    
+    def test_benchmark_uses_temp_copy(self):
+        """書き込み性能の計測は一時テーブルの複製に対して行い、本番のトリガーを発火させないテスト"""
+        import migrate_schema
+        conn = MagicMock()
+        migrate_schema.benchmark_upserts(conn, 3)
+        cursor = conn.cursor.return_value.__enter__.return_value
+        statements = [' '.join(c.args[0].split()) for c in cursor.execute.call_args_list]
+        self.assertTrue(statements[0].startswith("CREATE TEMP TABLE user_data_benchmark (LIKE user_data INCLUDING ALL)"))
+        writes = [sql for sql in statements if sql.startswith(("INSERT", "UPDATE", "DELETE"))]
+        self.assertEqual(len(writes), 3)
+        self.assertTrue(all("user_data_benchmark" in sql for sql in writes))
+        self.assertEqual(statements[-1], "DROP TABLE IF EXISTS user_data_benchmark")
+    
+    def test_indexes_include_expires_at(self):
+        """一覧・プレフィックス用の索引が expires_at を含み、期限判定も索引だけで済むテスト"""
+        import migrate_schema
+        self.assertIn("UNIQUE(user_id, key) INCLUDE (expires_at)", self.schema)
+        self.assertIn("(user_id, key text_pattern_ops) INCLUDE (expires_at)", self.schema)
+        
+        # 既存のDBは移行スクリプトが作り直し、含んでいれば何もしない
+        cursor = MagicMock()
+        cursor.fetchone.return_value = (False,)
+        migrate_schema.cover_expires_at(cursor)
+        statements = [' '.join(c.args[0].split()) for c in cursor.execute.call_args_list]
+        built = [sql for sql in statements if sql.startswith("CREATE")]
+        self.assertEqual(len(built), 2)
+        self.assertTrue(all("CONCURRENTLY" in sql and sql.endswith("INCLUDE (expires_at)") for sql in built))
+        self.assertIn("ADD CONSTRAINT user_data_user_id_key_key UNIQUE USING INDEX user_data_user_id_key_covering",
+                      statements[-2])
+        
+        cursor.reset_mock()
+        cursor.fetchone.return_value = (True,)
+        migrate_schema.cover_expires_at(cursor)
+        self.assertEqual(cursor.execute.call_count, 2)
+
+
+class TestJsonMigration(unittest.TestCase):
+    """JSONファイルからPostgreSQLへの移行スクリプトのテスト"""
+    
+    DATA = {
+        "1": {
+            "plain": "v",
+            "edited": {"value": "v3", "history": [[1000.0, "v1"], [2000.0, "v2"]]},
+            "expired": {"value": "x", "expires_at": 1.0},
+        }
+    }
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.temp_dir, "user_data.json")
+        with open(self.json_file, 'w', encoding='utf-8') as f:
+            json.dump(self.DATA, f)
+        self.db = MagicMock()
+        self.db.test_connection.return_value = True
+        manager = patch('migrate_to_postgres.DatabaseManager', return_value=self.db)
+        manager.start()
+        self.addCleanup(manager.stop)
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_history_migrated(self):
+        """値の履歴も user_data_history に移すテスト"""
+        import migrate_to_postgres
+        self.db.set_user_data.return_value = True
+        self.db.import_history.return_value = True
+        migrate_to_postgres.migrate_json_to_postgres(self.json_file)
+        self.db.import_history.assert_any_call("1", "edited", [(1000.0, "v1"), (2000.0, "v2")])
+    
+    def test_verify_checks_entries_with_history(self):
+        """履歴だけを持つ辞書形式の値も期限切れ扱いせずに照合するテスト"""
+        import migrate_to_postgres
+        self.db.get_user_data.return_value = {"plain": "v", "edited": "stale"}
+        self.assertFalse(migrate_to_postgres.verify_migration(self.json_file))
+        self.db.get_user_data.return_value = {"plain": "v", "edited": "v3"}
+        self.assertTrue(migrate_to_postgres.verify_migration(self.json_file))
+
+
+class TestShardLauncher(unittest.TestCase):
+    """シャード分割のテスト"""
+    
+    def test_split_shards_covers_all(self):
+        """全シャードが重複なく連続した範囲に割り当てられるテスト"""
+        ranges = split_shards(10, 3)
+        self.assertEqual(ranges, [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]])
+    
+    def test_split_shards_more_workers_than_shards(self):
+        """ワーカー数がシャード数を超える場合のテスト"""
+        self.assertEqual(split_shards(2, 8), [[0], [1]])
+    
+    def test_split_shards_invalid(self):
+        """シャード数0はエラーになるテスト"""
+        with self.assertRaises(ValueError):
+            split_shards(0, 1)
+
+
+class TestAdmissionControl(unittest.TestCase):
+    """流量制御のテスト"""
+    
+    def setUp(self):
+        self.now = 0.0
+        self.controller = AdmissionController(
+            rate_per_minute=60, burst=3, max_concurrent=1, max_queue=1,
+            queue_timeout=0.2, clock=lambda: self.now
+        )
+    
+    def test_token_bucket_burst_and_refill(self):
+        """バースト分まで許可し、時間経過で回復するテスト"""
+        self.assertEqual([self.controller.admit_user("1") for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(self.controller.retry_after("1"), 1.0)
+        # 他のユーザーには影響しない
+        self.assertTrue(self.controller.admit_user("2"))
+        self.now += 1.0
+        self.assertTrue(self.controller.admit_user("1"))
+        self.assertFalse(self.controller.admit_user("1"))
+    
+    def test_storage_runs_in_thread(self):
+        """ストレージ処理がワーカースレッドで実行されるテスト"""
+        result = asyncio.run(self.controller.run(threading.current_thread))
+        self.assertIsNot(result, threading.current_thread())
+    
+    def test_overload_rejected(self):
+        """同時実行上限と待ち行列が埋まると即座に拒否するテスト"""
+        release = threading.Event()
+        
+        async def scenario():
+            slow = asyncio.ensure_future(self.controller.run(release.wait, 5))
+            await asyncio.sleep(0.05)
+            queued = asyncio.ensure_future(self.controller.run(time.sleep, 0))
+            await asyncio.sleep(0.01)
+            with self.assertRaises(Overloaded):
+                await self.controller.run(time.sleep, 0)
+            # 待ち行列側はタイムアウトで拒否される
+            with self.assertRaises(Overloaded):
+                await queued
+            release.set()
+            await slow
+        
+        asyncio.run(scenario())
+        self.assertEqual(self.controller.stats['overloaded'], 2)
+        self.assertEqual(self.controller.in_flight, 0)
+
+
+class TestResponseDeferral(unittest.TestCase):
+    """応答の自動deferのテスト"""
+    
+    def setUp(self):
+        self.stats = ResponseStats()
+        self.interaction = Mock()
+        self.interaction.command.name = "save"
+        self.interaction.response.defer = AsyncMock()
+        self.interaction.response.send_message = AsyncMock()
+        self.interaction.followup.send = AsyncMock()
+    
+    def test_fast_reply_sent_directly(self):
+        """予算内に終わればdeferせずそのまま返信するテスト"""
+        async def work():
+            return "ok"
+        
+        asyncio.run(respond_with_deferral(self.interaction, work(), 1.0, self.stats))
+        self.interaction.response.defer.assert_not_called()
+        self.interaction.response.send_message.assert_awaited_once_with("ok", ephemeral=True)
+        self.assertEqual(self.stats.commands["save"]["fast"], 1)
+    
+    def test_slow_reply_deferred(self):
+        """予算を超えるとdeferしてフォローアップで返信するテスト"""
+        async def work():
+            await asyncio.sleep(0.1)
+            return "slow", None
+        
+        asyncio.run(respond_with_deferral(self.interaction, work(), 0.01, self.stats))
+        self.interaction.response.defer.assert_awaited_once_with(ephemeral=True, thinking=True)
+        self.interaction.followup.send.assert_awaited_once_with("slow", ephemeral=True)
+        self.interaction.response.send_message.assert_not_called()
+        self.assertEqual(self.stats.commands["save"]["deferred"], 1)
+        self.assertIn("1 deferred", self.stats.summary()[0])
+    
+    def test_error_recorded_and_raised(self):
+        """処理の例外は記録した上でそのまま伝播するテスト"""
+        async def work():
+            raise Overloaded()
+        
+        with self.assertRaises(Overloaded):
+            asyncio.run(respond_with_deferral(self.interaction, work(), 1.0, self.stats))
+        self.assertEqual(self.stats.commands["save"]["fast"], 1)
+
+
+class TestDebugProfiling(unittest.TestCase):
+    """/debug の計測（CPUプロファイル・メモリ差分・イベントループ）のテスト"""
+    
+    def test_sampling_profile(self):
+        """別スレッドで処理中の関数が上位に出て、待機中のスレッドは数えないテスト"""
+        stop = threading.Event()
+        
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+        
+        worker = threading.Thread(target=busy_loop, name='busy_1')
+        idle = threading.Thread(target=stop.wait, name='idle')
+        worker.start()
+        idle.start()
+        try:
+            profile = sample_stacks(0.2, interval=0.01)
+        finally:
+            stop.set()
+            worker.join()
+            idle.join()
+        self.assertGreater(profile.ticks, 0)
+        label, _ = profile.top_self(1)[0]
+        self.assertTrue(label.startswith("[busy] busy_loop"))
+        self.assertFalse(any(label.startswith("[idle]") for label, _ in profile.top_self(10)))
+        self.assertTrue(any(line.startswith("idle;") for line in profile.folded()))
+        self.assertIn("## Folded stacks", profile.report())
+    
+    def test_memory_diff(self):
+        """計測中に確保されて残ったメモリが差分に出て、終了後はtracemallocを止めるテスト"""
+        import tracemalloc
+        kept = []
+        
+        async def run():
+            async def allocate():
+                kept.extend(bytearray(10000) for _ in range(50))
+            task = asyncio.ensure_future(allocate())
+            diff = await memory_diff(0.05)
+            await task
+            return diff
+        
+        diff = asyncio.run(run())
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIn("test_bot.py", diff.summary(1)[0])
+        self.assertIn("## By line", diff.report())
+    
+    def test_loop_lag_and_tasks(self):
+        """ループをブロックした分が遅延として測れて、タスク数も数えられるテスト"""
+        async def run():
+            async def block():
+                await asyncio.sleep(0.01)
+                time.sleep(0.1)
+            blocker = asyncio.ensure_future(block())
+            lags = await measure_loop_lag(0.2, tick=0.02)
+            await blocker
+            return lags, task_counts()
+        
+        lags, tasks = asyncio.run(run())
+        self.assertGreaterEqual(max(lags), 0.05)
+        self.assertEqual(tasks, {'TestDebugProfiling.test_loop_lag_and_tasks.<locals>.run': 1})
+    
+    def test_owner_only(self):
+        """オーナー以外は計測せずに断り、オーナーには添付ファイル付きで返すテスト"""
+        interaction = MagicMock()
+        interaction.response.send_message = AsyncMock()
+        work = debug_profile_reply(1)
+        with patch('bot.bot.is_owner', AsyncMock(return_value=False)):
+            asyncio.run(respond_owner_only(interaction, work))
+        self.assertIn("オーナー", interaction.response.send_message.call_args.args[0])
+        self.assertIsNone(work.cr_frame)  # 計測は始まっていない
+        
+        content, file = asyncio.run(debug_loop_reply(0))
+        self.assertIsNone(file)
+        content, file = asyncio.run(debug_loop_reply(1))
+        self.assertIn("イベントループ", content)
+        self.assertTrue(file.filename.startswith("loop-"))
+
+
+class TestBackupChunks(unittest.TestCase):
+    """バックアップファイル分割のテスト"""
+    
+    def test_chunk_round_trip(self):
+        """分割書き込みしたレコードが順序通り読み戻せるテスト"""
+        records = [{"user_id": "1", "key": f"k{i}", "value": "値"} for i in range(7)]
+        with tempfile.TemporaryDirectory() as directory:
+            files = write_chunks(directory, 'rows', iter(records), chunk_rows=3)
+            self.assertEqual([f['rows'] for f in files], [3, 3, 1])
+            self.assertEqual(list(read_chunks(directory, files)), records)
+    
+    def test_empty_chunks(self):
+        """レコードがない場合はファイルを作らないテスト"""
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(write_chunks(directory, 'rows', iter([])), [])
+            self.assertEqual(os.listdir(directory), [])
+    
+    def test_tombstones_match_user_id_column_type(self):
+        """削除記録の適用は user_id 列の型（移行前の VARCHAR も）に合わせて比較するテスト"""
+        from backup import _apply_tombstones
+        tombstones = [{"user_id": "123", "key": "k", "deleted_at": "2026-01-01T00:00:00.000000"}]
+        with patch('backup.psycopg2.extras.execute_values') as execute_values:
+            for column_type, cast in (('bigint', '%s::bigint'), ('character varying', '%s::varchar')):
+                _apply_tombstones(MagicMock(rowcount=1), tombstones, column_type)
+                sql, rows = execute_values.call_args.args[1:]
+                self.assertIn("d.user_id = t.user_id", sql)
+                self.assertEqual(execute_values.call_args.kwargs['template'], f"({cast}, %s)")
+                self.assertEqual(rows, [("123", "k")])
+
+
 class TestValidation(unittest.TestCase):
     """バリデーション関数のテスト"""
     
+    def test_parse_names(self):
+        """複数データ名の分解と検証のテスト"""
+        self.assertEqual(parse_names("a b,c  a"), (["a", "b", "c"], None))
+        self.assertEqual(parse_names("single"), (["single"], None))
+        self.assertIsNotNone(parse_names("ok bad@name")[1])
+        self.assertIsNotNone(parse_names(" , ")[1])
+        self.assertIsNotNone(parse_names(" ".join(f"k{i}" for i in range(MAX_NAMES_PER_COMMAND + 1)))[1])
+    
     def test_validate_name_valid(self):
         """有効なデータ名のテスト"""
         valid_names = ["password", "test123", "my_password", "key-name", "a", "A1_2-3"]
@@ -137,6 +1625,20 @@ class TestValidation(unittest.TestCase):
                 self.assertIsNotNone(error)
                 self.assertIn("英数字、アンダースコア、ハイフン", error)
     
+    def test_namespaced_names(self):
+        """「/」区切りの階層名とプレフィックスの検証テスト"""
+        for name in ["work/github/token", "a/b", "my-app/key_1"]:
+            with self.subTest(name=name):
+                self.assertIsNone(validate_name(name))
+        for name in ["/work", "work/", "work//token", "work/ token"]:
+            with self.subTest(name=name):
+                self.assertIsNotNone(validate_name(name))
+        self.assertIsNone(validate_prefix("work/"))
+        self.assertIsNone(validate_prefix("work/git"))
+        self.assertIsNotNone(validate_prefix(""))
+        self.assertIsNotNone(validate_prefix("/"))
+        self.assertIsNotNone(validate_prefix("work%"))
+    
     def test_validate_name_too_long(self):
         """長すぎるデータ名のテスト"""
         long_name = "a" * (MAX_NAME_LENGTH + 1)
@@ -151,6 +1653,36 @@ class TestValidation(unittest.TestCase):
             with self.subTest(value=value[:20] + "..."):
                 self.assertIsNone(validate_value(value))
     
+    def test_parse_import_lines(self):
+        """NDJSONインポートの解析テスト"""
+        lines = ['{"name": "a", "value": "1"}\n', '\n', '{"name": "b", "value": "日本語"}\n']
+        items, expiries, error = parse_import_lines(lines)
+        self.assertIsNone(error)
+        self.assertEqual(items, {"a": "1", "b": "日本語"})
+        self.assertEqual(expiries, {})
+    
+    def test_parse_import_lines_invalid(self):
+        """不正な行で行番号付きエラーになるテスト"""
+        cases = [
+            ['{"name": "a", "value": "1"}', 'not json'],
+            ['{"name": "a"}'],
+            ['{"name": "a", "value": 1}'],
+            ['{"name": "bad name", "value": "1"}'],
+            ['{"name": "a", "value": "1", "expires_at": "tomorrow"}'],
+        ]
+        for lines in cases:
+            with self.subTest(lines=lines):
+                items, expiries, error = parse_import_lines(lines)
+                self.assertEqual(items, {})
+                self.assertIn(f"{len(lines)}行目", error)
+    
+    def test_parse_import_lines_too_many(self):
+        """上限件数を超えるファイルは途中で打ち切るテスト"""
+        lines = (f'{{"name": "k{i}", "value": "v"}}' for i in range(MAX_ITEMS_PER_USER + 10))
+        items, expiries, error = parse_import_lines(lines)
+        self.assertEqual(items, {})
+        self.assertIn(f"{MAX_ITEMS_PER_USER}件", error)
+    
     def test_validate_value_too_long(self):
         """長すぎるデータ値のテスト"""
         long_value = "a" * (MAX_VALUE_LENGTH + 1)
@@ -217,7 +1749,7 @@ def run_tests():
     print("=" * 50)
     
     # テストスイートを作成
-    test_classes = [TestUserDataManager, TestValidation, TestIntegration]
+    test_classes = [TestUserDataManager, TestCompactStore, TestChangeFeedCache, TestSingleFlight, TestReadReplicaRouting, TestWriteBatching, TestDegradedMode, TestMultiKeyQueries, TestHistory, TestPreparedStatements, TestExpiry, TestColdStart, TestSchemaMigration, TestJsonMigration, TestShardLauncher, TestAdmissionControl, TestResponseDeferral, TestDebugProfiling, TestBackupChunks, TestValidation, TestIntegration]
     suite = unittest.TestSuite()
     
     for test_class in test_classes:
@@ -48,7 +48,7 @@ def test_database_connection():
         logger.info("✓ Database schema initialized")
         
         # Test basic operations
-        test_user_id = "test_user_123"
+        test_user_id = "123456789012345678"  # user_id is a BIGINT snowflake
         test_key = "test_key"
         test_value = "test_value"
         